@@ -0,0 +1,214 @@
+import threading
+import bisect
+import math
+import time
+
+"""
+Runtime predictions and the expected start and end (ETA) of every queued task.
+
+The runtime (from 'Running' to 'Finished') of every finished task is counted in quantile sketches
+per owner and task type, per owner, per task type and over all tasks.
+A prediction comes from the most specific sketch with enough samples, the duration the user
+guessed is only used if there is no sketch for the owner and the task type yet.
+"""
+
+# A sketch is used for predictions once it has seen this many tasks
+MIN_SAMPLES = 5
+
+
+class RuntimeSketch:
+    """
+    Streaming quantile sketch of runtimes in seconds.
+    Values are counted in logarithmic buckets (as in DDSketch), so every quantile is off by
+    at most <accuracy> (relative) and the memory only grows with the range of the values, not their number.
+    """
+    def __init__(self, accuracy=0.02):
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.counts = {}
+        self.count = 0
+        # Sorted buckets with cumulative counts and quantiles, until the next value is added
+        self._cumulative = None
+        self._quantiles = {}
+
+    def _key(self, value):
+        return int(math.ceil(math.log(max(value, 1.0)) / self._log_gamma))
+
+    def _value(self, key):
+        # The value in the middle of the bucket (relative to its bounds)
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def add(self, value):
+        key = self._key(value)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.count += 1
+        self._cumulative = None
+        self._quantiles = {}
+
+    def cumulative(self):
+        if self._cumulative is None:
+            keys = sorted(self.counts)
+            cumulative = []
+            total = 0
+            for key in keys:
+                total += self.counts[key]
+                cumulative.append(total)
+            self._cumulative = (keys, cumulative)
+        return self._cumulative
+
+    def quantile(self, q, above=0):
+        """
+        The <q>-quantile (0 - 1) of all values or only of the values larger than <above>
+        (e.g. for a task that is running for <above> seconds already).
+        None if there are no such values
+        """
+        if above <= 0 and q in self._quantiles:
+            return self._quantiles[q]
+        keys, cumulative = self.cumulative()
+        skip = 0
+        if above > 0:
+            i = bisect.bisect_right(keys, self._key(above))
+            skip = cumulative[i - 1] if i > 0 else 0
+        if skip >= self.count:
+            return None
+        rank = skip + max(1, math.ceil(q * (self.count - skip)))
+        value = self._value(keys[bisect.bisect_left(cumulative, rank)])
+        if above <= 0:
+            self._quantiles[q] = value
+        return value
+
+
+class RuntimeEstimator:
+    """
+    Learns the runtimes of finished tasks and predicts the runtime of new and running ones.
+    -----
+    default - runtime in seconds if nothing is known about a task
+    """
+    def __init__(self, default=3600, accuracy=0.02):
+        self.default = default
+        self.accuracy = accuracy
+        self.sketches = {}
+        # Every task is learned once, even if its row changes again later (e.g. 'Finished' -> 'Done')
+        self.learned = set()
+
+    def learn(self, rows):
+        """ Input: rows - tasks (rows of the db), those with a start and finish time are learned """
+        for row in rows:
+            if row['id'] in self.learned or not row.get('started') or not row.get('finished'):
+                continue
+            self.learned.add(row['id'])
+            runtime = row['finished'] - row['started']
+            if runtime <= 0:
+                continue
+            for key in self._keys(row['owner'], row['task_type']):
+                if key not in self.sketches:
+                    self.sketches[key] = RuntimeSketch(self.accuracy)
+                self.sketches[key].add(runtime)
+
+    def _keys(self, owner, task_type):
+        return [(owner, task_type), (owner, None), (None, task_type), (None, None)]
+
+    def estimate(self, task, q=0.5, elapsed=0):
+        """
+        Input: task - row of the db
+               q - quantile of the runtime (0.5 for the median, higher to be on the safe side)
+               elapsed - how long the task is running already (seconds)
+        -----
+        Returns the predicted runtime in seconds (at least <elapsed>)
+        """
+        keys = self._keys(task['owner'], task['task_type'])
+        candidates = [self.sketches.get(keys[0]), 60 * task['duration'] if task.get('duration') else None] + \
+            [self.sketches.get(key) for key in keys[1:]]
+        for candidate in candidates:
+            if isinstance(candidate, RuntimeSketch):
+                if candidate.count < MIN_SAMPLES:
+                    continue
+                candidate = candidate.quantile(q, elapsed)
+            if candidate is not None and candidate >= elapsed:
+                return candidate
+        return max(self.default, elapsed)
+
+
+def forecast(queue, running, capacity, now, parallel=0):
+    """
+    Input: queue - Pending tasks in the order they should start, with their predicted runtime
+           running - Running tasks with their predicted end
+           capacity - {node: allocatable resources}
+           parallel - at most this many jobs at once (0 = no limit)
+    -----
+    Returns {id: (start, end)} for every queued task that fits on any node.
+    The tasks are started in the order of the queue as soon as they fit, on the node where they
+    can start first (best-fit if that's the case for several nodes). Every task starts
+    no earlier than the one before it, so it doesn't count on backfill and is a bit pessimistic.
+    """
+    free = dict(capacity)
+    # [(end, id, request)] of all jobs on a node that end after the current time, sorted
+    ends = {node: [] for node in capacity}
+    slots = []
+    for r in running:
+        end = max(r.end, now)
+        bisect.insort(slots, end)
+        if r.node in free:
+            free[r.node] = free[r.node] - r.request
+            bisect.insort(ends[r.node], (end, r.id, r.request))
+
+    current = now
+    result = {}
+    for task in queue:
+        if not any(c.fits(task.request) for c in capacity.values()):
+            continue
+        earliest = current
+        if 0 < parallel <= len(slots):
+            earliest = max(earliest, slots[len(slots) - parallel])
+
+        best = None
+        for node, node_ends in ends.items():
+            available = free[node]
+            start = earliest
+            i = 0
+            while i < len(node_ends) and (node_ends[i][0] <= earliest or not available.fits(task.request)):
+                start = max(start, node_ends[i][0])
+                available = available + node_ends[i][2]
+                i += 1
+            if available.fits(task.request):
+                candidate = (start, (available - task.request).share(capacity[node]), node)
+                if best is None or candidate < best:
+                    best = candidate
+        start, _, node = best
+        end = start + task.runtime
+        result[task.id] = (start, end)
+
+        # Everything that ends before this start is free for the following tasks
+        current = start
+        for other, node_ends in ends.items():
+            done = bisect.bisect_right(node_ends, (current, float('inf')))
+            if done:
+                free[other] = sum((request for _, _, request in node_ends[:done]), free[other])
+                del node_ends[:done]
+        del slots[:bisect.bisect_right(slots, current)]
+        free[node] = free[node] - task.request
+        bisect.insort(ends[node], (end, task.id, task.request))
+        bisect.insort(slots, end)
+    return result
+
+
+class QueueForecast:
+    """
+    The ETAs of the last update, shared between the reconciler and the IPC server
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._etas = {}
+        self.updated = None
+
+    def set(self, etas):
+        with self._lock:
+            self._etas = etas
+            self.updated = time.time()
+
+    def etas(self):
+        """ {id: (start, end)}, starts that already passed (the task is about to start) are moved to now """
+        now = time.time()
+        with self._lock:
+            etas = self._etas
+        return {_id: (max(start, now), max(end, now + end - start)) for _id, (start, end) in etas.items()}
@@ -0,0 +1,221 @@
+from kubernetes import watch
+from kubernetes.client.rest import ApiException
+from types import SimpleNamespace
+import threading
+import logging
+import json
+import time
+
+
+class Informer(threading.Thread):
+    """
+    Keeps a local copy of one kind of Kubernetes object (Jobs, Pods, Services)
+    up to date without re-listing the cluster.
+    -----
+    The objects are listed exactly once, afterwards a watch stream is opened at the
+    resourceVersion of that list. When the stream times out it is resumed at the last
+    resourceVersion that was seen, so no event is lost and nothing is listed again.
+    Only if the API server answers with '410 Gone' (the resourceVersion is too old)
+    the objects are listed again.
+
+    Every change is passed to <on_event(kind, event_type, obj, received)>,
+    where <received> is the time the event arrived (used to measure the event lag).
+    -----
+    For testing <stream> can be replaced by any function that takes a resourceVersion
+    and returns an iterable of events (see 'RecordedStream').
+    If <recording> is a path all received events are appended to it (see 'record').
+    """
+    def __init__(self, kind, list_func, on_event=None, stream=None, timeout=300, recording=None, **kwargs):
+        super().__init__(name="informer-%s" % kind, daemon=True)
+        self.kind = kind
+        self.list_func = list_func
+        self.kwargs = kwargs
+        self.on_event = on_event
+        self.stream = stream or self._watch
+        self.timeout = timeout
+        self.recording = recording
+        self.resource_version = None
+        self.synced = threading.Event()
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._stopping = False
+
+    def items(self):
+        """ All objects currently known, the cache is never modified in place """
+        with self._lock:
+            return list(self._cache.values())
+
+    def get(self, name):
+        with self._lock:
+            return self._cache.get(name)
+
+    def stop(self):
+        self._stopping = True
+
+    def list(self):
+        """ (Re-)Fill the cache from a single list call """
+        result = self.list_func(**self.kwargs)
+        with self._lock:
+            self._cache = {obj.metadata.name: obj for obj in result.items}
+        self.resource_version = result.metadata.resource_version
+        logging.info("Listed %d %s at resourceVersion %s" % (len(result.items), self.kind, self.resource_version))
+        self.synced.set()
+        if self.on_event is not None:
+            self.on_event(self.kind, 'LISTED', None, time.time())
+
+    def handle(self, event):
+        """
+        Apply a single watch event to the cache.
+        Returns False if the stream has to be restarted with a new list.
+        """
+        received = time.time()
+        event_type = event['type']
+        if self.recording is not None:
+            record(self.recording, self.kind, event)
+        if event_type == 'ERROR':
+            status = event.get('raw_object', {})
+            if status.get('code') == 410:
+                logging.info("resourceVersion %s of %s expired" % (self.resource_version, self.kind))
+                return False
+            logging.warning("Error event while watching %s: %s" % (self.kind, status))
+            return True
+        if event_type == 'BOOKMARK':
+            self.resource_version = event['raw_object']['metadata']['resourceVersion']
+            return True
+
+        obj = event['object']
+        with self._lock:
+            if event_type == 'DELETED':
+                self._cache.pop(obj.metadata.name, None)
+            else:
+                self._cache[obj.metadata.name] = obj
+        self.resource_version = obj.metadata.resource_version
+        if self.on_event is not None:
+            self.on_event(self.kind, event_type, obj, received)
+        return True
+
+    def _watch(self, resource_version):
+        w = watch.Watch()
+        return w.stream(self.list_func, resource_version=resource_version,
+                        timeout_seconds=self.timeout, **self.kwargs)
+
+    def run(self):
+        relist = True
+        while not self._stopping:
+            try:
+                if relist:
+                    self.list()
+                    relist = False
+                for event in self.stream(self.resource_version):
+                    if not self.handle(event):
+                        relist = True
+                        break
+                    if self._stopping:
+                        break
+            except ApiException as e:
+                relist = e.status == 410
+                logging.warning("Exception while watching %s: %s\n" % (self.kind, e))
+                time.sleep(1)
+            except Exception as e:
+                # Connection problems, resume at the last resourceVersion
+                logging.warning("Watch of %s interrupted: %s" % (self.kind, e))
+                time.sleep(1)
+
+
+class ClusterCache:
+    """
+    The informers for all objects the scheduler is interested in.
+    Jobs and Pods of notebooks are labeled with 'id', their Services with 'sid'.
+    Idle pods of the warm pool are labeled with 'pool=warm' (see warmpool.py).
+    Nodes only cause a reconcile when they are added or removed,
+    not for every heartbeat that changes their status.
+    """
+    def __init__(self, batch_api_instance, core_api_instance, on_event=None, streams=None, recording=None):
+        streams = streams or {}
+
+        def on_node_event(kind, event_type, obj, received):
+            if on_event is not None and event_type in ('ADDED', 'DELETED', 'LISTED'):
+                on_event(kind, event_type, obj, received)
+
+        self.informers = {
+            'jobs': Informer('jobs', batch_api_instance.list_namespaced_job, on_event,
+                             stream=streams.get('jobs'), recording=recording,
+                             namespace='default', label_selector='id'),
+            'pods': Informer('pods', core_api_instance.list_namespaced_pod, on_event,
+                             stream=streams.get('pods'), recording=recording,
+                             namespace='default', label_selector='id'),
+            'warm': Informer('warm', core_api_instance.list_namespaced_pod, on_event,
+                             stream=streams.get('warm'), recording=recording,
+                             namespace='default', label_selector='pool=warm'),
+            'services': Informer('services', core_api_instance.list_namespaced_service, on_event,
+                                 stream=streams.get('services'), recording=recording,
+                                 namespace='default', label_selector='sid'),
+            'nodes': Informer('nodes', core_api_instance.list_node, on_node_event,
+                              stream=streams.get('nodes'), recording=recording),
+        }
+
+    def start(self, timeout=None):
+        """ Start all informers and wait until every cache was filled once """
+        for informer in self.informers.values():
+            informer.start()
+        for informer in self.informers.values():
+            informer.synced.wait(timeout)
+
+    def stop(self):
+        for informer in self.informers.values():
+            informer.stop()
+
+    def jobs(self):
+        return self.informers['jobs'].items()
+
+    def pods(self):
+        return self.informers['pods'].items()
+
+    def warm_pods(self):
+        return self.informers['warm'].items()
+
+    def services(self):
+        return self.informers['services'].items()
+
+    def nodes(self):
+        return self.informers['nodes'].items()
+
+
+class RecordedStream:
+    """
+    Replays a recorded event stream instead of watching a real API server.
+    -----
+    The recording is a file with one JSON object per line, as written by 'record':
+    {"kind": "pods", "type": "MODIFIED", "object": {<the raw object>}}
+    Events are deserialized to the same models the kubernetes client would return.
+    Only events newer than the requested resourceVersion are replayed, when there are none left
+    the stream idles like a quiet watch would.
+    """
+    def __init__(self, path, kind, api_client, model, idle=1):
+        self.path = path
+        self.kind = kind
+        self.api_client = api_client
+        self.model = model
+        self.idle = idle
+
+    def __call__(self, resource_version):
+        replayed = False
+        with open(self.path, 'r') as f:
+            for line in f:
+                event = json.loads(line)
+                raw = event['object']
+                if event['kind'] != self.kind or \
+                        int(raw['metadata']['resourceVersion']) <= int(resource_version or 0):
+                    continue
+                replayed = True
+                yield {'type': event['type'],
+                       'raw_object': raw,
+                       'object': self.api_client.deserialize(SimpleNamespace(data=json.dumps(raw)), self.model)}
+        if not replayed:
+            time.sleep(self.idle)
+
+
+def record(path, kind, event):
+    """ Append a watch event to a recording that can be replayed with 'RecordedStream' """
+    with open(path, 'a') as f:
+        f.write(json.dumps({'kind': kind, 'type': event['type'], 'object': event['raw_object']}) + '\n')
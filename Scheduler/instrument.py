@@ -0,0 +1,68 @@
+from prometheus_client import Counter, Histogram, start_http_server
+from kubernetes.client.rest import ApiException
+# Shared with the website (common/tracing.py), imported from here by the modules of the scheduler
+from tracing import tracer, timed
+import functools
+import os
+
+"""
+Timing of the hot paths of the scheduler.
+
+Every Kubernetes API call, db statement and transaction, IPC request and reconcile is measured
+in a Prometheus histogram, served as text on http://<pod>:<METRICS_PORT>/metrics.
+If TRACE_FILE is set every measurement is also written as a span to that file (see common/tracing.py).
+"""
+
+METRICS_PORT = int(os.environ.get('SCHEDULER_METRICS_PORT', 9100))
+
+# Buckets from 1ms to 30s
+BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+KUBE_SECONDS = Histogram('scheduler_kube_api_seconds', "Duration of Kubernetes API calls (of watches until the stream "
+                                                       "is open)", ['call'], buckets=BUCKETS)
+KUBE_ERRORS = Counter('scheduler_kube_api_errors_total', "Kubernetes API calls that failed", ['call', 'status'])
+DB_STATEMENT_SECONDS = Histogram('scheduler_db_statement_seconds', "Duration of db statements (writes include the "
+                                                                   "wait for the lock)", ['statement'], buckets=BUCKETS)
+DB_TRANSACTION_SECONDS = Histogram('scheduler_db_transaction_seconds', "Duration of db transactions including the "
+                                                                       "commit", ['operation'], buckets=BUCKETS)
+IPC_SECONDS = Histogram('scheduler_ipc_seconds', "Time to handle a message of the frontend", ['op'], buckets=BUCKETS)
+RECONCILE_SECONDS = Histogram('scheduler_reconcile_seconds', "Duration of a reconcile", buckets=BUCKETS)
+EVENT_LAG_SECONDS = Histogram('scheduler_event_lag_seconds', "Time from the oldest pending event until the "
+                                                             "reconcile starts", buckets=BUCKETS)
+STEP_SECONDS = Histogram('scheduler_update_step_seconds', "Duration of the steps of a reconcile", ['step'],
+                         buckets=BUCKETS)
+START_LATENCY_SECONDS = Histogram('scheduler_start_latency_seconds', "Time from the submission of a task until its "
+                                                                     "notebook runs, in a warm pod or a new job",
+                                  ['start'], buckets=(1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600, 1800))
+
+
+class InstrumentedApi:
+    """
+    Wraps an instance of a Kubernetes API (e.g. BatchV1Api) and measures every call of it.
+    The wrapped methods keep their docstrings, 'watch.Watch' reads the return type from them.
+    """
+    def __init__(self, api):
+        self._api = api
+
+    def __getattr__(self, name):
+        attr = getattr(self._api, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            label = name + (' (watch)' if kwargs.get('watch') else '')
+            try:
+                with timed(KUBE_SECONDS, label, call=label):
+                    return attr(*args, **kwargs)
+            except ApiException as e:
+                KUBE_ERRORS.labels(call=label, status=str(e.status)).inc()
+                raise
+        setattr(self, name, call)
+        return call
+
+
+def serve_metrics(port=METRICS_PORT):
+    """ Serve /metrics in a thread of its own (port 0: not at all) """
+    if port > 0:
+        start_http_server(port)
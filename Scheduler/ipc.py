@@ -0,0 +1,199 @@
+from instrument import timed, IPC_SECONDS
+import selectors
+import socket
+import struct
+import logging
+import json
+import time
+
+# Every message is a JSON object prefixed by its length (4 bytes, big endian)
+HEADER = struct.Struct('>I')
+MAX_MESSAGE = 1 << 20
+
+
+def encode(message):
+    data = json.dumps(message).encode('utf-8')
+    return HEADER.pack(len(data)) + data
+
+
+class Connection:
+    """ Buffers of a single client """
+    def __init__(self, sock):
+        self.sock = sock
+        self.inbuf = b''
+        self.outbuf = b''
+
+    def messages(self):
+        """ All complete messages received so far """
+        while len(self.inbuf) >= HEADER.size:
+            length, = HEADER.unpack_from(self.inbuf)
+            if length > MAX_MESSAGE:
+                raise ValueError("Message too long (%d bytes)" % length)
+            if len(self.inbuf) < HEADER.size + length:
+                return
+            data = self.inbuf[HEADER.size:HEADER.size + length]
+            self.inbuf = self.inbuf[HEADER.size + length:]
+            yield json.loads(data.decode('utf-8'))
+
+
+class IpcServer:
+    """
+    Request/acknowledge protocol between the frontend and the scheduler.
+    -----
+    Many clients can be connected at once, they are all served by a single selector loop,
+    the reconciles themselves run in the thread of the Reconciler.
+    Messages:
+      {"op": "update"}
+        -> {"ok": true, "generation": N}
+        Is answered immediately. N is the reconcile generation that will include the update,
+        updates that arrive while one is pending are coalesced into the same reconcile.
+      {"op": "wait", "generation": N, "timeout": T}
+        -> {"ok": true/false, "generation": <current generation>}
+        Is answered as soon as generation N is done or after T seconds (ok = false).
+      {"op": "eta"}
+        -> {"ok": true, "eta": {"<id>": [start, end]}, "updated": <time of the last reconcile>}
+        Expected start and end (unix time) of all queued tasks, from the QueueForecast <etas>.
+      {"op": "metrics", "id": N, "last": K}
+        -> {"ok": true, "metrics": {"time": [...], "cpu": [...], ..., "peaks": {...}}}
+        Resource usage of a task (the last K samples, all if not given), from the TelemetryCollector <telemetry>.
+        Without "id": {"ok": true, "metrics": {"<id>": {"cpu": [...], "mem": [...]}}} for all running tasks.
+      {"op": "route", "id": N}
+        -> {"ok": true, "address": "<ip>:<port>"}
+        Where the Jupyter server of a task can be reached, from <routes> (ok = false while it has none).
+    """
+    def __init__(self, reconciler, host='127.0.0.1', port=65432, etas=None, telemetry=None, routes=None):
+        self.reconciler = reconciler
+        self.etas = etas
+        self.telemetry = telemetry
+        self.routes = routes
+        self.selector = selectors.DefaultSelector()
+        self.handlers = {'update': self.handle_update, 'wait': self.handle_wait, 'eta': self.handle_eta,
+                         'metrics': self.handle_metrics, 'route': self.handle_route}
+        # (deadline, generation, connection) for every client that waits for a reconcile
+        self.waiting = []
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(128)
+        self.sock.setblocking(False)
+        self.selector.register(self.sock, selectors.EVENT_READ, None)
+
+        # The reconciler wakes up the loop when a generation is done
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self.selector.register(self._wakeup_r, selectors.EVENT_READ, 'wakeup')
+        reconciler.on_done.append(self.wakeup)
+
+    def wakeup(self, generation=None):
+        try:
+            self._wakeup_w.send(b'\0')
+        except BlockingIOError:
+            # There is already a wake up pending
+            pass
+
+    def handle_update(self, conn, message):
+        self.send(conn, {'ok': True, 'generation': self.reconciler.notify('frontend')})
+
+    def handle_wait(self, conn, message):
+        generation = int(message['generation'])
+        if self.reconciler.generation >= generation:
+            self.send(conn, {'ok': True, 'generation': self.reconciler.generation})
+        else:
+            deadline = time.time() + float(message.get('timeout', 30))
+            self.waiting.append((deadline, generation, conn))
+
+    def handle_eta(self, conn, message):
+        if self.etas is None:
+            self.send(conn, {'ok': False, 'error': "no forecast"})
+        else:
+            self.send(conn, {'ok': True, 'eta': {str(_id): eta for _id, eta in self.etas.etas().items()},
+                             'updated': self.etas.updated})
+
+    def handle_metrics(self, conn, message):
+        if self.telemetry is None:
+            self.send(conn, {'ok': False, 'error': "no telemetry"})
+        elif message.get('id') is None:
+            self.send(conn, {'ok': True, 'metrics': {str(_id): s for _id, s in
+                                                     self.telemetry.summary(message.get('last', 30)).items()}})
+        else:
+            series = self.telemetry.series(int(message['id']), message.get('last'))
+            self.send(conn, {'ok': series is not None, 'metrics': series})
+
+    def handle_route(self, conn, message):
+        address = self.routes(int(message['id'])) if self.routes is not None else None
+        self.send(conn, {'ok': address is not None, 'address': address})
+
+    def send(self, conn, message):
+        conn.outbuf += encode(message)
+        self.selector.modify(conn.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, conn)
+
+    def close(self, conn):
+        self.selector.unregister(conn.sock)
+        conn.sock.close()
+        self.waiting = [w for w in self.waiting if w[2] is not conn]
+
+    def accept(self):
+        sock, addr = self.sock.accept()
+        sock.setblocking(False)
+        self.selector.register(sock, selectors.EVENT_READ, Connection(sock))
+
+    def read(self, conn):
+        try:
+            data = conn.sock.recv(65536)
+        except ConnectionError:
+            data = b''
+        if not data:
+            self.close(conn)
+            return
+        conn.inbuf += data
+        try:
+            for message in conn.messages():
+                handler = self.handlers.get(message.get('op'))
+                if handler is None:
+                    self.send(conn, {'ok': False, 'error': "unknown op %s" % message.get('op')})
+                else:
+                    with timed(IPC_SECONDS, 'ipc ' + message['op'], op=message['op']):
+                        handler(conn, message)
+        except (ValueError, KeyError, TypeError) as e:
+            logging.warning("Invalid message from frontend: %s" % e)
+            self.close(conn)
+
+    def write(self, conn):
+        try:
+            sent = conn.sock.send(conn.outbuf)
+        except ConnectionError:
+            self.close(conn)
+            return
+        conn.outbuf = conn.outbuf[sent:]
+        if not conn.outbuf:
+            self.selector.modify(conn.sock, selectors.EVENT_READ, conn)
+
+    def answer_waiting(self):
+        """ Answer all clients whose generation is done or that waited too long """
+        now = time.time()
+        generation = self.reconciler.generation
+        still_waiting = []
+        for deadline, wanted, conn in self.waiting:
+            if generation >= wanted or now >= deadline:
+                self.send(conn, {'ok': generation >= wanted, 'generation': generation})
+            else:
+                still_waiting.append((deadline, wanted, conn))
+        self.waiting = still_waiting
+
+    def serve_forever(self):
+        while True:
+            timeout = max(0, min([w[0] for w in self.waiting]) - time.time()) if self.waiting else None
+            for key, mask in self.selector.select(timeout):
+                if key.data is None:
+                    self.accept()
+                elif key.data == 'wakeup':
+                    self._wakeup_r.recv(4096)
+                else:
+                    conn = key.data
+                    if mask & selectors.EVENT_READ:
+                        self.read(conn)
+                    if mask & selectors.EVENT_WRITE and conn.sock.fileno() != -1:
+                        self.write(conn)
+            self.answer_waiting()
@@ -0,0 +1,164 @@
+from kubernetes import client
+from placement import GPU_RESOURCE
+import os
+
+"""
+The job of a notebook container, the same for tasks ('create_job' in schedule.py) and warm pods (warmpool.py),
+which only differ in their labels, env variables and the folder mounted at /scripts.
+"""
+
+VOLUME_NAME = "hostclaim"
+
+# Where every node keeps the datasets of its tasks (see locality.py)
+LOCAL_DATA_PATH = '/mnt/localdata'
+
+
+def notebook_job(name, labels, env, request, scripts, hostname=None, datasets=None):
+    """
+    Input: name     - of the job
+           labels   - of the job and its pod
+           env      - [V1EnvVar] of the notebook container
+           request  - Resources (CPU, MEM in MiB, GPU) the pod gets, they are reserved and the maximum
+           scripts  - the folder of the volume mounted at /scripts (subPath)
+           hostname - the node to place the pod on (its label 'kubernetes.io/hostname')
+           datasets - the datasets the task reads (JSON, see locality.py), copied to the local disk of the node
+                      by an init container before the notebook starts (see jupyter/stage.py)
+    -----
+    Returns the V1Job, similarly structured like this YAML:
+    ----------
+    labels: <labels>
+    initContainers: (only with datasets)
+      - name: stage-data
+      - image: notebookserver:1.0
+      - command: python /stage.py
+      - env: DATASETS, NODE_NAME (of the pod)
+      - volumeMounts: /data (read-only), /localdata, /locality (subPath "internal/.locality")
+    containers:
+      - name: notebook-site
+      - image: notebookserver:1.0
+      - env: <env>
+          - name: LOCAL_DATA
+            value: /localdata (only with datasets)
+      - resources:
+          limits/requests:
+            cpu: <CPU>
+            memory: <MEM>Mi
+            nvidia.com/gpu: <GPU> (only if > 0)
+      - volumeMounts:
+        - mountPath: "/data"
+          subPath: "data"
+          name: vol
+          readOnly: true
+        - mountPath: "/scripts"
+          subPath: <scripts>
+          name: vol
+        - mountPath: "/dev/shm"
+          name: shm
+        - mountPath: "/localdata" (only with datasets, read-only)
+          name: local
+    volumes:
+      - name: vol
+      - persistentVolumeClaim:
+        - claimName: <VOLUME_NAME>
+      - name: shm
+      - emptyDir:
+          medium: Memory
+          sizeLimit: <MEM>Mi
+      - name: local
+      - hostPath:
+          path: /mnt/localdata
+    nodeSelector:
+      kubernetes.io/hostname: <hostname>
+    ----------
+    """
+    # The place to mount the datasets
+    data_mount = client.V1VolumeMount(
+        mount_path="/data",
+        sub_path="data",
+        name="vol",
+        read_only=True)
+    # The place to mount the scripts
+    script_mount = client.V1VolumeMount(
+        mount_path="/scripts",
+        sub_path=scripts,
+        name="vol")
+    # volume for datasets/scripts
+    volume = client.V1Volume(
+        name="vol",
+        persistent_volume_claim=client.V1PersistentVolumeClaimVolumeSource(
+            claim_name=VOLUME_NAME))
+    # Shared memory for the worker processes of scripts (e.g. DataLoader), Docker only gives 64MiB.
+    # It counts towards the memory of the pod
+    shm_mount = client.V1VolumeMount(
+        mount_path="/dev/shm",
+        name="shm")
+    shm = client.V1Volume(
+        name="shm",
+        empty_dir=client.V1EmptyDirVolumeSource(
+            medium="Memory",
+            size_limit="%dMi" % request.mem))
+    env = list(env)
+    volumes = [volume, shm]
+    mounts = [data_mount, script_mount, shm_mount]
+    init_containers = None
+    if datasets:
+        # The datasets are copied to the local disk of the node first, the notebook maps them from there
+        local = client.V1Volume(
+            name="local",
+            host_path=client.V1HostPathVolumeSource(path=LOCAL_DATA_PATH, type="DirectoryOrCreate"))
+        volumes.append(local)
+        mounts.append(client.V1VolumeMount(mount_path="/localdata", name="local", read_only=True))
+        env.append(client.V1EnvVar(name='LOCAL_DATA', value='/localdata'))
+        init_containers = [stage_container(datasets)]
+    # Resources
+    limits = {"cpu": "%g" % request.cpu, "memory": "%dMi" % request.mem}
+    if request.gpu > 0:
+        limits[GPU_RESOURCE] = str(request.gpu)
+    resources = client.V1ResourceRequirements(
+        limits=limits,
+        requests=limits
+    )
+    # Container
+    container = client.V1Container(
+        name="notebook-site",
+        image="notebookserver:1.0",
+        env=env,
+        resources=resources,
+        volume_mounts=mounts)
+    # Pod-Spec
+    template = client.V1PodTemplateSpec(
+        metadata=client.V1ObjectMeta(labels=dict(labels)),
+        spec=client.V1PodSpec(
+            restart_policy="Never",
+            volumes=volumes,
+            init_containers=init_containers,
+            containers=[container],
+            node_selector={"kubernetes.io/hostname": hostname} if hostname else None))
+    # Job-Spec
+    spec = client.V1JobSpec(
+        template=template,
+        backoff_limit=4)
+    # Job-Object
+    return client.V1Job(
+        api_version="batch/v1",
+        kind="Job",
+        metadata=client.V1ObjectMeta(name=name, labels=dict(labels)),
+        spec=spec)
+
+
+def stage_container(datasets):
+    """
+    The init container that copies the <datasets> (JSON) of a task from the shared volume to the local disk
+    of the node (see jupyter/stage.py) and reports them to the scheduler (see locality.py)
+    """
+    return client.V1Container(
+        name="stage-data",
+        image="notebookserver:1.0",
+        command=["python", "/stage.py"],
+        env=[client.V1EnvVar(name='DATASETS', value=datasets),
+             client.V1EnvVar(name='LOCAL_DATA_LIMIT', value=os.environ.get('LOCAL_DATA_LIMIT', '50')),
+             client.V1EnvVar(name='NODE_NAME', value_from=client.V1EnvVarSource(
+                 field_ref=client.V1ObjectFieldSelector(field_path='spec.nodeName')))],
+        volume_mounts=[client.V1VolumeMount(mount_path="/data", sub_path="data", name="vol", read_only=True),
+                       client.V1VolumeMount(mount_path="/localdata", name="local"),
+                       client.V1VolumeMount(mount_path="/locality", sub_path="internal/.locality", name="vol")])
@@ -0,0 +1,127 @@
+from kubernetes import client
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+from collections import Counter
+from placement import Resources
+from jobspec import notebook_job
+from schedule import create_job
+from mutations import workers, delete_jobs, WORKERS
+import threading
+import argparse
+import random
+import json
+import time
+
+"""
+Benchmark of the changes a reconcile sends to the API server, against a local fake API server.
+
+    python kubebench.py [--changes 100] [--latency 20] [--errors 0.0] [--repeat 3]
+
+<changes> pending changes: half of them tasks to start, half of them finished tasks to delete. The fake server
+answers every call after <latency> ms (the round trip to a real API server) and a fraction <errors> of them
+with 500. Compared (median of <repeat> runs):
+  old  one call after the other, as older versions did it: create the job and its NodePort service,
+       delete the job (foreground) and its service
+  new  the jobs are applied by the pool of mutations.py (server-side apply, WORKERS threads, retries)
+       and the finished ones deleted with one deletecollection per DELETE_CHUNK ids
+The reconcile reads the cluster from the cache of the informers, these calls are all of its round trips.
+"""
+
+
+class FakeApiServer(BaseHTTPRequestHandler):
+    """ Answers the calls to jobs and services like the API server, without keeping anything """
+    latency = 0.02
+    errors = 0.0
+    calls = Counter()
+    lock = threading.Lock()
+    protocol_version = 'HTTP/1.1'
+
+    def answer(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_call(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        parts = urlsplit(self.path).path.strip('/').split('/')
+        kind = parts[parts.index('namespaces') + 2]
+        with self.lock:
+            self.calls[(self.command, kind if len(parts) > parts.index('namespaces') + 3 or self.command == 'POST'
+                        else kind + ' (collection)')] += 1
+        time.sleep(self.latency)
+        if random.random() < self.errors:
+            return self.answer(500, {'kind': 'Status', 'status': 'Failure', 'code': 500})
+        if self.command == 'DELETE':
+            return self.answer(200, {'kind': 'Status', 'apiVersion': 'v1', 'status': 'Success'})
+        self.answer(201 if self.command == 'POST' else 200, json.loads(body or b'{}'))
+
+    do_POST = do_PATCH = do_DELETE = handle_call
+
+    def log_message(self, *args):
+        pass
+
+
+def old_reconcile(batch_api, core_api, start, finished):
+    for _id in start:
+        job = notebook_job("notebook-%02d" % _id, {'id': str(_id)}, [], Resources(1, 1000, 0),
+                           "internal/bench/%d" % _id)
+        batch_api.create_namespaced_job(body=job, namespace="default")
+        service = client.V1Service(api_version="v1", kind="Service",
+                                   metadata=client.V1ObjectMeta(name="nb-entrypoint-%02d" % _id,
+                                                                labels={"sid": str(_id)}),
+                                   spec=client.V1ServiceSpec(selector={"id": str(_id)}, type='NodePort',
+                                                             ports=[client.V1ServicePort(port=8888)]))
+        core_api.create_namespaced_service(namespace="default", body=service)
+    for _id in finished:
+        options = client.V1DeleteOptions(propagation_policy='Foreground', grace_period_seconds=5)
+        batch_api.delete_namespaced_job(name="notebook-%02d" % _id, namespace="default", body=options)
+        core_api.delete_namespaced_service(name="nb-entrypoint-%02d" % _id, namespace="default", body=options)
+
+
+def new_reconcile(batch_api, core_api, start, finished):
+    delete_jobs(batch_api, finished)
+    workers.map(lambda _id: create_job(batch_api, _id, 'bench', 'main.ipynb', 'pwd', Resources(1, 1000, 0)), start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--changes', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=20, help="ms per call of the fake API server")
+    parser.add_argument('--errors', type=float, default=0.0, help="fraction of calls answered with 500")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    FakeApiServer.latency = args.latency / 1000
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeApiServer)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    configuration = client.Configuration()
+    configuration.host = 'http://127.0.0.1:%d' % server.server_address[1]
+    configuration.connection_pool_maxsize = WORKERS
+    api_client = client.ApiClient(configuration)
+    batch_api, core_api = client.BatchV1Api(api_client), client.CoreV1Api(api_client)
+
+    start = list(range(1, args.changes // 2 + 1))
+    finished = list(range(args.changes // 2 + 1, args.changes + 1))
+    print("%d changes (%d to start, %d to delete), %.0f ms per call, %.0f%% errors"
+          % (args.changes, len(start), len(finished), args.latency, 100 * args.errors))
+    for name, reconcile in (('old', old_reconcile), ('new', new_reconcile)):
+        # The old version had no retries, errors are only counted for the new one
+        FakeApiServer.errors = args.errors if name == 'new' else 0.0
+        times = []
+        for _ in range(args.repeat):
+            FakeApiServer.calls.clear()
+            begin = time.perf_counter()
+            reconcile(batch_api, core_api, start, finished)
+            times.append(time.perf_counter() - begin)
+        calls = sum(FakeApiServer.calls.values())
+        print("%-4s %8.2f s  %4d calls  %s" % (name, sorted(times)[len(times) // 2], calls,
+                                              ", ".join("%s %s: %d" % (method, kind, n) for (method, kind), n
+                                                        in sorted(FakeApiServer.calls.items()))))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+import logging
+import json
+import time
+import os
+
+"""
+Which datasets every node of the cluster holds on its local disk.
+
+Before a task that reads datasets starts, the init container of its pod copies them from the shared volume
+to the local disk of its node (see jupyter/stage.py) and leaves a marker <root>/<node>/<sha256> with their size.
+It deletes the marker before it evicts a dataset. So the scheduler only has to list one folder per node
+to know where the data is, the nodes don't have to be asked.
+-----
+Datasets of tasks that were just placed count as held by their node right away (for EXPECTED seconds),
+so tasks placed after them with the same data go to the same node before the copy finished.
+"""
+
+LOCALITY_DIR = '/mnt/internal/.locality'
+# How long a dataset counts as held by a node without a marker after a task that reads it was placed there
+EXPECTED = 600
+
+
+class DataLocality:
+    def __init__(self, root=LOCALITY_DIR, expected=EXPECTED):
+        self.root = root
+        self.expected = expected
+        self._held = {}
+        # {node: {sha256: (bytes, until)}} of datasets that are being copied
+        self._expected = {}
+
+    def refresh(self):
+        """ Read the markers of all nodes """
+        held = {}
+        try:
+            nodes = os.listdir(self.root)
+        except FileNotFoundError:
+            nodes = []
+        for node in nodes:
+            held[node] = {}
+            try:
+                markers = os.listdir(os.path.join(self.root, node))
+            except NotADirectoryError:
+                continue
+            for sha256 in markers:
+                if sha256.startswith('.'):
+                    continue
+                try:
+                    with open(os.path.join(self.root, node, sha256), 'r') as f:
+                        held[node][sha256] = int(f.read() or 0)
+                except (OSError, ValueError):
+                    continue
+        self._held = held
+
+    def expect(self, node, data, now=None):
+        """ A task that reads <data> ((sha256, bytes)) was placed on <node> """
+        until = (now or time.time()) + self.expected
+        for sha256, size in data:
+            self._expected.setdefault(node, {})[sha256] = (size, until)
+
+    def held(self, now=None):
+        """ {node: {sha256: bytes}} of the datasets every node holds or is copying """
+        now = now or time.time()
+        held = {node: dict(datasets) for node, datasets in self._held.items()}
+        for node, datasets in list(self._expected.items()):
+            for sha256, (size, until) in list(datasets.items()):
+                if until < now or sha256 in held.get(node, {}):
+                    del datasets[sha256]
+                else:
+                    held.setdefault(node, {})[sha256] = size
+            if not datasets:
+                del self._expected[node]
+        return held
+
+
+def task_data(task):
+    """
+    The datasets a task reads as ((sha256, bytes), ...), from its column 'datasets'
+    (JSON [{"name", "sha256", "size", "path"}], see 'task_datasets' in flask/app.py)
+    """
+    if not task.get('datasets'):
+        return ()
+    try:
+        return tuple((d['sha256'], int(d['size'])) for d in json.loads(task['datasets']))
+    except (ValueError, TypeError, KeyError):
+        logging.warning("Task %s has invalid datasets: %s" % (task.get('id'), task['datasets']))
+        return ()
@@ -0,0 +1,174 @@
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+from concurrent.futures import ThreadPoolExecutor
+from urllib3.exceptions import HTTPError
+from instrument import timed, KUBE_SECONDS, KUBE_ERRORS
+import threading
+import logging
+import random
+import json
+import time
+import os
+
+"""
+Changes of the cluster (create and delete jobs) made by a reconcile.
+
+They are independent of each other, so they are sent at once by a pool of WORKERS threads instead of one
+round trip after the other. Every call is retried on errors of the API server (5xx, 429 'too many requests',
+connection errors) with exponential backoff, 'Retry-After' is respected. A token bucket keeps the scheduler
+below QPS calls per second (with bursts of BURST), like the rate limit of kubectl.
+-----
+Jobs are created with server-side apply: applying the same job again (e.g. when the informer didn't see it
+yet at the next reconcile) changes nothing instead of failing with 'already exists'.
+The jobs of many tasks are deleted with a single call (deletecollection with a label selector on their ids),
+in the background: the job is gone at once, Kubernetes deletes its pods afterwards.
+"""
+
+WORKERS = int(os.environ.get('SCHEDULER_API_WORKERS', 8))
+QPS = float(os.environ.get('SCHEDULER_API_QPS', 50))
+BURST = int(os.environ.get('SCHEDULER_API_BURST', 100))
+RETRIES = 4
+# Field manager of server-side apply (who owns the fields of the jobs)
+FIELD_MANAGER = 'scheduler'
+# Ids per deletecollection call (the selector 'id in (...)' is sent in the URL)
+DELETE_CHUNK = 100
+
+
+class RateLimiter:
+    """ Token bucket: <qps> calls per second on average, <burst> at once """
+    def __init__(self, qps=QPS, burst=BURST):
+        self.qps = qps
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.qps)
+            self._last = now
+            self._tokens -= 1
+            wait = -self._tokens / self.qps if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+limiter = RateLimiter()
+
+
+def retrying(call, fn, *args, **kwargs):
+    """
+    Call <fn> (the Kubernetes API call <call>) within the rate limit,
+    retry it RETRIES times on server errors, 429 and connection errors
+    """
+    for attempt in range(RETRIES + 1):
+        limiter.acquire()
+        try:
+            return fn(*args, **kwargs)
+        except ApiException as e:
+            if attempt == RETRIES or not (e.status == 429 or e.status >= 500):
+                raise
+            delay = retry_after(e) or backoff(attempt)
+            logging.info("%s failed (%s), retry in %.1fs" % (call, e.status, delay))
+        except (HTTPError, OSError) as e:
+            if attempt == RETRIES:
+                raise
+            delay = backoff(attempt)
+            logging.info("%s failed (%s), retry in %.1fs" % (call, e, delay))
+        time.sleep(delay)
+
+
+def backoff(attempt, base=0.2, cap=5.0):
+    """ Exponential backoff with full jitter """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def retry_after(e):
+    try:
+        return min(30.0, float((e.headers or {}).get('Retry-After')))
+    except (TypeError, ValueError):
+        return None
+
+
+class ApiWorkers:
+    """ A bounded pool of threads for the API calls of a reconcile """
+    def __init__(self, workers=WORKERS):
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='kube-api')
+
+    def map(self, fn, items):
+        """ Call <fn(item)> for all <items> at once, returns the results in order when all are done """
+        items = list(items)
+        if len(items) <= 1:
+            return [fn(item) for item in items]
+        return list(self._executor.map(fn, items))
+
+
+workers = ApiWorkers()
+
+
+def _call(api, name, path, method, path_params, query_params, body, content_type, response_type):
+    """ A request that this version of the client has no method for, measured like the others """
+    try:
+        with timed(KUBE_SECONDS, name, call=name):
+            return api.api_client.call_api(
+                path, method, path_params, query_params,
+                {'Accept': 'application/json', 'Content-Type': content_type},
+                body=body, response_type=response_type, auth_settings=['BearerToken'],
+                _return_http_data_only=True)
+    except ApiException as e:
+        KUBE_ERRORS.labels(call=name, status=str(e.status)).inc()
+        raise
+
+
+def apply_job(batch_api_instance, job, namespace="default"):
+    """
+    Input: job - V1Job or dict
+    -----
+    Create the job or make it match <job> (server-side apply), nothing changes if it does already.
+    API servers without server-side apply (415) get a create, a job that exists already is kept.
+    A job that exists with another pod template (which can't be changed) is an error (422): it is kept
+    as it is, the caller counts the task as not placed and the next reconcile sees the existing job
+    """
+    if not isinstance(job, dict):
+        job = batch_api_instance.api_client.sanitize_for_serialization(job)
+    name = job['metadata']['name']
+    try:
+        # JSON is YAML, the client only sends bodies of other content types as string
+        return retrying('apply_namespaced_job', _call, batch_api_instance, 'apply_namespaced_job',
+                        '/apis/batch/v1/namespaces/{namespace}/jobs/{name}', 'PATCH',
+                        {'namespace': namespace, 'name': name}, [('fieldManager', FIELD_MANAGER), ('force', 'true')],
+                        json.dumps(job), 'application/apply-patch+yaml', 'V1Job')
+    except ApiException as e:
+        if e.status != 415:
+            raise
+    try:
+        return retrying('create_namespaced_job', batch_api_instance.create_namespaced_job, body=job,
+                        namespace=namespace)
+    except ApiException as e:
+        if e.status != 409:
+            raise
+        logging.info("Job %s exists already" % name)
+
+
+def delete_jobs(batch_api_instance, ids, namespace="default"):
+    """
+    Delete the jobs (and in the background their pods) of the tasks <ids>,
+    with one call per DELETE_CHUNK ids. Returns False if a call failed
+    """
+    ids = sorted(ids)
+    ok = True
+    for i in range(0, len(ids), DELETE_CHUNK):
+        selector = "id in (%s)" % ",".join(str(_id) for _id in ids[i:i + DELETE_CHUNK])
+        try:
+            retrying('deletecollection_namespaced_job', _call, batch_api_instance, 'deletecollection_namespaced_job',
+                     '/apis/batch/v1/namespaces/{namespace}/jobs', 'DELETE', {'namespace': namespace},
+                     [('labelSelector', selector)],
+                     client.V1DeleteOptions(propagation_policy='Background', grace_period_seconds=5),
+                     'application/json', 'V1Status')
+            logging.info("Jobs deleted: %s" % selector)
+        except ApiException as e:
+            logging.warning("Exception when deleting the jobs %s: %s\n" % (selector, e))
+            ok = False
+    return ok
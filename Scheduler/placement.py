@@ -0,0 +1,156 @@
+from collections import namedtuple
+
+"""
+Placement of tasks on the nodes of the cluster.
+
+Every task requests CPU, memory and GPUs. They are packed onto the nodes with a best-fit policy:
+a task goes to the node where it leaves the least resources unused.
+If the first task of the queue doesn't fit anywhere it gets a reservation on the node where it can
+start the earliest (when the running tasks end as expected). Tasks behind it are started
+ahead of it (backfill) only if they don't delay that reservation.
+Tasks that read datasets go to the node that already holds most of them (see locality.py),
+among those with the same amount of data to copy the best fit wins.
+"""
+
+GPU_RESOURCE = 'nvidia.com/gpu'
+
+_CPU_UNITS = {'m': 0.001}
+_MEM_UNITS = {'Ki': 2 ** 10, 'Mi': 2 ** 20, 'Gi': 2 ** 30, 'Ti': 2 ** 40,
+              'k': 10 ** 3, 'K': 10 ** 3, 'M': 10 ** 6, 'G': 10 ** 9, 'T': 10 ** 12}
+
+
+def parse_cpu(quantity):
+    """ Kubernetes CPU quantity ('1.5', '500m') in cores """
+    quantity = str(quantity)
+    for suffix, factor in _CPU_UNITS.items():
+        if quantity.endswith(suffix):
+            return float(quantity[:-len(suffix)]) * factor
+    return float(quantity)
+
+
+def parse_mem(quantity):
+    """ Kubernetes memory quantity ('5000Mi', '16Gi', '1e9') in MiB """
+    quantity = str(quantity)
+    for suffix in sorted(_MEM_UNITS, key=len, reverse=True):
+        if quantity.endswith(suffix):
+            return float(quantity[:-len(suffix)]) * _MEM_UNITS[suffix] / 2 ** 20
+    return float(quantity) / 2 ** 20
+
+
+class Resources(namedtuple('Resources', ['cpu', 'mem', 'gpu'])):
+    """ cpu in cores, mem in MiB, gpu as a count """
+    def __add__(self, other):
+        return Resources(self.cpu + other.cpu, self.mem + other.mem, self.gpu + other.gpu)
+
+    def __sub__(self, other):
+        return Resources(self.cpu - other.cpu, self.mem - other.mem, self.gpu - other.gpu)
+
+    def fits(self, request):
+        # Small tolerance for float rounding
+        return self.cpu >= request.cpu - 1e-9 and self.mem >= request.mem - 1e-9 and self.gpu >= request.gpu
+
+    def share(self, capacity):
+        """ Average fraction of <capacity> that these resources make up (over all resources the node has) """
+        shares = [a / c for a, c in zip(self, capacity) if c > 0]
+        return sum(shares) / len(shares) if shares else 0
+
+
+ZERO = Resources(0, 0, 0)
+
+# A task that waits to be placed (<data>: (sha256, bytes) of the datasets it reads)
+# and one that is already running on <node> since <start> until <end> (expected)
+Pending = namedtuple('Pending', ['id', 'request', 'runtime', 'data'], defaults=[()])
+Running = namedtuple('Running', ['id', 'node', 'request', 'end', 'start'])
+
+
+def node_capacity(node):
+    """ Allocatable resources of a node (V1Node), None if no tasks can be placed on it """
+    if node.spec.unschedulable:
+        return None
+    ready = [c for c in (node.status.conditions or []) if c.type == 'Ready']
+    if ready and ready[0].status != 'True':
+        return None
+    allocatable = node.status.allocatable or {}
+    return Resources(parse_cpu(allocatable.get('cpu', 0)),
+                     parse_mem(allocatable.get('memory', 0)),
+                     int(allocatable.get(GPU_RESOURCE, 0)))
+
+
+def missing_bytes(data, held):
+    """ Bytes of the datasets <data> ((sha256, bytes)) that are not in <held> ({sha256: bytes} of a node) """
+    return sum(size for sha256, size in data if sha256 not in held)
+
+
+def best_fit(request, free, capacity, data=(), local=None):
+    """
+    The node where <request> fits and leaves the smallest share of the node unused, None if it fits nowhere.
+    With <data> and <local> ({node: {sha256: bytes}}) the nodes that have to copy the least data come first
+    """
+    candidates = [(missing_bytes(data, local.get(n, {})) if data and local else 0,
+                   (f - request).share(capacity[n]), n) for n, f in free.items() if f.fits(request)]
+    return min(candidates)[2] if candidates else None
+
+
+def reserve(task, free, running, now):
+    """
+    Input: task - the blocked Pending task
+           free - {node: resources free now}
+           running - all Running tasks
+    -----
+    Find the earliest time the task can start, when the running tasks end as expected.
+    Returns (start, node, left), where left are the resources that are free on the node
+    at that time additionally to those of the task, or None if the task can never fit.
+    """
+    best = None
+    for node, available in free.items():
+        ends = sorted((r.end, r.request) for r in running if r.node == node)
+        for end, request in [(now, ZERO)] + ends:
+            available = available + request
+            start = max(now, end)
+            if available.fits(task.request):
+                if best is None or start < best[0]:
+                    best = (start, node, available - task.request)
+                break
+    return best
+
+
+def schedule(queue, capacity, running, now, backfill=True, local=None):
+    """
+    Input: queue - Pending tasks in the order they should be started
+           capacity - {node: allocatable resources}
+           running - Running tasks
+           now - current time, in the same unit as the runtimes and ends
+           backfill - whether tasks may overtake a blocked task
+           local - {node: {sha256: bytes}} datasets each node holds (None: placement ignores the data)
+    -----
+    Returns [(task, node)] for all tasks that should be started now
+    """
+    free = dict(capacity)
+    for r in running:
+        if r.node in free:
+            free[r.node] = free[r.node] - r.request
+    running = list(running)
+
+    placed = []
+    reservation = None
+    for task in queue:
+        node = best_fit(task.request, free, capacity, task.data, local)
+        if reservation is not None and node is not None:
+            start, res_node, left = reservation
+            if node == res_node and now + task.runtime > start:
+                # It would still run when the reserved task should start, only allowed with the leftovers
+                if not left.fits(task.request):
+                    others = {n: f for n, f in free.items() if n != res_node}
+                    node = best_fit(task.request, others, capacity, task.data, local)
+                else:
+                    reservation = (start, res_node, left - task.request)
+        if node is not None:
+            placed.append((task, node))
+            free[node] = free[node] - task.request
+            running.append(Running(task.id, node, task.request, now + task.runtime, now))
+        elif reservation is None:
+            # The first blocked task gets its reservation, only backfill is allowed behind it
+            reservation = reserve(task, free, running, now)
+            if not backfill:
+                break
+    return placed
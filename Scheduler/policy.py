@@ -0,0 +1,138 @@
+from collections import namedtuple
+
+"""
+Queue policies decide in which order waiting tasks are started.
+
+Every policy has the method order(queue, now) that returns the Queued tasks in the order they should start
+and sync(running, now) that is called with all running tasks, so it can keep track of the usage of every owner.
+"""
+
+# A waiting task. share is the fraction of the cluster it requests, estimate its expected runtime in seconds
+Queued = namedtuple('Queued', ['id', 'owner', 'share', 'estimate', 'priority', 'submit'])
+
+
+class UsageTracker:
+    """
+    Historical usage per owner (share of the cluster * seconds), decayed with a half-life.
+    Running tasks count with the time they have been running so far.
+    """
+    def __init__(self, half_life=24 * 3600):
+        self.half_life = half_life
+        self.finished = {}
+        self.running = {}
+
+    def _decay(self, value, since, now):
+        return value * 2 ** (-(now - since) / self.half_life)
+
+    def charge(self, owner, amount, now):
+        value, since = self.finished.get(owner, (0, now))
+        self.finished[owner] = (self._decay(value, since, now) + amount, now)
+
+    def sync(self, running, now):
+        """
+        Input: running - {id: (owner, share, start)} of all running tasks
+        -----
+        Tasks that aren't running anymore are charged with their whole runtime
+        """
+        for _id, (owner, share, start) in self.running.items():
+            if _id not in running:
+                self.charge(owner, share * max(0, now - start), now)
+        self.running = dict(running)
+
+    def usage(self, owner, now):
+        value, since = self.finished.get(owner, (0, now))
+        current = sum(share * max(0, now - start) for o, share, start in self.running.values() if o == owner)
+        return self._decay(value, since, now) + current
+
+
+class FifoPolicy:
+    """ Start tasks in the order they were submitted """
+    def __init__(self):
+        self.tracker = UsageTracker()
+
+    def sync(self, running, now):
+        self.tracker.sync(running, now)
+
+    def order(self, queue, now):
+        return sorted(queue, key=lambda t: t.id)
+
+
+class FairSharePolicy:
+    """
+    Weighted fair share between owners with priorities and aging.
+    -----
+    Every task gets a score from four factors (each between 0 and 1):
+      fair share - 2^(-usage share / weight share) of its owner, 1 if the owner used nothing recently
+      priority   - the priority given by the user (0 - <max_priority>)
+      age        - time since submission, reaches 1 after <max_age> seconds (no task starves)
+      duration   - short tasks (by their estimate) get a small boost
+    Owners without an entry in <weights> have the weight 1.
+    The queue is ordered greedily: after a task is picked, its expected usage is charged to its owner,
+    so a user with many tasks in the queue doesn't get all first places.
+    """
+    def __init__(self, weights=None, half_life=24 * 3600, max_age=24 * 3600, max_priority=10,
+                 w_fairshare=1.0, w_priority=0.5, w_age=0.5, w_duration=0.1):
+        self.weights = weights or {}
+        self.max_age = max_age
+        self.max_priority = max_priority
+        self.factors = (w_fairshare, w_priority, w_age, w_duration)
+        self.tracker = UsageTracker(half_life)
+
+    def sync(self, running, now):
+        self.tracker.sync(running, now)
+
+    def task_score(self, task, now):
+        """ Everything but the fair share factor """
+        _, w_priority, w_age, w_duration = self.factors
+        priority = min(max(task.priority or 0, 0), self.max_priority) / self.max_priority
+        age = min(1, max(0, now - task.submit) / self.max_age) if task.submit else 0
+        duration = 1 / (1 + task.estimate / 3600)
+        return w_priority * priority + w_age * age + w_duration * duration
+
+    def order(self, queue, now):
+        owners = {t.owner for t in queue}
+        usage = {o: self.tracker.usage(o, now) for o in owners | {o for o, _, _ in self.tracker.running.values()}}
+        weight = {o: self.weights.get(o, 1) for o in usage}
+        total_weight = sum(weight.values())
+
+        # The best task of every owner first
+        by_owner = {o: [] for o in owners}
+        for task in queue:
+            by_owner[task.owner].append((-self.task_score(task, now), task.id, task))
+        for tasks in by_owner.values():
+            tasks.sort(key=lambda t: t[:2])
+
+        ordered = []
+        while by_owner:
+            total_usage = sum(usage.values())
+            best = None
+            for owner, tasks in by_owner.items():
+                usage_share = usage[owner] / total_usage if total_usage > 0 else 0
+                fairshare = 2 ** (-usage_share / (weight[owner] / total_weight))
+                score = self.factors[0] * fairshare - tasks[0][0]
+                if best is None or (score, -tasks[0][1]) > best[0]:
+                    best = ((score, -tasks[0][1]), owner)
+            owner = best[1]
+            task = by_owner[owner].pop(0)[2]
+            if not by_owner[owner]:
+                del by_owner[owner]
+            ordered.append(task)
+            usage[owner] += task.share * task.estimate
+        return ordered
+
+
+def make_policy(settings):
+    """
+    The policy from the settings:
+      policy    - 'fifo' or 'fairshare'
+      shares    - weights of the owners, e.g. 'alice:2,bob:1'
+      half_life - half-life of the usage in hours
+    """
+    if settings.get('policy', 'fairshare') == 'fifo':
+        return FifoPolicy()
+    weights = {}
+    for entry in settings.get('shares', '').split(','):
+        if ':' in entry:
+            owner, weight = entry.split(':', 1)
+            weights[owner.strip()] = float(weight)
+    return FairSharePolicy(weights, half_life=float(settings.get('half_life', 24)) * 3600)
@@ -0,0 +1,102 @@
+from instrument import timed, RECONCILE_SECONDS, EVENT_LAG_SECONDS
+import threading
+import logging
+import time
+
+
+class Reconciler(threading.Thread):
+    """
+    Runs <reconcile()> whenever something changed.
+    -----
+    Changes are reported with 'notify' (by the informers or the frontend).
+    All changes that arrive while a reconcile is running are coalesced into the next one,
+    so a burst of events only leads to a single reconcile.
+    If nothing happens for <resync> seconds a reconcile is done anyway as a safety net.
+    It works on the local caches only and does not re-list the cluster.
+
+    Every finished reconcile increases 'generation', so callers can wait until
+    the changes they reported have been handled (see 'wait_for').
+    Functions in 'on_done' are called with the new generation after every reconcile.
+    -----
+    For every reconcile the event lag (time from the oldest pending event until
+    the reconcile starts) and the reconcile time are measured, logged and exported (see instrument.py).
+    """
+    def __init__(self, reconcile, resync=300):
+        super().__init__(name="reconciler", daemon=True)
+        self.reconcile = reconcile
+        self.resync = resync
+        self.generation = 0
+        self.stats = ReconcileStats()
+        self.on_done = []
+        self._cond = threading.Condition()
+        self._pending = []
+        self._running = False
+
+    def notify(self, reason, received=None):
+        """
+        Report a change, returns the generation that will include it
+        """
+        with self._cond:
+            self._pending.append((reason, received or time.time()))
+            self._cond.notify_all()
+            # A reconcile that is already running doesn't see this change
+            return self.generation + (2 if self._running else 1)
+
+    def wait_for(self, generation, timeout=None):
+        """
+        Block until the reconcile <generation> is done, returns False on timeout
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self.generation >= generation, timeout)
+
+    def run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._pending) > 0, self.resync)
+                pending, self._pending = self._pending, []
+                self._running = True
+
+            start = time.time()
+            lag = start - min([received for _, received in pending], default=start)
+            EVENT_LAG_SECONDS.observe(lag)
+            with timed(RECONCILE_SECONDS, 'reconcile') as t:
+                try:
+                    self.reconcile()
+                except Exception:
+                    logging.exception("Reconcile failed")
+            duration = t.duration
+
+            with self._cond:
+                self.generation += 1
+                self._running = False
+                self._cond.notify_all()
+            for callback in self.on_done:
+                callback(self.generation)
+            self.stats.add(lag, duration)
+            logging.info("Reconcile %d: %d events (%s), event lag %.3fs, took %.3fs" %
+                         (self.generation, len(pending), ", ".join(sorted({r for r, _ in pending})) or "resync",
+                          lag, duration))
+
+
+class ReconcileStats:
+    """
+    Count, mean and max of event lag and reconcile time
+    """
+    def __init__(self):
+        self.count = 0
+        self.lag_total = self.lag_max = 0.0
+        self.time_total = self.time_max = 0.0
+
+    def add(self, lag, duration):
+        self.count += 1
+        self.lag_total += lag
+        self.lag_max = max(self.lag_max, lag)
+        self.time_total += duration
+        self.time_max = max(self.time_max, duration)
+
+    def __repr__(self):
+        if self.count == 0:
+            return "no reconciles"
+        return "%d reconciles | event lag mean %.3fs max %.3fs | reconcile time mean %.3fs max %.3fs" % \
+               (self.count, self.lag_total / self.count, self.lag_max,
+                self.time_total / self.count, self.time_max)
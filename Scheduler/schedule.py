@@ -1,373 +1,484 @@
 from kubernetes import client, config
-from kubernetes.stream import stream
 from kubernetes.client.rest import ApiException
-import socket
-import sqlalchemy as db
+from informer import ClusterCache
+from reconcile import Reconciler
+from status import StatusWatcher
+from store import TaskStore, STAMPS
+from ipc import IpcServer
+from placement import Resources, Pending, Running, ZERO, GPU_RESOURCE, parse_cpu, parse_mem, node_capacity, schedule
+from policy import Queued, make_policy
+from estimate import RuntimeEstimator, QueueForecast, forecast
+from warmpool import WarmPool
+from jobspec import notebook_job
+from telemetry import TelemetryCollector
+from locality import DataLocality, task_data
+from mutations import workers, apply_job, delete_jobs, retrying, WORKERS
+from instrument import InstrumentedApi, serve_metrics, timed, STEP_SECONDS
+import time
+import os
 import logging
 
+# Quantile of the predicted runtimes used to place tasks (backfill must not delay a reservation)
+# and for the expected start and end shown to the users
+PLACEMENT_QUANTILE = 0.8
+ETA_QUANTILE = 0.5
 
-def create_job(batch_api_instance, core_api_instance, id, USER, PY_FILE, PWD, settings):
+# Indexes of an array task that run at once if it doesn't say and how often a single index is retried
+ARRAY_PARALLELISM = 4
+ARRAY_RETRIES = 2
+
+
+def create_job(batch_api_instance, id, USER, PY_FILE, PWD, request, hostname=None, array=None, headless=False,
+               datasets=None):
     """
-    Input: Needs an instance of the BatchV1Api and the CoreV1Api
+    Input: Needs an instance of the BatchV1Api
            id           - id of task
            USER         - User/Owner of the task (so the executable files can be reached)
            PY_FILE, PWD - the ENV variables to be set for Jupyter to work as intended
-           settings = (CPU_SHARE, MEM_SHARE, _) - how much CPU and RAM to use at most
+           request      - Resources (CPU, MEM in MiB, GPU) every pod of the task gets, they are reserved and the maximum
+           hostname     - the node to place the task on (its label 'kubernetes.io/hostname')
+           array        - (completions, parallelism) of an array task, see 'array_job'
+           headless     - run the notebook or script without Jupyter and stop (batch mode, see jupyter/entrypoint.sh)
+           datasets     - the datasets the task reads (JSON, see locality.py), copied to the local disk of the node
+                          by an init container before the notebook starts (see jupyter/stage.py)
     -----
-    Create a Job from a Notebook-Container and add it to the cluster.
-    The job is similarly structured like this YAML:
+    Create a Job from a Notebook-Container and add it to the cluster (server-side apply, so doing it
+    again for the same task changes nothing, see mutations.py). Returns False if the job couldn't be applied.
+    The job is built by 'jobspec.notebook_job' (like the warm pods), with the label id:<id>,
+    the folder "internal/<USER>/<id>" at /scripts and the env variables:
     ----------
-    labels: id:<id>
-    containers:
-      - name: notebook-site
-      - image: notebookserver:1.0
-      - env:
-          - name: PY_FILE
-            value: <PY_FILE>
-          - name: JUPYTER_PWD
-            value: <PWD>
-      - resources:
-          limits:
-            cpu: <CPU_SHARE>
-            memory: <MEM_SHARE>
-      - volumeMounts:
-        - mountPath: "/data"
-          subPath: "data"
-          name: vol
-        - mountPath: "/scripts"
-          subPath: "internal/<USER>/<id>"
-          name: vol
-    volumes:
-      - name: vol
-      - persistentVolumeClaim:
-        - claimName: <VOLUME_NAME>
+      - name: PY_FILE
+        value: <PY_FILE>
+      - name: JUPYTER_PWD
+        value: <PWD>
+      - name: ID
+        value: <id>
+      - name: HEADLESS
+        value: 1 (only if headless)
     ----------
     """
     JOB_NAME = "notebook-%02d" % id
-    VOLUME_NAME = "hostclaim"
-    CPU_SHARE, MEM_SHARE, _ = settings
-
-    # The place to mount the datasets
-    data_mount = client.V1VolumeMount(
-        mount_path="/data",
-        sub_path="data",
-        name="vol")
-    # The place to mount the scripts
-    script_mount = client.V1VolumeMount(
-        mount_path="/scripts",
-        sub_path="internal/%s/%d" % (USER, id),
-        name="vol")
-    # volume for datasets/scripts
-    volume = client.V1Volume(
-        name="vol",
-        persistent_volume_claim=client.V1PersistentVolumeClaimVolumeSource(
-            claim_name=VOLUME_NAME))
+
     # env-Variables
     file_env = client.V1EnvVar(name='PY_FILE', value=PY_FILE)
     pwd_env = client.V1EnvVar(name='JUPYTER_PWD', value=PWD)
-    # Resources
-    resources = client.V1ResourceRequirements(
-        limits={"cpu": CPU_SHARE, "memory": MEM_SHARE},
-        requests={"cpu": "0", "memory": "0"}
-    )
-    # Container
-    container = client.V1Container(
-        name="notebook-site",
-        image="notebookserver:1.0",
-        env=[file_env, pwd_env],
-        resources=resources,
-        volume_mounts=[data_mount, script_mount])
-    # Pod-Spec
-    template = client.V1PodTemplateSpec(
-        metadata=client.V1ObjectMeta(labels={"id": str(id)}),
-        spec=client.V1PodSpec(
-            restart_policy="Never",
-            volumes=[volume],
-            containers=[container]))
-    # Job-Spec
-    spec = client.V1JobSpec(
-        template=template,
-        backoff_limit=4)
-    # Job-Object
-    job = client.V1Job(
-        api_version="batch/v1",
-        kind="Job",
-        metadata=client.V1ObjectMeta(name=JOB_NAME),
-        spec=spec)
+    # Jupyter is reached through the proxy of the website at /nb/<id>/ (see proxy/nginx.conf)
+    id_env = client.V1EnvVar(name='ID', value=str(id))
+    env = [file_env, pwd_env, id_env] + ([client.V1EnvVar(name='HEADLESS', value='1')] if headless else [])
+    job = notebook_job(JOB_NAME, {"id": str(id)}, env, request, "internal/%s/%d" % (USER, id),
+                       hostname=hostname, datasets=datasets)
+
+    if array is not None:
+        job = array_job(batch_api_instance.api_client.sanitize_for_serialization(job), *array)
 
     # Add Job to Cluster
     try:
-        api_response = batch_api_instance.create_namespaced_job(
-            body=job, namespace="default")
-        logging.info("Job created. status='%s'" % str(api_response.status))
+        apply_job(batch_api_instance, job)
+        logging.info("Job %s created" % JOB_NAME)
+        return True
     except ApiException as e:
-        logging.warning("Exception when calling CoreV1Api->create_namespaced_job: %s\n" % e)
-
-    # Create the service so the notebook becomes accessible
-    create_service(core_api_instance, id)
+        logging.warning("Exception when applying the job %s: %s\n" % (JOB_NAME, e))
+        return False
 
 
-def create_service(api_instance, id):
+def array_job(job, completions, parallelism):
     """
-    Input: Needs an instance of the CoreV1Api
-    -----
-    Create a Service for the Notebook-Job.
-    The service is similarly structured like this YAML:
-    -----
-    apiVersion: v1
-    kind: Service
-    metadata:
-      name: <SERVICE_NAME>
-      namespace: default
-    spec:
-      type: NodePort
-      selector:
-        id: <id>
-      ports:
-      - port: 8888
-        targetPort: 8888
-        nodePort: <NODE_PORT>
+    Input: job - the job of 'create_job' as dict
     -----
+    Turn the job into an Indexed Job: <completions> pods with the env JOB_COMPLETION_INDEX = 0 ... completions - 1,
+    at most <parallelism> at once. Every index runs the notebook with its index as parameter and stops
+    (see jupyter/array_index.py). A failed index is retried ARRAY_RETRIES times on its own (backoffLimitPerIndex,
+    on clusters without it the retries of all indexes count together).
+    The fields are newer than this client, so the job is sent as dict
     """
-    SERVICE_NAME = "nb-entrypoint-%02d" % id
-    NODE_PORT = 31000 + id
-
-    # Port
-    port = client.V1ServicePort(
-        port=8888,
-        target_port=8888,
-        node_port=NODE_PORT)
-    # Job-Spec
-    spec = client.V1ServiceSpec(
-        selector={"id": str(id)},
-        type='NodePort',
-        ports=[port])
-    # Service-Objekt
-    service = client.V1Service(
-        api_version="v1",
-        kind="Service",
-        metadata=client.V1ObjectMeta(
-            name=SERVICE_NAME,
-            labels={"sid": str(id)}),
-        spec=spec)
-
-    # Add Service to Cluster
-    try:
-        api_response = api_instance.create_namespaced_service(
-            namespace='default', body=service)
-        logging.info("Service created. status='%s'" % str(api_response.status))
-    except ApiException as e:
-        logging.warning("Exception when calling CoreV1Api->create_namespaced_service: %s\n" % e)
+    # Jobs without labels get those of their pods, so these have to be given as well
+    job['metadata']['labels'] = dict(job['spec']['template']['metadata']['labels'], array=str(completions))
+    job['spec'].update({'completionMode': 'Indexed', 'completions': completions, 'parallelism': parallelism,
+                        'backoffLimitPerIndex': ARRAY_RETRIES, 'backoffLimit': ARRAY_RETRIES * completions})
+    job['spec']['template']['spec']['containers'][0]['env'].append({'name': 'ARRAY_SIZE', 'value': str(completions)})
+    return job
 
 
-def update(batch_api_instance, core_api_instance, settings, check_services=False):
+def update(batch_api_instance, core_api_instance, cache, store, statuses, policy, estimator, etas, pool, telemetry,
+           locality, settings, check_services=False):
     """
     Input: Needs an instance of the BatchV1Api and the CoreV1Api
-           settings = (_, _, parallel) - how many tasks to run at once
+           cache - the ClusterCache with all notebook jobs, pods and services
+           store - the TaskStore with all active tasks of the db
+           statuses - the StatusWatcher for the status files of the notebooks
+           policy - the queue policy (see policy.py)
+           estimator - the RuntimeEstimator that learns from finished tasks
+           etas - the QueueForecast for the expected start and end of queued tasks
+           pool - the WarmPool of idle notebook pods
+           telemetry - the TelemetryCollector with the resource usage of the notebooks
+           locality - the DataLocality, which datasets the nodes hold
+           settings - see 'load_settings'
     -----
-    check for changes in db and create job+service for new entries
-    also delete job+service for deleted entries
-    if checkServices is True check if existing jobs have their service
+    check for changes in db and create jobs for new entries
+    also delete the jobs of deleted and finished entries
+    if check_services is True delete the services of older versions
+    -----
+    The state of the cluster is taken from the cache, so no list calls are made
+    and only the rows of the db that changed since the last update are read.
+    All jobs to delete are deleted with one call, the new ones are created at once (see mutations.py).
+    The steps are measured in 'scheduler_update_step_seconds' (see instrument.py)
     """
-    # Connect to DB
-    engine = db.create_engine('sqlite:////mnt/internal/queue.db', convert_unicode=True)
-    connection = engine.connect()
-    metadata = db.MetaData()
-    tasks = db.Table('tasks', metadata, autoload=True, autoload_with=engine)
-
-    # Get all existing ids (and other data)
-    query = db.select([tasks])
-    result_proxy = connection.execute(query)
-    result_set = result_proxy.fetchall()
-    ids_db = {x[0] for x in result_set}
-    py_files = {x[0]: x[4] for x in result_set}
-    pwds = {x[0]: x[6] for x in result_set}
-    users = {x[0]: x[1] for x in result_set}
-    logging.info(result_set)
-
-    delete_completed_jobs(batch_api_instance, core_api_instance, connection, tasks)
-
-    # Get all running job ids
-    try:
-        jobs = batch_api_instance.list_job_for_all_namespaces()
-    # logging.info(pprint.pformat(api_response))
-    except ApiException as e:
-        print("Exception when calling BatchV1Api->list_job_for_all_namespaces: %s\n" % e)
-        return
-    ids_kube = {int(job.metadata.labels['id']) for job in jobs.items if job.metadata.name.startswith('notebook-')}
-    ids_to_add = sorted(list(ids_db - ids_kube))
-    ids_to_delete = list(ids_kube - ids_db)
+    # Get all active ids (and other data)
+    store.refresh()
+    estimator.learn(store.changed_rows.values())
+    tasks = store.active
+    ids_db = set(tasks.keys())
+
+    # Jobs that are already being deleted are ignored
+    jobs = [job for job in cache.jobs() if job.metadata.deletion_timestamp is None]
+    finished = completed_jobs(jobs)
+    ids_db -= finished
+    pool.observe(store.changed_rows.values(), jobs)
+
+    # Get all running job ids (jobs from the warm pool have other names)
+    job_names = {int(job.metadata.labels['id']): job.metadata.name for job in jobs
+                 if job.metadata.name.startswith('notebook-')}
+    ids_kube = set(job_names)
+    ids_to_add = sorted(list(ids_db - ids_kube - pool.binding(ids_kube, time.time())))
+    ids_to_delete = list(ids_kube - ids_db - finished)
     logging.info("ids found: %s | ids needed: %s | queued ids: %s | deleting ids: %s" %
                  (ids_kube, ids_db, list(ids_to_add), list(ids_to_delete)))
 
-    # Delete old notebooks
-    for _id in ids_to_delete:
-        delete_job(batch_api_instance, core_api_instance, _id)
-
-    # There can be <parallel> task at once
-    parallel = settings[2]
-    new_jobs = parallel - update_status(core_api_instance, connection, tasks)
-
-    # Create new notebooks until there are running <parallel> many
-    while new_jobs > 0 and len(ids_to_add) > 0:
-        _id = ids_to_add.pop(0)
-        create_job(batch_api_instance, core_api_instance, _id, users[_id], py_files[_id], pwds[_id], settings)
-        new_jobs -= 1
+    # Delete finished and old notebooks
+    if finished or ids_to_delete:
+        with timed(STEP_SECONDS, 'update delete', step='delete'):
+            delete_jobs(batch_api_instance, finished | set(ids_to_delete))
+
+    # Only notebooks with a job can report a status and their resource usage
+    with timed(STEP_SECONDS, 'update status', step='status'):
+        statuses.watch({_id: tasks[_id]['owner'] for _id in ids_kube & ids_db})
+        telemetry.watch({_id: tasks[_id]['owner'] for _id in ids_kube & ids_db})
+        changes = update_status(tasks, statuses)
+    # When a task started and finished (as reported by the notebook), to learn its runtime
+    stamps = {_id: {STAMPS[status]: statuses.status(_id)[1]} for _id, status in changes.items() if status in STAMPS}
+    # Finished tasks are kept in the db as history (array tasks never report 'Finished', they end with their job),
+    # failed ones keep their status
+    changes.update({_id: 'Done' for _id in finished
+                    if _id in tasks and changes.get(_id, tasks[_id]['status']) != 'Failed'})
+    for _id in finished:
+        if _id in tasks and is_array(tasks[_id]):
+            stamps.setdefault(_id, {})['finished'] = time.time()
+    # The peak usage of finished tasks, to suggest the resources of the next ones
+    for _id, status in changes.items():
+        if status in ('Finished', 'Failed', 'Done'):
+            stamps.setdefault(_id, {}).update(telemetry.peaks(_id))
+    store.set_status(changes, stamps)
+
+    # Place as many queued tasks as fit on the nodes (but at most <parallel> jobs at once)
+    # in the order of the queue policy
+    now = time.time()
+    with timed(STEP_SECONDS, 'update queue', step='queue'):
+        capacity, hostnames = node_resources(cache)
+        locality.refresh()
+        total = sum(capacity.values(), ZERO)
+        active_jobs = [job for job in jobs if int(job.metadata.labels['id']) in ids_db]
+        running = running_tasks(cache, active_jobs, tasks, estimator, settings)
+        policy.sync({r.id: (tasks[r.id]['owner'], r.request.share(total), r.start) for r in running}, now)
+        queue = order_queue(policy, tasks, ids_to_add, total, estimator, settings, now)
+
+    # Tasks that fit into an idle warm pod start there right away, the others get a new job.
+    # Tasks with datasets need a new job, its init container copies them to the node
+    limit = max(0, settings['parallel'] - len(running)) if settings['parallel'] > 0 else None
+    warm = pool.assign(batch_api_instance, core_api_instance, cache,
+                       [task for task in queue if has_notebook_server(tasks[task.id]) and not task.data],
+                       tasks, now, limit)
+    running += [Running(task.id, node, pool.request, now + task.runtime, now) for task, node in warm]
+    queue = [task for task in queue if task.id not in {t.id for t, _ in warm}]
+    with timed(STEP_SECONDS, 'update place', step='place'):
+        placed = place_tasks(queue, capacity, hostnames, running, settings, pool.reserved(cache, now),
+                             locality.held(now))
+
+    def start(placement):
+        """ Whether the job of the placed task was created, errors of one task don't stop the others """
+        task, hostname = placement
+        info = tasks[task.id]
+        array = (info['array_size'], array_parallelism(info)) if is_array(info) else None
+        try:
+            return create_job(batch_api_instance, task.id, info['owner'], info['program'], info['pwd'],
+                              pod_request(task.request, array), hostname, array, bool(info.get('headless')),
+                              info.get('datasets') if task.data else None)
+        except Exception as e:
+            logging.warning("Exception when starting the task %d on %s: %s\n" % (task.id, hostname, e))
+            return False
+    with timed(STEP_SECONDS, 'update create', step='create'):
+        started = workers.map(start, placed)
+    # A task whose job wasn't created stays in the queue, its resources are free for the others
+    placed = [placement for placement, ok in zip(placed, started) if ok]
+    nodes = {hostname: node for node, hostname in hostnames.items()}
+    for task, hostname in placed:
+        locality.expect(nodes[hostname], task.data, now)
+    running += [Running(task.id, nodes[hostname], task.request, now + task.runtime, now) for task, hostname in placed]
+
+    # Refill the warm pool with capacity nothing waits for (or free it for waiting tasks that fit on a node)
+    waiting = [task for task in queue if task.id not in {t.id for t, _ in placed}]
+    pool.maintain(batch_api_instance, cache, [t for t in waiting if any(c.fits(t.request) for c in capacity.values())],
+                  capacity, hostnames, running + pool.reserved(cache, now), now)
+    pool.cleanup(set(job_names.values()) | {p.metadata.labels.get('job-name') for p in cache.warm_pods()})
+
+    # Expected start and end of the tasks that are still queued
+    with timed(STEP_SECONDS, 'update eta', step='eta') as t:
+        etas.set(predict_etas(queue, running, capacity, tasks, estimator, settings, now))
+    logging.info("ETAs of %d queued tasks took %.1fms" % (len(waiting), 1000 * t.duration))
 
     if check_services:
-        update_services(core_api_instance, ids_db)
+        delete_services(core_api_instance, cache.services())
 
 
-def update_status(core_api_instance, connection, tasks):
+def task_request(task, settings):
     """
-    Checks for updates in the status of notebooks and changes db accordingly
-    returns how many jobs can be started
+    Resources requested by a task, the settings are used if the task didn't specify them.
+    An array task needs them for all indexes that run at once
     """
-    stream_api_instance = client.CoreV1Api()
+    request = Resources(task['cpu'] or parse_cpu(settings['cpu']),
+                        task['mem'] or parse_mem(settings['mem']),
+                        task['gpu'] if task['gpu'] is not None else settings['gpu'])
+    return scaled(request, array_parallelism(task)) if is_array(task) else request
 
-    # Get all existing statuses
-    query = db.select([tasks])
-    result_proxy = connection.execute(query)
-    result_set = result_proxy.fetchall()
-    status_by_id = {x[0]: x[5] for x in result_set}
 
-    # Get pods that are relevant
-    try:
-        pods = core_api_instance.list_namespaced_pod(namespace='default')
-    except ApiException as e:
-        print("Exception when calling BatchV1Api->list_job_for_all_namespaces: %s\n" % e)
-        return
-    for pod_name in [p.metadata.name for p in pods.items if p.metadata.name.startswith("notebook-")]:
-        pod_id = int(pod_name.split('-')[1])
-        if pod_id not in status_by_id.keys():
-            continue
-        try:
-            resp = stream(stream_api_instance.connect_get_namespaced_pod_exec,
-                          pod_name,
-                          'default',
-                          command=['/bin/bash'],
-                          stderr=True, stdin=True,
-                          stdout=True, tty=True,
-                          _preload_content=False)
-        except ApiException:
-            # Just started pods cant exec yet
-            logging.info("not able to scan pod %s" % pod_name)
-            continue
+def job_request(job):
+    """ Resources a job requested (a task in a warm pod has those of the pod), None if it didn't """
+    resources = job.spec.template.spec.containers[0].resources
+    if resources is None or not resources.requests:
+        return None
+    request = Resources(parse_cpu(resources.requests.get('cpu', 0)),
+                        parse_mem(resources.requests.get('memory', 0)),
+                        int(resources.requests.get(GPU_RESOURCE, 0)))
+    return scaled(request, job.spec.parallelism or 1)
+
+
+def is_array(task):
+    """ Whether the task runs its notebook once per index (one Indexed Job, see 'array_job') """
+    return task.get('task_type') == 'array' and bool(task.get('array_size'))
+
+
+def has_notebook_server(task):
+    """ Whether Jupyter keeps running after the notebook (array and headless tasks stop, they have no service) """
+    return not is_array(task) and not task.get('headless')
 
-        resp.write_stdin('echo $JUPYTER_STATUS\n')
-        status = resp.readline_stdout(timeout=3)
-        # Wait for the right response
-        while status is not None:
-            status = status[:-1]
-            if status in ['Ready', 'Running', 'Finished']:
-                status_by_id[pod_id] = status
-            status = resp.readline_stdout(timeout=3)
 
-    # commit changes to db
-    for _id, st in status_by_id.items():
-        upd = db.update(tasks).where(tasks.c.id == _id).values(status=st)
-        connection.execute(upd)
+def array_parallelism(task):
+    """ How many indexes of an array task run at once """
+    return max(1, min(task['array_size'], task.get('parallelism') or ARRAY_PARALLELISM))
 
-    # Change Resources
-    return list(status_by_id.keys()).count("Running")
 
+def scaled(request, n):
+    return Resources(request.cpu * n, request.mem * n, request.gpu * n)
 
-def update_services(api_instance, ids_db):
+
+def pod_request(request, array):
+    """ The resources of a single pod of a task, <request> is for all its pods that run at once """
+    if array is None:
+        return request
+    n = array[1]
+    return Resources(request.cpu / n, request.mem / n, request.gpu // n)
+
+
+def task_runtime(task, estimator, q=PLACEMENT_QUANTILE, elapsed=0):
     """
-    Input: Needs an instance of the CoreV1Api
+    Predicted runtime of a task in seconds (see estimate.py)
+    q - quantile of the runtime, elapsed - how long the task is running already
+    """
+    return estimator.estimate(task, q, elapsed)
+
+
+def predict_etas(queue, running, capacity, tasks, estimator, settings, now):
+    """
+    Input: queue - Pending tasks in policy order (those that were just started are skipped)
+           running - Running tasks (including those that were just started)
     -----
-    Creates a service for every job that doesn't have one.
+    Returns {id: (start, end)} of the queued tasks, predicted with the median runtimes
+    """
+    started = {r.id for r in running}
+    queue = [task._replace(runtime=task_runtime(tasks[task.id], estimator, ETA_QUANTILE))
+             for task in queue if task.id not in started]
+    running = [r._replace(end=r.start + task_runtime(tasks[r.id], estimator, ETA_QUANTILE, now - r.start))
+               for r in running]
+    return forecast(queue, running, capacity, now, settings['parallel'])
+
+
+def running_tasks(cache, jobs, tasks, estimator, settings):
+    """
+    Input: cache - the ClusterCache
+           jobs - the jobs of all active tasks
+           tasks - {id: task} of all active tasks
     -----
-    Because Services are created only when notebooks are created,
-    unless something goes wrong this should never do something.
-    It is for fail-proofing and stability and is not necessary in a setting with no complications/error.
+    Returns a Running for every job: the node it runs (or will run) on, what it requested,
+    when it started and when it is expected to end
     """
-    # Get all running services
-    try:
-        api_response = api_instance.list_service_for_all_namespaces()
-    # logging.info(pprint.pformat(api_response.items))
-    except ApiException as e:
-        logging.warning("Exception when calling BatchV1Api->list_service_for_all_namespaces: %s\n" % e)
-        return
-    ids_kube = {int(service.metadata.labels['sid']) for service in api_response.items
-                if service.metadata.name.startswith("nb-entrypoint-")}
-    ids_to_add = ids_db - ids_kube
-    if len(ids_to_add) > 0:
-        logging.warning("Can't find services for ids %s. They will be created" % ids_to_add)
+    now = time.time()
+    hostnames = {n.metadata.labels.get('kubernetes.io/hostname', n.metadata.name): n.metadata.name
+                 for n in cache.nodes()}
+    pod_nodes = {p.metadata.labels['id']: p.spec.node_name for p in cache.pods() if p.spec.node_name}
+
+    running = []
+    for job in jobs:
+        _id = int(job.metadata.labels['id'])
+        node = pod_nodes.get(str(_id))
+        if node is None:
+            # Not scheduled yet, it will run where it was placed
+            selector = job.spec.template.spec.node_selector or {}
+            node = hostnames.get(selector.get('kubernetes.io/hostname'))
+        start = job.status.start_time.timestamp() if job.status.start_time else now
+        running.append(Running(_id, node, job_request(job) or task_request(tasks[_id], settings),
+                               start + task_runtime(tasks[_id], estimator, elapsed=now - start), start))
+    return running
+
+
+def node_resources(cache):
+    """
+    Returns ({node: allocatable Resources}, {node: hostname}) of all nodes tasks can be placed on
+    """
+    capacity = {}
+    hostnames = {}
+    for node in cache.nodes():
+        allocatable = node_capacity(node)
+        if allocatable is not None:
+            capacity[node.metadata.name] = allocatable
+            hostnames[node.metadata.name] = node.metadata.labels.get('kubernetes.io/hostname', node.metadata.name)
+    return capacity, hostnames
+
 
-    # Create new services
-    for _id in ids_to_add:
-        create_service(api_instance, _id)
+def order_queue(policy, tasks, ids, total, estimator, settings, now):
+    """
+    Input: policy - the queue policy
+           ids - the ids of all queued tasks
+           total - the Resources of the whole cluster
+    -----
+    Returns the Pending tasks in the order the policy wants to start them
+    """
+    pending = {_id: Pending(_id, task_request(tasks[_id], settings), task_runtime(tasks[_id], estimator),
+                            task_data(tasks[_id])) for _id in ids}
+    queued = [Queued(_id, tasks[_id]['owner'], p.request.share(total), p.runtime,
+                     tasks[_id].get('priority'), tasks[_id].get('submitted')) for _id, p in pending.items()]
+    return [pending[q.id] for q in policy.order(queued, now)]
 
 
-def delete_completed_jobs(batch_api_instance, core_api_instance, connection, tasks):
+def place_tasks(queue, capacity, hostnames, running, settings, reserved=(), local=None):
     """
-    Input: Needs an instance of the BatchV1Api and the CoreV1Api
-           and the connection to the db and the table tasks
+    Input: queue - Pending tasks in the order they should start
+           capacity, hostnames - the nodes (see 'node_resources')
+           running - Running tasks
+           reserved - Running entries for other things that use resources on the nodes (warm pods)
+           local - {node: {sha256: bytes}} the datasets on the nodes (see locality.py)
     -----
-    When a Job is completed (i.e notebook is quit) it will be deleted
-    Its Entry is then deleted from the db
+    Decide which tasks to start now and on which node (best-fit with backfill, near their data, see placement.py)
+    Returns [(Pending, hostname)]
     """
-    # Get all running jobs
-    try:
-        jobs = batch_api_instance.list_job_for_all_namespaces()
-    # logging.info(pprint.pformat(api_response))
-    except ApiException as e:
-        print("Exception when calling BatchV1Api->list_job_for_all_namespaces: %s\n" % e)
-        return
+    placed = schedule(queue, capacity, list(running) + list(reserved), time.time(), backfill=settings['backfill'],
+                      local=local)
+    if settings['parallel'] > 0:
+        placed = placed[:max(0, settings['parallel'] - len(running))]
+    blocked = [t.id for t in queue if not any(c.fits(t.request) for c in capacity.values())]
+    if blocked:
+        logging.warning("Tasks %s request more than any node can offer" % blocked)
+    return [(task, hostnames[node]) for task, node in placed]
 
-    for job in jobs.items:
-        if job.metadata.name.startswith('notebook-') and job.status.succeeded == 1:
-            _id = int(job.metadata.labels['id'])
-            # Delete from Kubernetes
-            logging.info("Notebook finished, id = %d" % _id)
-            delete_job(batch_api_instance, core_api_instance, _id)
-            # Delete from db
-            delete = tasks.delete().where(tasks.c.id == _id)
-            connection.execute(delete)
+
+def update_status(tasks, statuses):
+    """
+    Input: tasks - {id: task} of all active tasks
+           statuses - the StatusWatcher that knows the status reported by every notebook
+    -----
+    Checks for updates in the status of notebooks
+    Returns {id: status} for all notebooks that reported a new status
+    """
+    changes = {}
+    for _id, task in tasks.items():
+        reported = statuses.status(_id)
+        if reported is not None and reported[0] != task['status']:
+            changes[_id] = reported[0]
+    return changes
 
 
-def delete_job(batch_api_instance, core_api_instance, id):
+def delete_services(api_instance, services):
     """
-    Input: Needs an instance of the BatchV1Api and the CoreV1Api
+    Input: Needs an instance of the CoreV1Api
+           services - all notebook services (from the cache)
     -----
-    Delete a Notebook Job+Service that was deleted from the db
+    Deletes the NodePort services older versions created for every notebook (nb-entrypoint-<id>),
+    the notebooks are reached through the proxy of the website now (see 'notebook_address')
     """
-    JOB_NAME = "notebook-%02d" % id
-    SERVICE_NAME = "nb-entrypoint-%02d" % id
+    def delete(name):
+        try:
+            retrying('delete_namespaced_service', api_instance.delete_namespaced_service, name=name,
+                     namespace="default")
+            logging.info("Old service %s deleted" % name)
+        except ApiException as e:
+            if e.status != 404:
+                logging.warning("Exception when calling CoreV1Api->delete_namespaced_service: %s\n" % e)
+    workers.map(delete, [s.metadata.name for s in services if s.metadata.name.startswith("nb-entrypoint-")])
 
-    # Delete Job
-    try:
-        api_response = batch_api_instance.delete_namespaced_job(
-            name=JOB_NAME,
-            namespace="default",
-            body=client.V1DeleteOptions(
-                propagation_policy='Foreground',
-                grace_period_seconds=5))
-    except ApiException as e:
-        print("Exception when calling BatchV1Api->delete_namespaced_job: %s\n" % e)
-        return
-    logging.info("Job deleted. status='%s'" % str(api_response.status))
 
-    # Delete Service
+def notebook_address(cache, id):
+    """ <ip>:<port> of the Jupyter server of a task (its running pod, from the cache), None if there is none """
+    for pod in cache.pods():
+        if pod.metadata.labels.get('id') == str(id) and pod.metadata.deletion_timestamp is None and \
+                pod.status.phase == 'Running' and pod.status.pod_ip:
+            return "%s:8888" % pod.status.pod_ip
+    return None
+
+
+def completed_jobs(jobs):
+    """
+    Input: jobs - all notebook jobs (from the cache)
+    -----
+    When a Job is completed (i.e notebook is quit) it has to be deleted.
+    The job of an array task is completed when all indexes succeeded or one failed too often.
+    Returns the ids of all completed jobs, their tasks are done
+    """
+    completed = set()
+    for job in jobs:
+        if not job.metadata.name.startswith('notebook-'):
+            continue
+        if 'array' in (job.metadata.labels or {}):
+            failed = any(c.type == 'Failed' and c.status == 'True' for c in job.status.conditions or [])
+            done = failed or (job.status.succeeded or 0) >= (job.spec.completions or 1)
+        else:
+            done = job.status.succeeded == 1
+        if done:
+            _id = int(job.metadata.labels['id'])
+            logging.info("Notebook finished, id = %d" % _id)
+            completed.add(_id)
+    return completed
+
+
+def load_settings(path):
+    """
+    Reads the settings file, one <key>=<value> per line:
+      cpu, mem - resources of a task that doesn't request its own
+      gpu      - GPUs of a task that doesn't request its own
+      parallel - how many tasks run at once at most (0 = as many as fit on the nodes)
+      runtime  - expected runtime in minutes of a task without estimate
+      backfill - 1 if small tasks may start ahead of a blocked large one (without delaying it)
+      policy, shares, half_life - the queue policy (see policy.make_policy)
+      warm     - at most this many idle notebook pods are kept ready for new tasks (0 = no warm pool)
+    """
+    settings = {'cpu': '1.5', 'mem': '5000Mi', 'gpu': 0, 'parallel': 2, 'runtime': 60, 'backfill': 1,
+                'policy': 'fairshare', 'shares': '', 'half_life': '24', 'warm': 0}
     try:
-        api_response = core_api_instance.delete_namespaced_service(
-            name=SERVICE_NAME,
-            namespace="default",
-            body=client.V1DeleteOptions(
-                propagation_policy='Foreground',
-                grace_period_seconds=5))
-    except ApiException as e:
-        print("Exception when calling BatchV1Api->delete_namespaced_job: %s\n" % e)
-        return
-    logging.info("Service deleted. status='%s'" % str(api_response.status))
+        with open(path, 'r') as c:
+            for line in c.readlines():
+                if '=' in line:
+                    key, value = line.strip().split('=', 1)
+                    settings[key] = value
+    except FileNotFoundError:
+        logging.warning('Configuration file not found using standard configuration')
+    for key in ['gpu', 'parallel', 'runtime', 'backfill', 'warm']:
+        settings[key] = int(settings[key])
+    return settings
 
 
 def main():
     """
-    Creates and Deletes Jobs+Services for the Notebook images.
-    They can be reached at 127.0.0.1:31000+<id>
-    Updates when it receives message 'update' from frontend.
+    Creates and Deletes Jobs for the Notebook images.
+    They are reached through the proxy of the website at /nb/<id>/, it asks for their address (see 'IpcServer')
+    Updates whenever a job, pod or service changes (watched by the informers)
+    and when it receives message 'update' from frontend (see 'IpcServer').
     See method 'update' for more info
     """
 
@@ -375,52 +486,57 @@ def main():
     config.load_incluster_config()
     c = client.Configuration()
     c.assert_hostname = False
+    # One connection for every worker that sends changes (see mutations.py)
+    c.connection_pool_maxsize = max(c.connection_pool_maxsize, WORKERS)
     client.Configuration.set_default(c)
-    batch_api_instance = client.BatchV1Api()
-    core_api_instance = client.CoreV1Api()
+    # Every call is measured (see instrument.py)
+    batch_api_instance = InstrumentedApi(client.BatchV1Api())
+    core_api_instance = InstrumentedApi(client.CoreV1Api())
     logging.basicConfig(level=logging.INFO)
     logging.info('Started Scheduler')
+    # Timings for Prometheus on port SCHEDULER_METRICS_PORT (0 to turn it off)
+    serve_metrics()
 
     # init configuration
-    try:
-        with open('settings', 'r') as c:
-            settings = [line.replace('\n', '').split('=')[1] for line in c.readlines()]
-            settings[2] = int(settings[2])
-    except FileNotFoundError:
-        logging.warning('Configuration file not found using standard configuration')
-        settings = ["1.5", "5000Mi", 2]
-
-    # Check if db and kubernetes line up (also check if the services are running)
-    update(batch_api_instance, core_api_instance, settings, check_services=True)
+    settings = load_settings('settings')
 
-    HOST = '127.0.0.1'  # localhost
-    PORT = 65432  # Port to listen on
-
-    # If there is no connection still update every <update_rate> seconds
+    # If nothing changes still update every <update_rate> seconds
     update_rate = 300
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.bind((HOST, PORT))
-
-        # Listen for Connection:
-        while True:
-            s.settimeout(update_rate)
-            s.listen()
-            try:
-                conn, addr = s.accept()
-            except socket.timeout:
-                # Manual Update
-                update(batch_api_instance, core_api_instance, settings)
-            with conn:
-                logging.info('Connected by %s' % str(addr))
-                while True:
-                    # Listen for messages
-                    data = conn.recv(1024).decode("utf-8")
-                    # Connection lost
-                    if not data:
-                        break
-                    if data == 'update':
-                        update(batch_api_instance, core_api_instance, settings)
-                    conn.sendall(b'Done')
+
+    # Watch the cluster and reconcile on every change
+    # Set SCHEDULER_RECORDING to a path to record all events for replaying them later
+    store = TaskStore()
+    policy = make_policy(settings)
+    # Runtimes are learned from all finished tasks (the first update reads the whole history)
+    estimator = RuntimeEstimator(default=60 * settings['runtime'])
+    etas = QueueForecast()
+    # Idle notebook pods with the default resources (see warmpool.py)
+    pool = WarmPool(settings['warm'],
+                    Resources(parse_cpu(settings['cpu']), parse_mem(settings['mem']), settings['gpu']))
+    # Resource usage reported by the notebooks (see telemetry.py)
+    telemetry = TelemetryCollector()
+    # Datasets on the local disks of the nodes (see locality.py)
+    locality = DataLocality()
+    reconciler = Reconciler(lambda: update(batch_api_instance, core_api_instance, cache, store, statuses,
+                                           policy, estimator, etas, pool, telemetry, locality, settings),
+                            resync=update_rate)
+    cache = ClusterCache(batch_api_instance, core_api_instance,
+                         on_event=lambda kind, event_type, obj, received: reconciler.notify(kind, received),
+                         recording=os.environ.get('SCHEDULER_RECORDING'))
+    # The notebooks report their status through files on the shared volume
+    statuses = StatusWatcher(on_change=lambda _id, status, timestamp: reconciler.notify('status', timestamp))
+    cache.start()
+
+    # Check if db and kubernetes line up (and delete the services of older versions)
+    update(batch_api_instance, core_api_instance, cache, store, statuses, policy, estimator, etas, pool, telemetry,
+           locality, settings, check_services=True)
+    statuses.start()
+    telemetry.start()
+    reconciler.start()
+
+    # Serve the frontend, it gets an acknowledgement immediately and can wait for a reconcile if needed
+    IpcServer(reconciler, host='127.0.0.1', port=65432, etas=etas, telemetry=telemetry,
+              routes=lambda _id: notebook_address(cache, _id)).serve_forever()
 
 
 if __name__ == '__main__':
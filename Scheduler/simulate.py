@@ -0,0 +1,250 @@
+from collections import namedtuple, OrderedDict
+from placement import Resources, Pending, Running, schedule
+from policy import Queued, FifoPolicy, FairSharePolicy
+import argparse
+import random
+import heapq
+import csv
+
+"""
+Offline simulation of the scheduler, no cluster is needed.
+
+A trace of tasks (synthetic or from a CSV file) is replayed against a set of identical nodes.
+The placement only knows the estimated runtime of a task, the simulated task runs for its real runtime.
+Reports how well the nodes are packed and how long tasks wait in the queue.
+
+Usage: python simulate.py [--trace trace.csv] [--tasks 500] [--nodes 2] [--no-backfill] [--policies] [--hold 1800]
+                          [--locality [--datasets 12] [--bandwidth 200] [--cache 50]]
+The trace has the columns id,owner,submit,cpu,mem,gpu,runtime,estimate and optionally priority
+(times in seconds, mem in MiB).
+With --policies the queue policies (fifo, fairshare) are compared per owner instead.
+With --hold interactive tasks (Jupyter keeps running and holds the resources for that many seconds after the
+notebook finished, until the user quits it) are compared with headless ones (the job stops with the notebook).
+With --locality most tasks read one of <datasets> datasets, which is copied to the node before the task starts
+(at <bandwidth> MB/s, every node keeps <cache> GB, see locality.py). Placement that ignores where the data is
+is compared with placement that prefers nodes holding it: bytes copied and the latency until tasks start working.
+"""
+
+TraceTask = namedtuple('TraceTask', ['id', 'owner', 'submit', 'request', 'runtime', 'estimate', 'priority', 'data'],
+                       defaults=[()])
+# Copying datasets to the nodes: <bandwidth> bytes per second, each node keeps <cache> bytes (least recently used
+# are deleted), <aware> whether placement prefers nodes that hold the data
+Locality = namedtuple('Locality', ['bandwidth', 'cache', 'aware'])
+
+
+def synthetic_trace(n, seed=0, owners=5, arrival=120, gpu_share=0.2, heavy=0.0):
+    """
+    <n> tasks of <owners> users, arriving on average every <arrival> seconds.
+    Mostly small CPU tasks, some large ones and some with a GPU. The estimates are off by up to a factor 2.
+    A fraction <heavy> of all tasks comes from the additional user 'heavy' (submitting in bursts).
+    """
+    rng = random.Random(seed)
+    trace = []
+    now = 0.0
+    for i in range(1, n + 1):
+        now += rng.expovariate(1 / arrival)
+        if rng.random() < 0.2:
+            request = Resources(rng.choice([4, 6, 8]), rng.choice([16000, 24000, 32000]), 0)
+        else:
+            request = Resources(rng.choice([0.5, 1, 1.5, 2]), rng.choice([2000, 4000, 5000, 8000]), 0)
+        if rng.random() < gpu_share:
+            request = request._replace(gpu=1)
+        runtime = rng.lognormvariate(7.5, 1)
+        owner = "heavy" if rng.random() < heavy else "user%d" % rng.randrange(owners)
+        trace.append(TraceTask(i, owner, now, request, runtime, runtime * rng.uniform(0.5, 2), 0))
+    return trace
+
+
+def synthetic_datasets(trace, n=12, seed=0, share=0.8):
+    """
+    A share <share> of the tasks reads one of <n> datasets (1 - 20 GB, some are read much more often than others)
+    """
+    rng = random.Random(seed)
+    sizes = [int(rng.uniform(1, 20) * 10 ** 9) for _ in range(n)]
+    weights = [1 / (i + 1) for i in range(n)]
+    return [t._replace(data=(("dataset%d" % d, sizes[d]),) if rng.random() < share else ())
+            for t, d in ((t, rng.choices(range(n), weights)[0]) for t in trace)]
+
+
+def load_trace(path):
+    with open(path, 'r') as f:
+        return [TraceTask(int(row['id']), row['owner'], float(row['submit']),
+                          Resources(float(row['cpu']), float(row['mem']), int(row['gpu'])),
+                          float(row['runtime']), float(row['estimate']), int(row.get('priority') or 0))
+                for row in csv.DictReader(f)]
+
+
+def percentile(values, p):
+    """ <p>-th percentile (0-100) of <values>, nearest rank """
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))]
+
+
+def simulate(trace, capacity, backfill=True, policy=None, hold=0, locality=None):
+    """
+    Input: trace - TraceTasks
+           capacity - {node: Resources}
+           backfill - see placement.schedule
+           policy - the queue policy (see policy.py), FIFO if None
+           hold - seconds a task keeps its resources after it finished (the scheduler doesn't know about it)
+           locality - a Locality: the datasets of the tasks are copied to their node first (None: no data)
+    -----
+    Returns {'start': {id: time}, 'end': {id: time}, 'wait': {id: seconds}, 'makespan', 'utilisation', 'working',
+    'copied', 'latency': {id: seconds}}
+    'utilisation' is the share of the resources allocated to tasks, 'working' the share of the resources of tasks
+    that still run their notebook (without the hold). 'copied' are the bytes copied to the nodes and 'latency' the
+    time from the submission until the task could start working (wait and copy)
+    """
+    policy = policy or FifoPolicy()
+    arrivals = sorted(trace, key=lambda t: t.submit)
+    by_id_all = {t.id: t for t in trace}
+    total = sum(capacity.values(), Resources(0, 0, 0))
+    queue = []
+    running = {}
+    ends = []
+    start, end = {}, {}
+    used_time = Resources(0, 0, 0)
+    held = {node: OrderedDict() for node in capacity}
+    copied = 0
+    latency = {}
+    now = arrivals[0].submit if arrivals else 0
+    first = now
+    i = 0
+
+    while i < len(arrivals) or queue or running:
+        # Advance to the next arrival or completion
+        next_times = ([arrivals[i].submit] if i < len(arrivals) else []) + ([ends[0][0]] if ends else [])
+        if not next_times:
+            raise ValueError("Tasks %s never fit on any node" % [t.id for t in queue])
+        later = min(next_times)
+        allocated = sum((r.request for r in running.values()), Resources(0, 0, 0))
+        used_time = used_time + Resources(*[a * (later - now) for a in allocated])
+        now = later
+
+        while ends and ends[0][0] <= now:
+            _, _id = heapq.heappop(ends)
+            end[_id] = now
+            del running[_id]
+        while i < len(arrivals) and arrivals[i].submit <= now:
+            queue.append(arrivals[i])
+            i += 1
+
+        by_id = {t.id: t for t in queue}
+        policy.sync({r.id: (by_id_all[r.id].owner, r.request.share(total), r.start) for r in running.values()}, now)
+        queued = [Queued(t.id, t.owner, t.request.share(total), t.estimate, t.priority, t.submit) for t in queue]
+        pending = [Pending(q.id, by_id[q.id].request, by_id[q.id].estimate, by_id[q.id].data)
+                   for q in policy.order(queued, now)]
+        local = {node: dict(datasets) for node, datasets in held.items()} if locality and locality.aware else None
+        for task, node in schedule(pending, capacity, running.values(), now, backfill, local):
+            trace_task = by_id[task.id]
+            start[task.id] = now
+            # The task holds its resources while its data is copied
+            staging = 0
+            if locality is not None:
+                missing = [(sha256, size) for sha256, size in task.data if sha256 not in held[node]]
+                staging = sum(size for _, size in missing) / locality.bandwidth
+                copied += sum(size for _, size in missing)
+                keep_recent(held[node], task.data, locality.cache)
+            latency[task.id] = now - trace_task.submit + staging
+            running[task.id] = Running(task.id, node, task.request, now + staging + trace_task.estimate, now)
+            heapq.heappush(ends, (now + staging + trace_task.runtime + hold, task.id))
+            queue.remove(trace_task)
+
+    makespan = now - first
+    utilisation = Resources(*[u / (c * makespan) if c > 0 and makespan > 0 else 0
+                              for u, c in zip(used_time, total)])
+    work = sum((Resources(*[a * t.runtime for a in t.request]) for t in trace), Resources(0, 0, 0))
+    working = Resources(*[w / (c * makespan) if c > 0 and makespan > 0 else 0 for w, c in zip(work, total)])
+    wait = {t.id: start[t.id] - t.submit for t in trace}
+    return {'start': start, 'end': end, 'wait': wait, 'makespan': makespan, 'utilisation': utilisation,
+            'working': working, 'copied': copied, 'latency': latency}
+
+
+def keep_recent(datasets, used, cache):
+    """ Mark the datasets <used> as used last in <datasets> (OrderedDict, least recently used first) """
+    for sha256, size in used:
+        datasets.pop(sha256, None)
+        datasets[sha256] = size
+    while len(datasets) > len(used) and sum(datasets.values()) > cache:
+        datasets.popitem(last=False)
+
+
+def report(name, trace, result):
+    waits = list(result['wait'].values())
+    u = result['utilisation']
+    w = result['working']
+    print("%-12s makespan %8.0fs | utilisation cpu %3.0f%% mem %3.0f%% gpu %3.0f%% (working cpu %3.0f%% gpu %3.0f%%) | "
+          "wait mean %6.0fs p50 %6.0fs p95 %6.0fs" %
+          (name, result['makespan'], 100 * u.cpu, 100 * u.mem, 100 * u.gpu, 100 * w.cpu, 100 * w.gpu,
+           sum(waits) / max(1, len(waits)), percentile(waits, 50), percentile(waits, 95)))
+
+
+def report_locality(name, trace, result):
+    """ Bytes copied to the nodes and how long tasks took from their submission until they could start working """
+    latency = list(result['latency'].values())
+    print("%-12s copied %8.1f GB | start latency mean %6.0fs p50 %6.0fs p95 %6.0fs | makespan %8.0fs" %
+          (name, result['copied'] / 1e9, sum(latency) / max(1, len(latency)), percentile(latency, 50),
+           percentile(latency, 95), result['makespan']))
+
+
+def report_owners(name, trace, result):
+    """ Wait times per owner, to see whether one owner crowds out the others """
+    owners = sorted({t.owner for t in trace})
+    print("%s (makespan %.0fs)" % (name, result['makespan']))
+    for owner in owners:
+        waits = [result['wait'][t.id] for t in trace if t.owner == owner]
+        print("  %-8s %4d tasks | wait p50 %7.0fs p95 %7.0fs" %
+              (owner, len(waits), percentile(waits, 50), percentile(waits, 95)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate the scheduler on a task trace")
+    parser.add_argument('--trace', help="CSV file with the tasks, a synthetic trace is used if not given")
+    parser.add_argument('--tasks', type=int, default=500, help="size of the synthetic trace")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--nodes', type=int, default=2)
+    parser.add_argument('--cpu', type=float, default=16)
+    parser.add_argument('--mem', type=float, default=64000)
+    parser.add_argument('--gpu', type=int, default=2)
+    parser.add_argument('--no-backfill', action='store_true', help="only simulate without backfill")
+    parser.add_argument('--policies', action='store_true', help="compare the queue policies per owner")
+    parser.add_argument('--heavy', type=float, default=0.5,
+                        help="fraction of the synthetic tasks from one heavy user (only with --policies)")
+    parser.add_argument('--hold', type=float, default=0,
+                        help="compare interactive tasks that hold their resources this many seconds after they "
+                             "finished with headless ones")
+    parser.add_argument('--locality', action='store_true',
+                        help="compare placement with and without regard to the datasets of the tasks")
+    parser.add_argument('--datasets', type=int, default=12, help="number of datasets (only with --locality)")
+    parser.add_argument('--bandwidth', type=float, default=200,
+                        help="MB/s at which a dataset is copied to a node (only with --locality)")
+    parser.add_argument('--cache', type=float, default=50,
+                        help="GB of datasets every node keeps (only with --locality)")
+    args = parser.parse_args()
+
+    trace = load_trace(args.trace) if args.trace else \
+        synthetic_trace(args.tasks, args.seed, heavy=args.heavy if args.policies else 0)
+    capacity = {"node%d" % n: Resources(args.cpu, args.mem, args.gpu) for n in range(args.nodes)}
+    if args.policies:
+        report_owners("fifo", trace, simulate(trace, capacity, policy=FifoPolicy()))
+        report_owners("fairshare", trace, simulate(trace, capacity, policy=FairSharePolicy()))
+        return
+    if args.locality:
+        trace = synthetic_datasets(trace, args.datasets, args.seed)
+        for name, aware in [("data-blind", False), ("locality", True)]:
+            report_locality(name, trace, simulate(trace, capacity, backfill=not args.no_backfill,
+                                                  locality=Locality(args.bandwidth * 1e6, args.cache * 1e9, aware)))
+        return
+    if args.hold > 0:
+        report("interactive", trace, simulate(trace, capacity, backfill=not args.no_backfill, hold=args.hold))
+        report("headless", trace, simulate(trace, capacity, backfill=not args.no_backfill))
+        return
+    report("no backfill", trace, simulate(trace, capacity, backfill=False))
+    if not args.no_backfill:
+        report("backfill", trace, simulate(trace, capacity, backfill=True))
+
+
+if __name__ == '__main__':
+    main()
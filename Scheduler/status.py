@@ -0,0 +1,99 @@
+import threading
+import logging
+import time
+import os
+
+# Written by jupyter/entrypoint.sh into the script folder of every task
+STATUS_FILE = '.status'
+STATUSES = ['Ready', 'Running', 'Finished', 'Failed']
+
+
+def read_status(path):
+    """
+    Reads a status file, it contains a single line '<STATUS> <UNIX TIMESTAMP>'
+    Returns (status, timestamp) or None if there is no (valid) status yet
+    """
+    try:
+        with open(path, 'r') as f:
+            parts = f.read().split()
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    if len(parts) == 0 or parts[0] not in STATUSES:
+        return None
+    try:
+        timestamp = float(parts[1])
+    except (IndexError, ValueError):
+        timestamp = None
+    return parts[0], timestamp
+
+
+class StatusWatcher(threading.Thread):
+    """
+    Picks up the status transitions (Ready/Running/Finished or Failed) that the notebook containers report themselves.
+    -----
+    Every container writes its status into '<USER>/<id>/.status' on the shared volume.
+    The watcher only has to stat the files of the tasks that have a job, which is a few microseconds
+    per task, and calls <on_change(id, status, timestamp)> as soon as one of them changed.
+    No exec calls into the pods are necessary anymore.
+    """
+    def __init__(self, on_change=None, root='/mnt/internal', interval=0.5):
+        super().__init__(name="status-watcher", daemon=True)
+        self.on_change = on_change
+        self.root = root
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._paths = {}
+        self._mtimes = {}
+        self._statuses = {}
+
+    def path(self, user, id):
+        return os.path.join(self.root, user, str(id), STATUS_FILE)
+
+    def watch(self, users):
+        """
+        Input: users - {id: USER} of all tasks that have a job
+        -----
+        Set which tasks are watched, all others are forgotten
+        """
+        with self._lock:
+            self._paths = {_id: self.path(user, _id) for _id, user in users.items()}
+            self._mtimes = {_id: m for _id, m in self._mtimes.items() if _id in self._paths}
+            self._statuses = {_id: st for _id, st in self._statuses.items() if _id in self._paths}
+        self.scan()
+
+    def status(self, id):
+        """ Last known (status, timestamp) of a task or None """
+        with self._lock:
+            return self._statuses.get(id)
+
+    def scan(self):
+        """ Check all watched files once, returns the ids that changed """
+        with self._lock:
+            paths = dict(self._paths)
+        changed = []
+        for _id, path in paths.items():
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            with self._lock:
+                if self._mtimes.get(_id) == mtime:
+                    continue
+                self._mtimes[_id] = mtime
+            status = read_status(path)
+            if status is None:
+                continue
+            with self._lock:
+                if _id not in self._paths or self._statuses.get(_id, (None,))[0] == status[0]:
+                    continue
+                self._statuses[_id] = status
+            changed.append(_id)
+            logging.info("Status of task %d changed to %s" % (_id, status[0]))
+            if self.on_change is not None:
+                self.on_change(_id, *status)
+        return changed
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.scan()
@@ -0,0 +1,102 @@
+from status import StatusWatcher, STATUS_FILE
+import statistics
+import argparse
+import tempfile
+import shutil
+import time
+import os
+
+"""
+Benchmark of the status refresh: how long the scheduler needs to learn the status of all live notebooks.
+
+    python statusbench.py [--notebooks 1 10 100] [--repeat 50]
+    python statusbench.py --kube [--namespace default]
+
+Without --kube the status files (see status.py) of <notebooks> tasks are written to a temporary folder and
+StatusWatcher.scan is timed when no file changed and when all of them changed (median of <repeat> scans).
+With --kube the probe of older versions is timed against the running notebook pods of the cluster instead:
+an exec into every pod that runs 'echo $JUPYTER_STATUS' and reads the answer with a timeout of 3s per line.
+"""
+
+
+def write_status(root, user, id, status):
+    folder = os.path.join(root, user, str(id))
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, STATUS_FILE)
+    with open(path + '.tmp', 'w') as f:
+        f.write("%s %f\n" % (status, time.time()))
+    os.replace(path + '.tmp', path)
+
+
+def bench_files(notebooks, repeat):
+    """ (seconds of a scan without changes, seconds of a scan where all changed), medians """
+    root = tempfile.mkdtemp(prefix='statusbench-')
+    try:
+        users = {id: 'user%d' % (id % 5) for id in range(1, notebooks + 1)}
+        for id, user in users.items():
+            write_status(root, user, id, 'Ready')
+        watcher = StatusWatcher(root=root)
+        watcher.watch(users)
+        unchanged, changed = [], []
+        for i in range(repeat):
+            start = time.perf_counter()
+            watcher.scan()
+            unchanged.append(time.perf_counter() - start)
+            status = 'Running' if i % 2 == 0 else 'Ready'
+            for id, user in users.items():
+                write_status(root, user, id, status)
+            start = time.perf_counter()
+            assert len(watcher.scan()) == notebooks
+            changed.append(time.perf_counter() - start)
+        return statistics.median(unchanged), statistics.median(changed)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def bench_exec(namespace):
+    """ Seconds of the exec probe of every notebook pod (as update_status of older versions did it) """
+    from kubernetes import client, config
+    from kubernetes.stream import stream
+    config.load_kube_config()
+    api = client.CoreV1Api()
+    times = {}
+    for pod in api.list_namespaced_pod(namespace).items:
+        if not pod.metadata.name.startswith('notebook-') or pod.status.phase != 'Running':
+            continue
+        start = time.perf_counter()
+        resp = stream(api.connect_get_namespaced_pod_exec, pod.metadata.name, namespace, command=['/bin/bash'],
+                      stderr=True, stdin=True, stdout=True, tty=True, _preload_content=False)
+        resp.write_stdin('echo $JUPYTER_STATUS\n')
+        while resp.readline_stdout(timeout=3) is not None:
+            pass
+        resp.close()
+        times[pod.metadata.name] = time.perf_counter() - start
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--notebooks', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--kube', action='store_true', help="time the exec probe against the cluster instead")
+    parser.add_argument('--namespace', default='default')
+    args = parser.parse_args()
+
+    if args.kube:
+        times = bench_exec(args.namespace)
+        for name, seconds in sorted(times.items()):
+            print("%-40s %.2f s" % (name, seconds))
+        print("%d pods, %.2f s per refresh" % (len(times), sum(times.values())))
+        return
+    print("notebooks  unchanged  all changed")
+    for n in args.notebooks:
+        unchanged, changed = bench_files(n, args.repeat)
+        print("%-10d %-10s %s" % (n, format_seconds(unchanged), format_seconds(changed)))
+
+
+def format_seconds(seconds):
+    return "%.1f ms" % (seconds * 1000) if seconds >= 0.001 else "%d us" % round(seconds * 1e6)
+
+
+if __name__ == '__main__':
+    main()
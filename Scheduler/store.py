@@ -0,0 +1,120 @@
+from sqlalchemy.pool import QueuePool
+from instrument import timed, DB_STATEMENT_SECONDS, DB_TRANSACTION_SECONDS
+# Shared with the website (common/database.py)
+from database import BUSY_TIMEOUT, LockStats, configure_sqlite
+import sqlalchemy as db
+import logging
+import time
+import os
+
+# Tasks with one of these statuses are scheduled (see flask/store.py for the schema),
+# 'Done' and 'Failed' (a headless task whose notebook or script failed) are kept as history
+ACTIVE = ['Ready', 'Running', 'Finished']
+
+# Columns that record when a task reached a status (the runtime of a failed task says nothing about the next ones)
+STAMPS = {'Running': 'started', 'Finished': 'finished'}
+
+# How many connections to keep open
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 2))
+
+
+class TaskStore:
+    """
+    The scheduler's view of the table 'tasks'.
+    -----
+    Keeps all active tasks in memory and only reads the rows that changed since the last pass
+    (every change increases the counter 'task_seq' and sets the column 'seq' of the row).
+    If the counter didn't change, no row is read at all.
+    Status changes are written in one transaction with one statement per status,
+    rows that already have that status are not touched.
+    -----
+    The engine and the reflected table live as long as the store, the database is used in WAL mode
+    """
+    def __init__(self, url='sqlite:////mnt/internal/queue.db'):
+        self.engine = db.create_engine(url, convert_unicode=True,
+                                       poolclass=QueuePool, pool_size=POOL_SIZE, max_overflow=POOL_SIZE,
+                                       connect_args={'check_same_thread': False, 'timeout': BUSY_TIMEOUT / 1000})
+        self.lock_stats = LockStats()
+        configure_sqlite(self.engine, self.lock_stats, DB_STATEMENT_SECONDS)
+        self.tasks = self.reflect()
+        self.seq = 0
+        self.active = {}
+        # {id: row} of all rows (also those that aren't active) read by the last refresh
+        self.changed_rows = {}
+
+    def reflect(self, interval=2):
+        """ The table 'tasks', waits until the website created it (see 'create_schema' in flask/store.py) """
+        while True:
+            try:
+                return db.Table('tasks', db.MetaData(), autoload=True, autoload_with=self.engine)
+            except db.exc.NoSuchTableError:
+                logging.info("Waiting for the website to create the table 'tasks'")
+                time.sleep(interval)
+
+    def counter(self, connection):
+        return connection.execute("SELECT value FROM task_seq").scalar()
+
+    def refresh(self):
+        """
+        Read the changes since the last call.
+        Returns the ids of all tasks that changed.
+        """
+        tasks = self.tasks
+        with timed(DB_TRANSACTION_SECONDS, 'db refresh', operation='refresh'), self.engine.connect() as connection:
+            counter = self.counter(connection)
+            if counter == self.seq:
+                self.changed_rows = {}
+                return set()
+
+            # Rows may have been deleted, the ids of all active tasks come from the index on status
+            active_ids = {row[0] for row in connection.execute(
+                db.select([tasks.c.id]).where(tasks.c.status.in_(ACTIVE)))}
+            query = db.select([tasks]).where(tasks.c.seq > self.seq)
+            changed_rows = {row['id']: dict(row) for row in connection.execute(query)}
+
+        changed = set(changed_rows) | (set(self.active) - active_ids)
+        self.active = {_id: changed_rows.get(_id, self.active.get(_id)) for _id in active_ids}
+        # A task that became active between the two queries is read with the next pass
+        self.active = {_id: row for _id, row in self.active.items() if row is not None}
+        self.seq = counter
+        self.changed_rows = changed_rows
+        logging.info("Read %d changed tasks up to change %d, %d active tasks | %s" %
+                     (len(changed_rows), counter, len(self.active), self.lock_stats))
+        return changed
+
+    def set_status(self, statuses, stamps=None):
+        """
+        Input: statuses - {id: status}
+               stamps - {id: {column: value}} written together with the status: when tasks reached it
+                        (see STAMPS) and their peak resource usage (see telemetry.py)
+        -----
+        Write all status changes in a single transaction, only rows with a different status are written
+        """
+        by_status = {}
+        for _id, status in statuses.items():
+            if self.active.get(_id, {}).get('status') != status:
+                by_status.setdefault(status, []).append(_id)
+        stamps = {_id: values for _id, values in (stamps or {}).items() if _id in statuses
+                  and statuses[_id] in by_status and _id in by_status[statuses[_id]]}
+        if len(by_status) == 0:
+            return
+        tasks = self.tasks
+        with timed(DB_TRANSACTION_SECONDS, 'db set_status', operation='set_status'), \
+                self.engine.begin() as connection:
+            for status, ids in by_status.items():
+                connection.execute(db.update(tasks)
+                                   .where(tasks.c.id.in_(ids))
+                                   .where(tasks.c.status != status)
+                                   .values(status=status))
+            for _id, values in stamps.items():
+                # A db of an older version may not have all columns
+                values = {column: value for column, value in values.items() if column in tasks.c}
+                if values:
+                    connection.execute(db.update(tasks).where(tasks.c.id == _id).values(**values))
+        for status, ids in by_status.items():
+            for _id in ids:
+                if status not in ACTIVE:
+                    self.active.pop(_id, None)
+                elif _id in self.active:
+                    self.active[_id]['status'] = status
+                    self.active[_id].update(stamps.get(_id, {}))
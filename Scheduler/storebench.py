@@ -0,0 +1,114 @@
+from store import TaskStore
+import sqlalchemy as db
+import subprocess
+import statistics
+import argparse
+import tempfile
+import shutil
+import time
+import sys
+import os
+
+"""
+Benchmark of the task store with a growing history: <history> done tasks and <active> active ones.
+
+    python storebench.py [--history 10000 100000] [--active 10] [--repeat 5] [--no-old]
+
+Compares (median of <repeat> runs) how the website gets the id of a new task and how long a pass of the scheduler
+over the database takes, as older versions did it and with the indexed, incremental store (see store.py):
+  next id   old: read all tasks and take the largest id + 1 | new: insert the task, the id comes from the db
+  pass      old: read all tasks, one autocommitted UPDATE per task | new: TaskStore.refresh and set_status
+            after one task changed its status
+The schema is created by the website (flask/store.py), so the database is the same as in production.
+"""
+
+WEBSITE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'flask')
+COMMON = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common')
+
+
+def create_database(path, history, active):
+    """ A database at <path> with the schema of the website and <history> done and <active> ready tasks """
+    url = 'sqlite:///' + path
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([WEBSITE, COMMON]))
+    subprocess.run([sys.executable, '-c', "import sys, sqlalchemy, store; "
+                                          "store.create_schema(sqlalchemy.create_engine(sys.argv[1]))", url],
+                   cwd=WEBSITE, env=env, check=True)
+    engine = db.create_engine(url)
+    with engine.begin() as connection:
+        rows = [{'owner': 'user%d' % (i % 20), 'task_type': 'python', 'duration': 0, 'program': 'main.ipynb',
+                 'status': 'Done' if i < history else 'Ready', 'pwd': ''} for i in range(history + active)]
+        connection.execute("INSERT INTO tasks (owner, task_type, duration, program, status, pwd) "
+                           "VALUES (:owner, :task_type, :duration, :program, :status, :pwd)", rows)
+    return engine
+
+
+def next_id_old(engine):
+    with engine.connect() as connection:
+        return max(row['id'] for row in connection.execute("SELECT * FROM tasks").fetchall()) + 1
+
+
+def next_id_new(engine):
+    with engine.connect() as connection:
+        transaction = connection.begin()
+        result = connection.execute("INSERT INTO tasks (owner, task_type, duration, program, status, pwd) "
+                                    "VALUES ('bench', 'python', 0, 'main.ipynb', 'Ready', '')")
+        _id = result.lastrowid
+        transaction.rollback()
+        return _id
+
+
+def pass_old(engine):
+    with engine.connect() as connection:
+        rows = connection.execute("SELECT * FROM tasks").fetchall()
+        status_by_id = {row['id']: row['status'] for row in rows}
+        for _id, status in status_by_id.items():
+            connection.execute("UPDATE tasks SET status = ? WHERE id = ?", status, _id)
+
+
+def pass_new(store, engine, ids, i):
+    # The website (or a notebook) changed one task
+    with engine.begin() as connection:
+        connection.execute("UPDATE tasks SET duration = ? WHERE id = ?", i, ids[i % len(ids)])
+    start = time.perf_counter()
+    store.refresh()
+    store.set_status({ids[i % len(ids)]: 'Running' if i % 2 == 0 else 'Ready'})
+    return time.perf_counter() - start
+
+
+def timed_median(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--history', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--active', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--no-old', action='store_true', help="skip the old pass (minutes with 100k tasks)")
+    args = parser.parse_args()
+
+    print("history  next id old / new      pass old / new")
+    for history in args.history:
+        folder = tempfile.mkdtemp(prefix='storebench-')
+        try:
+            engine = create_database(os.path.join(folder, 'queue.db'), history, args.active)
+            store = TaskStore('sqlite:///' + os.path.join(folder, 'queue.db'))
+            store.refresh()
+            ids = sorted(store.active)
+            id_old = timed_median(lambda: next_id_old(engine), args.repeat)
+            id_new = timed_median(lambda: next_id_new(engine), args.repeat)
+            new = statistics.median(pass_new(store, engine, ids, i) for i in range(args.repeat))
+            old = None if args.no_old else timed_median(lambda: pass_old(engine), 1)
+            print("%-8d %8.1f ms / %.1f ms   %s / %.1f ms" % (history, id_old * 1000, id_new * 1000,
+                                                             '-' if old is None else "%.1f s" % old, new * 1000))
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
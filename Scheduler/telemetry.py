@@ -0,0 +1,177 @@
+from collections import OrderedDict
+from array import array
+import threading
+import logging
+import time
+import os
+
+"""
+Resource usage of the running tasks over time.
+
+Every notebook container samples its cgroup (jupyter/telemetry.py) and appends the counters to
+'<USER>/<id>/.metrics' on the shared volume, so no metrics server or exec calls are needed.
+The collector reads the new lines of the watched files every few seconds and keeps per task
+a ring buffer of the last <capacity> samples (CPU in cores, memory in MiB, I/O in MB/s,
+GPU in % and MiB) as float32 arrays, and the peaks since the task started.
+-----
+The peaks are written to the db when a task finishes (see schedule.update) and the website
+suggests the resources of the next task of the same user from them.
+"""
+
+METRICS_FILE = '.metrics'
+FIELDS = ['time', 'cpu', 'mem', 'read', 'write', 'gpu', 'gpu_mem']
+# Fields whose maximum is kept
+PEAKS = {'cpu': 'peak_cpu', 'mem': 'peak_mem'}
+# Series of tasks that aren't watched anymore are kept for this many tasks
+KEEP_FINISHED = 100
+
+
+class RingBuffer:
+    """ The last <capacity> rows of FIELDS, one float32 array per field ('time' as float64) """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.columns = {field: array('d' if field == 'time' else 'f', bytes(capacity * (8 if field == 'time' else 4)))
+                        for field in FIELDS}
+        self.head = 0
+        self.count = 0
+
+    def append(self, row):
+        for field, value in zip(FIELDS, row):
+            self.columns[field][self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def values(self, field, last=None):
+        """ The values of a field, oldest first (only the <last> ones if given) """
+        n = self.count if last is None else min(last, self.count)
+        start = (self.head - n) % self.capacity
+        column = self.columns[field]
+        if start + n <= self.capacity:
+            values = column[start:start + n].tolist()
+        else:
+            values = column[start:].tolist() + column[:self.head].tolist()
+        # float32 has about 7 digits
+        return values if field == 'time' else [round(v, 3) for v in values]
+
+
+class TaskSeries:
+    """ The samples of one task: raw counters are turned into rates between two samples """
+    def __init__(self, capacity):
+        self.ring = RingBuffer(capacity)
+        self.last = None
+        self.peaks = {}
+
+    def add(self, sample):
+        """ sample - (time, cpu seconds, memory bytes, read bytes, written bytes, gpu %, gpu MiB) """
+        t, cpu, mem, rbytes, wbytes, gpu, gpu_mem = sample
+        last, self.last = self.last, sample
+        if last is None or t <= last[0]:
+            return
+        dt = t - last[0]
+        rate = lambda new, old: max(new - old, 0) / dt if new >= 0 and old >= 0 else -1
+        row = (t, rate(cpu, last[1]), mem / 2 ** 20 if mem >= 0 else -1,
+               rate(rbytes, last[3]) / 1e6, rate(wbytes, last[4]) / 1e6, gpu, gpu_mem)
+        self.ring.append(row)
+        for field, value in zip(FIELDS, row):
+            if field in PEAKS and value >= 0:
+                self.peaks[field] = max(self.peaks.get(field, 0), value)
+
+
+class TelemetryCollector(threading.Thread):
+    """
+    Reads the metrics files of all watched tasks every <interval> seconds.
+    Works like the StatusWatcher: 'watch' sets the tasks, only new lines of a file are read.
+    """
+    def __init__(self, root='/mnt/internal', interval=5, capacity=720):
+        super().__init__(name="telemetry", daemon=True)
+        self.root = root
+        self.interval = interval
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._paths = {}
+        # id -> (inode, offset) up to where the file was read
+        self._offsets = {}
+        self._series = {}
+        self._finished = OrderedDict()
+
+    def path(self, user, id):
+        return os.path.join(self.root, user, str(id), METRICS_FILE)
+
+    def watch(self, users):
+        """
+        Input: users - {id: USER} of all tasks that have a job
+        """
+        with self._lock:
+            self._paths = {_id: self.path(user, _id) for _id, user in users.items()}
+            for _id in [i for i in self._series if i not in self._paths]:
+                self._finished[_id] = self._series.pop(_id)
+                self._offsets.pop(_id, None)
+            while len(self._finished) > KEEP_FINISHED:
+                self._finished.popitem(last=False)
+
+    def scan(self):
+        """ Read the new samples of all watched tasks """
+        with self._lock:
+            paths = dict(self._paths)
+        for _id, path in paths.items():
+            try:
+                with open(path, 'rb') as f:
+                    inode = os.fstat(f.fileno()).st_ino
+                    known_inode, offset = self._offsets.get(_id, (inode, 0))
+                    if known_inode != inode:
+                        # The container started a new file
+                        offset = 0
+                    f.seek(offset)
+                    data = f.read()
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            # Only complete lines, the rest is read next time
+            end = data.rfind(b'\n') + 1
+            samples = []
+            for line in data[:end].split(b'\n'):
+                try:
+                    sample = [float(v) for v in line.split()]
+                except ValueError:
+                    continue
+                if len(sample) == len(FIELDS):
+                    samples.append(sample)
+            with self._lock:
+                if _id not in self._paths:
+                    continue
+                self._offsets[_id] = (inode, offset + end)
+                series = self._series.setdefault(_id, TaskSeries(self.capacity))
+                for sample in samples:
+                    series.add(sample)
+
+    def _get(self, id):
+        return self._series.get(id) or self._finished.get(id)
+
+    def series(self, id, last=None):
+        """ {field: [values]} of a task (oldest first) and its peaks, None if nothing is known """
+        with self._lock:
+            series = self._get(id)
+            if series is None:
+                return None
+            result = {field: series.ring.values(field, last) for field in FIELDS}
+            result['peaks'] = dict(series.peaks)
+            return result
+
+    def peaks(self, id):
+        """ {db column: peak} of a task (see PEAKS) """
+        with self._lock:
+            series = self._get(id)
+            return {PEAKS[field]: value for field, value in series.peaks.items()} if series else {}
+
+    def summary(self, last=30):
+        """ {id: {'cpu': [...], 'mem': [...]}} with the last samples of all watched tasks (for sparklines) """
+        with self._lock:
+            return {_id: {'cpu': s.ring.values('cpu', last), 'mem': s.ring.values('mem', last)}
+                    for _id, s in self._series.items()}
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.scan()
+            except Exception:
+                logging.exception("Reading the metrics failed")
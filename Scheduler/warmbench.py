@@ -0,0 +1,104 @@
+from urllib.parse import urlsplit, urlencode
+import http.client
+import statistics
+import argparse
+import hashlib
+import json
+import time
+
+"""
+Measurement of the start latency of tasks: from the submission until the notebook runs its first cell,
+against a running installation (website and scheduler).
+
+    python warmbench.py --url http://127.0.0.1:5000 [--tasks 20] [--interval 30] [--label warm]
+
+Run it once with 'warm=0' in the settings of the scheduler and once with 'warm' > 0 (the scheduler reads them
+at its start), the scheduler also reports both kinds as scheduler_start_latency_seconds{start="warm"|"cold"}.
+<tasks> notebooks (owner 'warmbench') are submitted one after the other with '/tasks/batch', every <interval>
+seconds, so a warm pool has the time to refill. The latency of a task is 'started' - 'submitted' of
+'/api/tasks': the scheduler sets 'started' when the notebook reports 'Running' (see status.py).
+Every notebook stops its Jupyter a few seconds after it started, so the task ends and frees its pod.
+"""
+
+OWNER = 'warmbench'
+# Ends the Jupyter server that is started after the notebook (see jupyter/entrypoint.sh)
+NOTEBOOK = '''import subprocess, sys
+subprocess.Popen([sys.executable, '-c', """
+import os, signal, time
+time.sleep(15)
+for pid in filter(str.isdigit, os.listdir('/proc')):
+    try:
+        if b'--port=8888' in open('/proc/%s/cmdline' % pid, 'rb').read():
+            os.kill(int(pid), signal.SIGTERM)
+    except OSError:
+        pass
+"""], start_new_session=True)
+print('warmbench')
+'''
+
+
+def request(connection, method, path, body=None, headers=None):
+    connection.request(method, path, body, headers or {})
+    response = connection.getresponse()
+    answer = response.read()
+    if response.status >= 400:
+        raise IOError("%s %s: %d %s" % (method, path, response.status, answer[:200]))
+    return json.loads(answer) if answer else None
+
+
+def submit(connection, digest):
+    spec = {'owner': OWNER, 'task_type': 'python', 'main': 'warmbench.py',
+            'files': [{'fullPath': 'warmbench.py', 'sha256': digest}], 'tasks': [{}]}
+    return request(connection, 'POST', '/tasks/batch', json.dumps(spec), {'Content-Type': 'application/json'})['ids'][0]
+
+
+def tasks(connection, ids):
+    """ {id: task} of the tasks <ids> (of the owner of the benchmark) """
+    found, cursor = {}, 0
+    while cursor is not None:
+        page = request(connection, 'GET', '/api/tasks?' + urlencode({'owner': OWNER, 'cursor': cursor}))
+        found.update({task['id']: task for task in page['tasks'] if task['id'] in ids})
+        cursor = page['next']
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help="address of the website")
+    parser.add_argument('--tasks', type=int, default=20)
+    parser.add_argument('--interval', type=float, default=30, help="seconds between two submissions")
+    parser.add_argument('--timeout', type=float, default=900, help="seconds to wait for the last task to start")
+    parser.add_argument('--label', default='', help="shown with the result (e.g. warm or cold)")
+    args = parser.parse_args()
+
+    parts = urlsplit(args.url)
+    connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+    data = NOTEBOOK.encode('utf-8')
+    digest = hashlib.sha256(data).hexdigest()
+    request(connection, 'PUT', '/blobs/%s' % digest, data)
+
+    ids = []
+    for i in range(args.tasks):
+        ids.append(submit(connection, digest))
+        print("Task %d submitted (%d of %d)" % (ids[-1], i + 1, args.tasks))
+        if i + 1 < args.tasks:
+            time.sleep(args.interval)
+    until = time.time() + args.timeout
+    while True:
+        found = tasks(connection, set(ids))
+        latencies = [task['started'] - task['submitted'] for task in found.values() if task.get('started')]
+        if len(latencies) == len(ids) or time.time() > until:
+            break
+        time.sleep(2)
+
+    print("%s %d of %d tasks started" % (args.label, len(latencies), len(ids)))
+    if latencies:
+        latencies.sort()
+        print("latency p50 %.1fs p95 %.1fs max %.1fs" % (statistics.median(latencies),
+                                                         latencies[min(len(latencies) - 1,
+                                                                       int(0.95 * len(latencies)))],
+                                                         latencies[-1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+from placement import Running, best_fit
+from jobspec import notebook_job
+from estimate import RuntimeSketch
+from mutations import apply_job, retrying
+from instrument import START_LATENCY_SECONDS
+from collections import deque
+import logging
+import random
+import shutil
+import string
+import math
+import os
+
+"""
+A pool of idle notebook pods that are started before they are needed.
+
+A warm pod runs the notebook image up to the point where it needs a task (Jupyter is initialised)
+and then waits for the file /scripts/.assigned. Its /scripts is a folder of its own, <root>/<job name>,
+so it sees nothing of other tasks or users. To assign a task the scheduler moves the files of the task
+into that folder and the folder to the place of the task (internal/<owner>/<id>, a rename: the mount of
+the pod follows it), labels the job and the pod with the id of the task, so they are treated like any
+other notebook job from then on, and writes owner, id, program and password (one per line) to /scripts/.assigned
+(Jupyter is then reached through the proxy).
+Warm pods have the default resources of the settings, only tasks that fit into them are assigned.
+-----
+The pool only uses capacity that nothing else waits for: it's refilled when the queue is empty
+and idle pods are deleted as soon as tasks wait that couldn't be placed.
+The size follows the arrival rate of tasks (Little's law): rate * time to start a warm pod + 1,
+but at most <size>.
+"""
+
+INTERNAL_DIR = '/mnt/internal'
+# The folders of the warm pods, in the scheduler and as subPath of the volume (see 'create')
+WARM_DIR = os.path.join(INTERNAL_DIR, '.warm')
+WARM_SUB_PATH = 'internal/.warm'
+ASSIGNED_FILE = '.assigned'
+# Label of warm pods and jobs, 'warm' while they are idle and 'assigned' once they run a task
+POOL_LABEL = 'pool'
+
+
+class WarmPool:
+    def __init__(self, size, request, root=WARM_DIR, internal=INTERNAL_DIR, window=3600, startup=60):
+        """
+        Input: size - maximum number of warm pods (0 = no pool)
+               request - Resources of a warm pod
+               root - the folders of the warm pods, internal - the folders of the tasks (<owner>/<id>)
+               window - the arrival rate is measured over this many seconds
+               startup - assumed time to start a warm pod (seconds) until one was measured
+        """
+        self.size = size
+        self.request = request
+        self.root = root
+        self.internal = internal
+        self.window = window
+        self.startup = startup
+        self.arrivals = deque()
+        self.last_id = 0
+        # job name -> time it was created, until its pod shows up
+        self.creating = {}
+        # id -> (pod name, time) of tasks that were just assigned, until the informers saw the new labels
+        self.bound = {}
+        self.measured = set()
+        # Submit to start of the notebook, for tasks started in a warm pod and in a new job (logged and in the
+        # metrics as scheduler_start_latency_seconds)
+        self.latency = {'warm': RuntimeSketch(), 'cold': RuntimeSketch()}
+        self.latency_seen = set()
+
+    def observe(self, rows, jobs):
+        """
+        Input: rows - the rows of the db that changed since the last update
+               jobs - all notebook jobs
+        -----
+        Count new tasks for the arrival rate and measure the latency of tasks that just started
+        """
+        assigned = {int(job.metadata.labels['id']) for job in jobs
+                    if job.metadata.labels.get(POOL_LABEL) == 'assigned'}
+        changed = False
+        for row in sorted(rows, key=lambda row: row['id']):
+            if row['id'] > self.last_id and row.get('submitted'):
+                self.arrivals.append(row['submitted'])
+                self.last_id = row['id']
+            if row['id'] not in self.latency_seen and row.get('started') and row.get('submitted'):
+                self.latency_seen.add(row['id'])
+                kind = 'warm' if row['id'] in assigned else 'cold'
+                self.latency[kind].add(row['started'] - row['submitted'])
+                START_LATENCY_SECONDS.labels(start=kind).observe(max(0, row['started'] - row['submitted']))
+                changed = True
+        if changed:
+            logging.info("Start latency (submit to first cell) %s" % self.latency_report())
+
+    def latency_report(self):
+        return " | ".join("%s: %d tasks, p50 %.1fs p95 %.1fs" %
+                          (kind, sketch.count, sketch.quantile(0.5) or 0, sketch.quantile(0.95) or 0)
+                          for kind, sketch in self.latency.items())
+
+    def target(self, now):
+        """ How many warm pods there should be """
+        while self.arrivals and self.arrivals[0] < now - self.window:
+            self.arrivals.popleft()
+        rate = len(self.arrivals) / self.window
+        return min(self.size, 1 + int(math.ceil(rate * self.startup)))
+
+    def pods(self, cache, now):
+        """ All warm pods that aren't being deleted, measures how long they took to start """
+        bound = {name for name, _ in self.bound.values()}
+        pods = [p for p in cache.warm_pods()
+                if p.metadata.deletion_timestamp is None and p.metadata.name not in bound]
+        for pod in pods:
+            job_name = pod.metadata.labels.get('job-name')
+            self.creating.pop(job_name, None)
+            statuses = pod.status.container_statuses or []
+            if job_name not in self.measured and statuses and statuses[0].state.running is not None:
+                self.measured.add(job_name)
+                startup = (statuses[0].state.running.started_at - pod.metadata.creation_timestamp).total_seconds()
+                self.startup = 0.8 * self.startup + 0.2 * max(startup, 0)
+        # Jobs that didn't get their pod in time failed
+        self.creating = {name: created for name, created in self.creating.items() if created > now - 120}
+        return pods
+
+    def binding(self, ids_kube, now):
+        """ Ids of tasks that were assigned to a warm pod but whose job isn't labeled in the cache yet """
+        self.bound = {_id: (name, t) for _id, (name, t) in self.bound.items()
+                      if _id not in ids_kube and t > now - 60}
+        return set(self.bound)
+
+    def idle(self, cache, now):
+        """ Warm pods that are ready to get a task """
+        return [p for p in self.pods(cache, now) if p.status.phase == 'Running' and p.spec.node_name]
+
+    def reserved(self, cache, now):
+        """
+        The resources held by warm pods as Running (they can be freed at any time, so they end now)
+        """
+        return [Running(None, p.spec.node_name, self.request, now, now)
+                for p in self.pods(cache, now) if p.spec.node_name]
+
+    def assign(self, batch_api_instance, core_api_instance, cache, queue, tasks, now, limit=None):
+        """
+        Input: queue - Pending tasks in the order they should start
+               tasks - {id: task} of all active tasks
+               limit - assign at most this many tasks (None = no limit)
+        -----
+        Start the first tasks of the queue that fit into a warm pod in them.
+        Returns [(Pending, node)] of the assigned tasks
+        """
+        idle = self.idle(cache, now)
+        assigned = []
+        for task in queue:
+            if not idle or (limit is not None and len(assigned) >= limit):
+                break
+            if not self.request.fits(task.request):
+                continue
+            pod = idle.pop(0)
+            info = tasks[task.id]
+            if self.bind(batch_api_instance, core_api_instance, pod, task.id, info['owner'],
+                         info['program'], info['pwd']):
+                self.bound[task.id] = (pod.metadata.name, now)
+                assigned.append((task, pod.spec.node_name))
+        return assigned
+
+    def bind(self, batch_api_instance, core_api_instance, pod, id, owner, program, pwd):
+        """ Give the task <id> to a warm pod, returns False if that didn't work """
+        job_name = pod.metadata.labels['job-name']
+        folder = os.path.join(self.internal, owner, str(id))
+        warm = os.path.join(self.root, job_name)
+        if any('\n' in str(field) for field in (owner, program, pwd)):
+            # Can't be written to .assigned (one field per line), the task gets a job of its own
+            logging.warning("Task %d can't be assigned to a warm pod: a line break in its fields" % id)
+            return False
+        if not os.path.isdir(warm):
+            # Its folder was removed, it could only get a task by seeing another folder
+            logging.warning("The warm pod %s has no folder %s" % (pod.metadata.name, warm))
+            self.delete(batch_api_instance, job_name)
+            return False
+        try:
+            hand_over(warm, folder)
+        except OSError as e:
+            logging.warning("Could not move task %d into the warm pod %s: %s" % (id, pod.metadata.name, e))
+            return False
+        body = {'metadata': {'labels': {'id': str(id), POOL_LABEL: 'assigned'}}}
+        try:
+            batch_api_instance.patch_namespaced_job(job_name, 'default', body)
+            core_api_instance.patch_namespaced_pod(pod.metadata.name, 'default', body)
+        except ApiException as e:
+            # The pod holds the folder of the task now, the task gets a job of its own instead
+            logging.warning("Could not assign task %d to the warm pod %s: %s" % (id, pod.metadata.name, e))
+            self.delete(batch_api_instance, job_name)
+            return False
+        # One field per line, the program may contain spaces
+        path = os.path.join(folder, ASSIGNED_FILE)
+        try:
+            with open(path + '.tmp', 'w') as f:
+                f.write("%s\n%d\n%s\n%s\n" % (owner, id, program, pwd))
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            # The pod would wait forever, the task gets a job of its own in the folder the pod leaves
+            logging.warning("Could not assign task %d to the warm pod %s: %s" % (id, pod.metadata.name, e))
+            self.delete(batch_api_instance, job_name)
+            return False
+        logging.info("Task %d started in the warm pod %s" % (id, pod.metadata.name))
+        return True
+
+    def maintain(self, batch_api_instance, cache, waiting, capacity, hostnames, occupied, now):
+        """
+        Input: waiting - Pending tasks that are still queued after this update
+               capacity, hostnames - the nodes (see schedule.node_resources)
+               occupied - Running tasks and warm pods
+        -----
+        Delete idle warm pods if tasks wait, otherwise fill the pool up to its target size
+        """
+        if waiting:
+            for pod in self.idle(cache, now):
+                self.delete(batch_api_instance, pod.metadata.labels['job-name'])
+            return
+
+        missing = self.target(now) - len(self.pods(cache, now)) - len(self.creating)
+        free = dict(capacity)
+        for r in occupied:
+            if r.node in free:
+                free[r.node] = free[r.node] - r.request
+        for _ in range(missing):
+            node = best_fit(self.request, free, capacity)
+            if node is None:
+                break
+            free[node] = free[node] - self.request
+            self.create(batch_api_instance, hostnames[node], now)
+
+    def cleanup(self, job_names):
+        """ Remove the folders of warm pods that don't exist anymore (those with a task were moved already) """
+        if not os.path.isdir(self.root):
+            return
+        for name in os.listdir(self.root):
+            if name not in job_names and name not in self.creating:
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+
+    def create(self, batch_api_instance, hostname, now):
+        """
+        Create a warm notebook job, the same as for a task (see jobspec.py) but with a folder of its own mounted
+        at /scripts (the task is only known later, see 'hand_over') and the env variable WARM_POOL
+        """
+        name = "notebook-warm-%s" % "".join(random.choice(string.ascii_lowercase + string.digits) for _ in range(6))
+        os.makedirs(os.path.join(self.root, name))
+        job = notebook_job(name, {POOL_LABEL: "warm"}, [client.V1EnvVar(name='WARM_POOL', value=name)], self.request,
+                           "%s/%s" % (WARM_SUB_PATH, name), hostname=hostname)
+        try:
+            apply_job(batch_api_instance, job)
+            self.creating[name] = now
+            logging.info("Warm pod %s created on %s" % (name, hostname))
+        except ApiException as e:
+            shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+            logging.warning("Exception when calling BatchV1Api->create_namespaced_job: %s\n" % e)
+
+    def delete(self, batch_api_instance, job_name):
+        try:
+            retrying('delete_namespaced_job', batch_api_instance.delete_namespaced_job,
+                     name=job_name,
+                     namespace="default",
+                     body=client.V1DeleteOptions(propagation_policy='Background', grace_period_seconds=5))
+            logging.info("Warm pod %s deleted, tasks are waiting" % job_name)
+        except ApiException as e:
+            logging.warning("Exception when calling BatchV1Api->delete_namespaced_job: %s\n" % e)
+
+
+def hand_over(warm, folder):
+    """
+    Move the files of the task in <folder> into the folder <warm> of a warm pod, then <warm> to the place of <folder>.
+    The pod mounted <warm> (a bind mount), it keeps it when it's renamed, so it gets exactly the folder of the task.
+    Raises OSError (the files that were moved are moved back)
+    """
+    if not os.path.isdir(warm):
+        raise FileNotFoundError("No folder %s" % warm)
+    moved = []
+    try:
+        for name in os.listdir(folder):
+            os.rename(os.path.join(folder, name), os.path.join(warm, name))
+            moved.append(name)
+        # Replaces the (now empty) folder of the task at once
+        os.rename(warm, folder)
+    except OSError:
+        for name in moved:
+            os.rename(os.path.join(warm, name), os.path.join(folder, name))
+        raise
@@ -1,7 +1,8 @@
 # Update Images
-sudo docker image build -t flask:1.0 flask/
-sudo docker image build -t scheduler:1.0 Scheduler/
+sudo docker image build -t flask:1.0 -f flask/Dockerfile .
+sudo docker image build -t scheduler:1.0 -f Scheduler/Dockerfile .
 sudo docker image build -t notebookserver:1.0 jupyter/
+sudo docker image build -t proxy:1.0 proxy/
 
 # Restart Server
 kubectl delete -f Kubernetes/frontend.yaml
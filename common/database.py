@@ -0,0 +1,83 @@
+from sqlalchemy import event
+from tracing import tracer
+import threading
+import time
+import os
+
+"""
+How the website (flask/store.py) and the scheduler (Scheduler/store.py) open the task database.
+
+Both use it in WAL mode, so reads never wait for the writes of the other process.
+Only two writers have to wait for each other, this time is measured in a LockStats.
+"""
+
+# How long to wait for a write lock (ms)
+BUSY_TIMEOUT = int(os.environ.get('DB_BUSY_TIMEOUT', 5000))
+
+
+class LockStats:
+    """
+    Time spent in write statements (which includes waiting for the write lock)
+    and how often the lock couldn't be acquired at all ('database is locked')
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.writes = 0
+        self.wait_total = self.wait_max = 0.0
+        self.locked = 0
+
+    def add(self, seconds):
+        with self._lock:
+            self.writes += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    def add_locked(self):
+        with self._lock:
+            self.locked += 1
+
+    def as_dict(self):
+        with self._lock:
+            return {'writes': self.writes, 'wait_total': self.wait_total,
+                    'wait_max': self.wait_max, 'locked': self.locked}
+
+    def __repr__(self):
+        with self._lock:
+            return "%d writes | lock wait total %.3fs max %.3fs | %d times locked" % \
+                   (self.writes, self.wait_total, self.wait_max, self.locked)
+
+
+def configure_sqlite(engine, stats, statement_seconds):
+    """
+    Set the pragmas for every new connection, measure all statements (in the histogram <statement_seconds>,
+    by their verb) and the lock wait of writes (in <stats>)
+    """
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA busy_timeout=%d" % BUSY_TIMEOUT)
+        cursor.close()
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def start_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def stop_timer(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info['query_start'].pop()
+        duration = time.perf_counter() - start
+        verb = statement.lstrip()[:6].upper()
+        statement_seconds.labels(statement=verb).observe(duration)
+        tracer.add('db ' + verb, start, duration)
+        if verb in ('INSERT', 'UPDATE', 'DELETE'):
+            stats.add(duration)
+
+    @event.listens_for(engine, 'handle_error')
+    def count_locked(context):
+        starts = context.connection.info.get('query_start') if context.connection is not None else None
+        if starts:
+            starts.pop()
+        if 'database is locked' in str(context.original_exception):
+            stats.add_locked()
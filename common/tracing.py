@@ -0,0 +1,135 @@
+import functools
+import threading
+import atexit
+import json
+import time
+import sys
+import os
+
+"""
+Timing of blocks as Prometheus histograms and spans, used by the website and the scheduler
+(each has its own histograms in its instrument.py). This folder is copied into both images
+(see flask/Dockerfile, Scheduler/Dockerfile), outside of them it has to be on PYTHONPATH.
+
+If TRACE_FILE is set every measurement is also written as a span to that file
+(Chrome trace event format, open it in chrome://tracing, Perfetto or speedscope or turn it
+into folded stacks for flamegraph.pl with 'python tracing.py <TRACE_FILE>').
+-----
+Spans are buffered and written in batches, without TRACE_FILE a measurement costs about 6µs.
+"""
+
+
+class Tracer:
+    """
+    Writes spans to <path> in the Chrome trace event format ('X' events, times in µs).
+    The file is a JSON array without the closing bracket, which all viewers accept,
+    so several processes can append to the same file.
+    """
+    def __init__(self, path=None, batch=512):
+        self.path = path
+        self.batch = batch
+        self._spans = []
+        self._lock = threading.Lock()
+        # Set again in forked processes (see flask/gunicorn.conf.py)
+        self.pid = os.getpid()
+        # perf_counter has no fixed origin, the spans are in unix time
+        self._offset = time.time() - time.perf_counter()
+        if path:
+            atexit.register(self.flush)
+
+    def add(self, name, start, duration, args=None):
+        """ start - time.perf_counter() at the start, duration in seconds """
+        if not self.path:
+            return
+        span = {'name': name, 'ph': 'X', 'ts': int(1e6 * (start + self._offset)), 'dur': int(1e6 * duration),
+                'pid': self.pid, 'tid': threading.get_ident()}
+        if args:
+            span['args'] = args
+        self._spans.append(span)
+        if len(self._spans) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            spans, self._spans = self._spans, []
+            if not spans:
+                return
+            data = "".join(json.dumps(span) + ",\n" for span in spans).encode('utf-8')
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            try:
+                # A single write, so the batches of several processes don't interleave
+                if os.fstat(fd).st_size == 0:
+                    data = b"[\n" + data
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+
+
+tracer = Tracer(os.environ.get('TRACE_FILE'))
+
+
+class timed:
+    """
+    Measure a block in <histogram> (with the given labels) and as span <name>:
+
+        with timed(FILE_SECONDS, 'blob link', operation='link'):
+            ...
+    The duration in seconds is kept in 'duration' afterwards.
+    """
+    __slots__ = ('metric', 'name', 'start', 'duration')
+
+    def __init__(self, histogram, name, **labels):
+        self.metric = histogram.labels(**labels) if labels else histogram
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.duration = time.perf_counter() - self.start
+        self.metric.observe(self.duration)
+        tracer.add(self.name, self.start, self.duration)
+
+
+def measured(histogram, name, **labels):
+    """ Decorator, measures every call of a function like 'timed' """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(histogram, name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def folded(path):
+    """
+    Turn a trace into folded stacks ('outer;inner <µs>' per line, the self time of every span),
+    the input of flamegraph.pl and speedscope
+    """
+    with open(path, 'r') as f:
+        text = f.read().strip().lstrip('[').rstrip(']').rstrip().rstrip(',')
+    spans = json.loads('[' + text + ']')
+    stacks = {}
+    threads = {}
+    for span in spans:
+        threads.setdefault((span['pid'], span['tid']), []).append(span)
+    for thread in threads.values():
+        # Parents start first and are longer, a span is inside every open span that ends after it
+        thread.sort(key=lambda s: (s['ts'], -s['dur']))
+        open_spans = []
+        for span in thread:
+            while open_spans and open_spans[-1]['ts'] + open_spans[-1]['dur'] <= span['ts']:
+                open_spans.pop()
+            if open_spans:
+                open_spans[-1]['child'] = open_spans[-1].get('child', 0) + span['dur']
+            open_spans.append(span)
+            span['stack'] = ";".join(s['name'] for s in open_spans)
+        for span in thread:
+            stacks[span['stack']] = stacks.get(span['stack'], 0) + max(span['dur'] - span.get('child', 0), 0)
+    return ["%s %d" % (stack, us) for stack, us in sorted(stacks.items())]
+
+
+if __name__ == '__main__':
+    print("\n".join(folded(sys.argv[1])))
@@ -1,67 +1,127 @@
-from flask import render_template, request, make_response, jsonify, Flask, flash, redirect, session
-from flask_sqlalchemy import SQLAlchemy
+from flask import render_template, request, make_response, jsonify, Flask, flash, redirect, session, send_file, \
+    send_from_directory, abort, Response, Markup
 from werkzeug.utils import secure_filename
 from flask_wtf import FlaskForm
-from wtforms import StringField, SelectField, IntegerField, MultipleFileField, validators
-
-from sqlalchemy import create_engine
-from sqlalchemy.orm import scoped_session, sessionmaker
-from sqlalchemy.ext.declarative import declarative_base
+from wtforms import StringField, SelectField, IntegerField, FloatField, MultipleFileField, BooleanField, validators
 
 import sys, traceback, os, shutil
-import socket
+from collections import Counter
+import tempfile
+import zipfile
+import functools
+import shlex
+import io
+import re
+import time
+import json
+import hashlib
 import logging
+import scheduler_client
 import nbformat as nbf
+from nbconvert import HTMLExporter
 from notebook.auth.security import passwd, passwd_check
-
-# Connect to database
-engine = create_engine('sqlite:////mnt/internal/queue.db', convert_unicode=True)
-db_session = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
-Base = declarative_base()
-Base.query = db_session.query_property()
-
-# Connection to Scheduler
-HOST = '127.0.0.1'
-PORT = 65432
+from store import engine, db_session, lock_stats, create_schema, active_tasks, finished_results, resource_suggestion, \
+    generation, Task
+from uploads import UploadSessions, UploadError, DEFAULT_CHUNK
+from blobs import BlobStore
+from archives import ArchiveStaging
+from registry import DatasetRegistry
+from logs import LogTails, RETRY
+from listing import Cached, LruCache
+from instrument import init_app, timed, CONVERSION_SECONDS
 
 # Flask settings
 app = Flask(__name__, template_folder='temp')
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////mnt/internal/queue.db'
 app.secret_key = "warumbraucheichdich"
 app.config['UPLOAD_FOLDER'] = '/mnt/data'
 app.config['PYTHONFILE_FOLDER'] = '/mnt/internal'
 
 # Database
-db = SQLAlchemy(app)
-Base.metadata.create_all(bind=engine)
+create_schema(engine)
 
 
-# Model (as used in the database)
-class Task(db.Model):
-    __tablename__ = "tasks"
- 
-    id = db.Column(db.Integer, primary_key=True)
-    owner = db.Column(db.String)
-    task_type = db.Column(db.String)
-    duration = db.Column(db.Integer)
-    program = db.Column(db.String)
-    status = db.Column(db.String)
-    pwd = db.Column(db.String)
- 
-    def __repr__(self):
-        return "%s - %10s - id: %s" % (self.owner, self.task_type, self.id)
+@app.teardown_appcontext
+def remove_session(exception=None):
+    """ Every request has a session of its own (per thread), its connection goes back to the pool at the end """
+    db_session.remove()
+
+
+# Timing of all requests and their steps, served on '/metrics' (see instrument.py)
+init_app(app)
+
+# Uploaded files are stored once by their SHA-256 (see blobs.py), one store per mount
+code_blobs = BlobStore(app.config['PYTHONFILE_FOLDER'])
+data_blobs = BlobStore(app.config['UPLOAD_FOLDER'])
+
+# The files of a task sent as one archive, extracted while they arrive (see archives.py)
+archives = ArchiveStaging(app.config['PYTHONFILE_FOLDER'], code_blobs)
+
+# Chunked uploads of datasets (see uploads.py)
+uploads = UploadSessions(app.config['UPLOAD_FOLDER'], data_blobs)
+
+# Catalogue of the datasets, CSVs can be converted to columns for the notebooks (see registry.py)
+registry = DatasetRegistry(app.config['UPLOAD_FOLDER'])
+
+# Shared by all viewers of the log of a task (see logs.py)
+log_tails = LogTails()
+
+# The list of tasks is read and rendered once per change of the tasks (see listing.py), the counter of changes
+# is read at most every second by the pages that ask for changes and what the scheduler and the logs say about
+# the tasks at most every LIVE seconds
+LIVE = 3
+current_generation = Cached(lambda _: generation(), max_age=1)
+task_rows = Cached(lambda _: ([task.to_dict() for task in active_tasks()],
+                               [task.to_dict() for task in finished_results()]))
+live_state = Cached(lambda gen: live_task_state(task_rows.get(gen)[0]), max_age=LIVE)
+task_list_html = Cached(lambda key, state: render_task_list(key[1], state))
+# Pages of '/api/tasks', tasks per page (default and most)
+api_pages = LruCache(256)
+API_PAGE = 100
+MAX_API_PAGE = 1000
+
+# Most tasks added at once by '/tasks/batch' and the names their environment variables may have
+MAX_BATCH = 5000
+ENV_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+RESERVED_ENV = {'PY_FILE', 'JUPYTER_PWD', 'WARM_POOL', 'OWNER', 'ID', 'PATH', 'HOME', 'PYTHONPATH',
+                'JOB_COMPLETION_INDEX', 'ARRAY_SIZE'}
+
+# Most indexes of an array task, their parameters can be given in this file of the task
+# (a list, see jupyter/array_index.py)
+MAX_ARRAY = 10000
+SWEEP_FILE = 'sweep.json'
+
+# All files of a task with their SHA-256, written by the website (see 'list_files')
+FILES_LIST = '.files.json'
+
+# Written by all tasks while they run (see jupyter/batch.py), the viewer shows at most its end and the start page less
+LOG_FILE = 'output.log'
+LOG_TAIL = 64 * 1024
+INDEX_TAIL = 1024
+# Outputs of notebooks may contain scripts, they run in a sandbox (without access to the website)
+SANDBOX = {'Content-Security-Policy': 'sandbox allow-scripts allow-popups'}
 
 
 # Forms
 class TaskForm(FlaskForm):
     # For adding Tasks
     supported_tasks = [('python', 'Python file(s)'), ('jupyter_notebook', 'Jupyter Notebook'),
-                       ('empty_notebook', 'Empty Notebook')]
+                       ('empty_notebook', 'Empty Notebook'), ('array', 'Array (Python file(s) or Notebook per index)'),
+                       ('script', 'Python script (run directly, without Jupyter)')]
     task_type = SelectField('Task', choices=supported_tasks)
     owner = StringField('Ersteller', validators=[validators.Optional()])
     duration = IntegerField('geschätzte Dauer in Minuten', validators=[validators.Optional()])
     files = MultipleFileField('Program / Module')
     main = StringField('Name of main if many files', validators=[validators.Optional()])
+    cpu = FloatField('CPU Kerne', validators=[validators.Optional(), validators.NumberRange(min=0.1)])
+    mem = IntegerField('RAM in MiB', validators=[validators.Optional(), validators.NumberRange(min=100)])
+    gpu = IntegerField('GPUs', validators=[validators.Optional(), validators.NumberRange(min=0)])
+    priority = IntegerField('Priorität (0 - 10)', validators=[validators.Optional(), validators.NumberRange(min=0, max=10)])
+    array_size = IntegerField('Array: Anzahl Indizes', validators=[validators.Optional(),
+                                                                    validators.NumberRange(min=1, max=MAX_ARRAY)])
+    parallelism = IntegerField('Array: davon gleichzeitig', validators=[validators.Optional(),
+                                                                        validators.NumberRange(min=1)])
+    headless = BooleanField('Ohne Jupyter ausführen (Batch, Ergebnisse auf der Website)')
+    datasets = StringField('Datensätze (Namen, mit Komma getrennt)', validators=[validators.Optional()])
 
 
 class PwdForm(FlaskForm):
@@ -83,45 +143,406 @@ def index():
     """
     # Start Session
     session['status'] = True
-    session['files'] = []
-
-    # Update Scheduler and let it add all current tasks to the database
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.connect((HOST, PORT))
-        s.sendall(b'update')
-        # Wait for a response of the Scheduler.
-        # This adds stability and should guarantee that all tasks are shown.
-        # Can be commented out to improve the loading speed of the website.
-        s.recv(1024)
-
-    # Get all current tasks
-    qry = db_session.query(Task)
-    results = qry.all()
-    task_list = [vars(task) for task in results]
-    for task in task_list:
-        task['duration'] = int(task['duration'])
-            
-    return render_template('index.html', taskList=task_list)
+    session['manifest'] = None
+    session['staged'] = None
+
+    # The scheduler keeps the database up to date by itself, so there is no need to wait for it
+    # Get all current tasks (with the expected start and end of queued ones and the usage of the running ones)
+    etag, fragment = task_list_fragment(generation())
+    return render_template('index.html', task_list=Markup(fragment), etag=etag)
+
+
+@app.route("/tasks/list")
+def task_list():
+    """
+    The list of tasks of the start page (HTML), which asks for it every few seconds.
+    The answer is 304 as long as nothing in it changed ('If-None-Match' with its ETag)
+    """
+    etag, fragment = task_list_fragment(current_generation.get())
+    response = make_response(fragment)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+
+def task_list_fragment(gen):
+    """
+    Returns (ETag, HTML) of the list of tasks for the change <gen> of the tasks, the tasks are read
+    and the list is rendered only if something in it changed (see listing.py)
+    """
+    digest, state = live_state.get(gen)
+    etag = "%d-%s" % (gen, digest)
+    # Rendered from the state the ETag was made from
+    return etag, task_list_html.get((etag, gen), state)
+
+
+def render_task_list(gen, state):
+    tasks, results = task_rows.get(gen)
+    return render_template('tasklist.html', taskList=[dict(task, **state.get(task['id'], {})) for task in tasks],
+                           results=results)
+
+
+def live_task_state(tasks):
+    """
+    What isn't in the database about the <tasks>: the expected start and end of queued ones (from the scheduler),
+    the progress of arrays, the end of the log and the resource usage of running ones.
+    Returns (hash, {id: {field: value}})
+    """
+    etas = scheduler_client.eta()
+    usage = scheduler_client.metrics()
+    state = {}
+    for task in tasks:
+        fields = {}
+        if task['id'] in etas:
+            fields['eta_start'], fields['eta_end'] = [format_time(t) for t in etas[task['id']]]
+        if task['task_type'] == 'array' and task['array_size']:
+            counts = Counter(status for status, _ in array_status(task['owner'], task['id'], task['array_size']))
+            fields['array'] = "%d/%d fertig, %d laufen, %d fehlgeschlagen" % \
+                (counts['Finished'], task['array_size'], counts['Running'], counts['Failed'])
+        if task['status'] in ('Running', 'Finished', 'Failed'):
+            fields['log'] = log_tails.tail(os.path.join(app.config['PYTHONFILE_FOLDER'], task['owner'], str(task['id']),
+                                                        LOG_FILE), INDEX_TAIL)
+        if usage.get(task['id'], {}).get('cpu'):
+            series = usage[task['id']]
+            fields['cpu_now'], fields['mem_now'] = series['cpu'][-1], series['mem'][-1]
+            fields['cpu_line'], fields['mem_line'] = sparkline(series['cpu']), sparkline(series['mem'])
+        if fields:
+            state[task['id']] = fields
+    return hashlib.sha256(json.dumps(state, sort_keys=True).encode('utf-8')).hexdigest()[:16], state
+
+
+@app.route("/api/tasks")
+def api_tasks():
+    """
+    The tasks as JSON, ordered by id: {"tasks": [...], "next": cursor of the next page or null,
+    "generation": counter of the changes of the tasks}
+    Parameters (all optional):
+    'owner', 'status' - only tasks of this owner / with these statuses (separated by commas)
+    'since' - only tasks changed after this generation (to follow the changes)
+    'cursor' - the 'next' of the previous page, 'limit' - tasks per page (API_PAGE, at most MAX_API_PAGE)
+    -----
+    The ETag is the generation, the answer is 304 as long as no task changed ('If-None-Match').
+    Pages are cached (per process) until then
+    """
+    try:
+        statuses = tuple(sorted(s for s in request.args.get('status', '').split(',') if s))
+        since = int(request.args['since']) if request.args.get('since') else None
+        cursor = int(request.args.get('cursor') or 0)
+        limit = min(max(int(request.args.get('limit') or API_PAGE), 1), MAX_API_PAGE)
+    except ValueError:
+        abort(make_response(jsonify({"message": "Invalid since, cursor or limit"}), 400))
+    gen = current_generation.get()
+    etag = "tasks-%d" % gen
+    if request.if_none_match.contains(etag):
+        return "", 304, {'ETag': '"%s"' % etag, 'Cache-Control': 'no-cache'}
+    key = (gen, request.args.get('owner'), statuses, since, cursor, limit)
+    body = api_pages.get(key)
+    if body is None:
+        query = Task.query.filter(Task.id > cursor)
+        if request.args.get('owner'):
+            query = query.filter(Task.owner == request.args['owner'])
+        if statuses:
+            query = query.filter(Task.status.in_(statuses))
+        if since is not None:
+            query = query.filter(Task.seq > since)
+        rows = query.order_by(Task.id).limit(limit + 1).all()
+        tasks = [{k: v for k, v in task.to_dict().items() if k != 'pwd'} for task in rows[:limit]]
+        body = json.dumps({"tasks": tasks, "next": str(rows[limit - 1].id) if len(rows) > limit else None,
+                           "generation": gen})
+        api_pages.put(key, body)
+    response = make_response(body)
+    response.mimetype = 'application/json'
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def format_time(timestamp):
+    """ Time of day, with the date if it's not today """
+    t = time.localtime(timestamp)
+    if t[:3] == time.localtime()[:3]:
+        return time.strftime('%H:%M', t)
+    return time.strftime('%d.%m. %H:%M', t)
+
+
+def sparkline(values, width=120, height=24):
+    """ Points of an SVG polyline for the values (scaled to their maximum) """
+    values = [max(v, 0) for v in values]
+    top = max(values) or 1
+    step = width / max(len(values) - 1, 1)
+    return " ".join("%.1f,%.1f" % (i * step, height - height * v / top) for i, v in enumerate(values))
+
+
+@app.route("/tasks/<int:task_id>/metrics")
+def task_metrics(task_id):
+    """
+    Resource usage of a task over time, measured by the scheduler (see Scheduler/telemetry.py):
+    {"time": [...], "cpu": [cores], "mem": [MiB], "read"/"write": [MB/s], "gpu": [%], "gpu_mem": [MiB],
+    "peaks": {...}}, -1 where a value isn't available. Optional parameter 'last' (number of samples).
+    For older tasks only the peaks from the db are known.
+    """
+    task = Task.query.get(task_id)
+    if task is None:
+        return make_response(jsonify({"message": "Unknown task %d" % task_id}), 404)
+    series = scheduler_client.metrics(task_id, request.args.get('last', type=int))
+    if series is None:
+        series = {'peaks': {'cpu': task.peak_cpu, 'mem': task.peak_mem}}
+    series['request'] = {'cpu': task.cpu, 'mem': task.mem, 'gpu': task.gpu}
+    return jsonify(series)
+
+
+@app.route("/tasks/suggest")
+def suggest_resources():
+    """
+    Suggested CPU and memory for a new task of 'owner' and 'task_type',
+    from the peak usage of its previous tasks (empty if there aren't enough)
+    """
+    owner = secure_filename(request.args.get('owner', '')) or "dfki"
+    return jsonify(resource_suggestion(owner, request.args.get('task_type', 'python')) or {})
+
+
+@app.route("/tasks/<int:task_id>/array")
+def task_array(task_id):
+    """
+    Status of the indexes of an array task:
+    {"size", "parallelism", "counts": {status: number}, "indexes": [{"index", "status", "since"}]}
+    """
+    task = Task.query.get(task_id)
+    if task is None or task.task_type != 'array':
+        return make_response(jsonify({"message": "No array task %d" % task_id}), 404)
+    statuses = array_status(task.owner, task.id, task.array_size)
+    return jsonify({"size": task.array_size, "parallelism": task.parallelism, "status": task.status,
+                    "counts": Counter(status for status, _ in statuses),
+                    "indexes": [{"index": i, "status": status, "since": since}
+                                for i, (status, since) in enumerate(statuses)]})
+
+
+@app.route("/tasks/<int:task_id>/results")
+def task_results(task_id):
+    """
+    The results of an array task as zip: the folders of all indexes that are finished so far
+    (their executed notebook and everything they wrote), also while others still run
+    """
+    task = Task.query.get(task_id)
+    if task is None or task.task_type != 'array':
+        return make_response(jsonify({"message": "No array task %d" % task_id}), 404)
+    directory = os.path.join(app.config['PYTHONFILE_FOLDER'], task.owner, str(task.id))
+    results = tempfile.TemporaryFile()
+    with zipfile.ZipFile(results, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for index, (status, _) in enumerate(array_status(task.owner, task.id, task.array_size)):
+            if status != 'Finished':
+                continue
+            for root, _, names in os.walk(os.path.join(directory, str(index))):
+                for name in names:
+                    if not name.startswith('.'):
+                        path = os.path.join(root, name)
+                        archive.write(path, os.path.relpath(path, directory))
+    results.seek(0)
+    return send_file(results, mimetype='application/zip', as_attachment=True,
+                     attachment_filename="task-%d-results.zip" % task.id)
+
+
+@app.route("/tasks/<int:task_id>/view")
+def task_view(task_id):
+    """
+    The shared viewer of results (instead of a notebook server per task): the executed notebook,
+    the end of the log (followed live while the task runs) and all files the task wrote
+    """
+    task = Task.query.get(task_id)
+    if task is None:
+        abort(404)
+    directory = os.path.join(app.config['PYTHONFILE_FOLDER'], task.owner, str(task.id))
+    log, log_end = None, 0
+    try:
+        with open(os.path.join(directory, LOG_FILE), 'rb') as f:
+            f.seek(max(0, os.fstat(f.fileno()).st_size - LOG_TAIL))
+            data = f.read()
+            log, log_end = data.decode('utf-8', 'replace'), f.tell()
+    except OSError:
+        pass
+    files = []
+    for root, dirs, names in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for name in sorted(names):
+            if not name.startswith('.'):
+                path = os.path.join(root, name)
+                files.append((os.path.relpath(path, directory), os.path.getsize(path)))
+    notebook = (task.program or '').endswith('.ipynb') and os.path.isfile(os.path.join(directory, task.program))
+    return render_template('view.html', task=task, log=log, log_end=log_end, files=files, notebook=notebook,
+                           retry=RETRY)
+
+
+@app.route("/tasks/<int:task_id>/log")
+def task_log(task_id):
+    """
+    The output of a task as Server-Sent Events, live while it runs (see logs.py).
+    It starts at the byte offset 'offset' or 'Last-Event-ID' (sent by browsers when they reconnect),
+    without either at the last 64 KiB. 'index' - the log of this index of an array task (400 if it isn't one).
+    503 if the worker streams as many logs as it may already, the client tries again after 'Retry-After' seconds
+    """
+    task = Task.query.get(task_id)
+    if task is None:
+        abort(404)
+    directory = os.path.join(app.config['PYTHONFILE_FOLDER'], task.owner, str(task.id))
+    if request.args.get('index') is not None:
+        index = request.args.get('index', type=int)
+        if index is None or index < 0:
+            abort(400, "index must be a number")
+        directory = os.path.join(directory, str(index))
+    offset = request.headers.get('Last-Event-ID') or request.args.get('offset')
+    offset = int(offset) if offset and offset.isdigit() else None
+    if not log_tails.reserve():
+        return Response("retry: %d\n\n" % (RETRY * 1000), 503, mimetype='text/event-stream',
+                        headers={'Retry-After': str(RETRY), 'Cache-Control': 'no-cache'})
+    stream = log_tails.stream(os.path.join(directory, LOG_FILE), os.path.join(directory, '.status'), offset,
+                              done=task.status in ('Done', 'Failed'))
+    # The stream can take minutes, it must not keep a connection of the pool
+    db_session.remove()
+    # No buffering by proxies, the events have to arrive when they are sent
+    response = Response(stream, mimetype='text/event-stream', headers={'Cache-Control': 'no-cache',
+                                                                       'X-Accel-Buffering': 'no'})
+    # Also if the stream never started (the client was gone already)
+    response.call_on_close(log_tails.release)
+    return response
+
+
+@app.route("/tasks/<int:task_id>/route")
+def task_route(task_id):
+    """
+    Where the proxy sends '/nb/<id>/' (see proxy/nginx.conf, it asks before every request and keeps the answer
+    for a few seconds): the address of the Jupyter server in the header 'X-Notebook'.
+    403 if the task has none (yet, Jupyter starts when the notebook has finished), the proxy then shows the viewer
+    of the task instead
+    """
+    task = Task.query.get(task_id)
+    address = None
+    if task is not None and task.status == 'Finished' and task.task_type != 'array' and not task.headless:
+        address = scheduler_client.route(task_id)
+    if address is None:
+        return "", 403
+    return "", 200, {'X-Notebook': address}
+
+
+@app.route("/tasks/<int:task_id>/notebook")
+def task_notebook(task_id):
+    """ The (executed) notebook of a task as HTML, shown by the viewer """
+    task = Task.query.get(task_id)
+    if task is None or not (task.program or '').endswith('.ipynb'):
+        abort(404)
+    path = os.path.join(app.config['PYTHONFILE_FOLDER'], task.owner, str(task.id), task.program)
+    try:
+        html = notebook_html(path, os.stat(path).st_mtime_ns)
+    except FileNotFoundError:
+        abort(404)
+    return html, 200, SANDBOX
+
+
+@functools.lru_cache(maxsize=32)
+def notebook_html(path, mtime):
+    """ The notebook at <path> as HTML, converted again only if it changed (<mtime>) """
+    with timed(CONVERSION_SECONDS, 'notebook to html', kind='html'):
+        return HTMLExporter().from_filename(path)[0]
+
+
+@app.route("/tasks/<int:task_id>/files/<path:name>")
+def task_file(task_id, name):
+    """ A file of a task (not the hidden ones, e.g. its environment) """
+    task = Task.query.get(task_id)
+    if task is None or any(part.startswith('.') for part in name.split('/')):
+        abort(404)
+    response = send_from_directory(os.path.join(app.config['PYTHONFILE_FOLDER'], task.owner, str(task.id)), name)
+    response.headers.extend(SANDBOX)
+    return response
+
+
+@app.route("/tasks/eta")
+def task_etas():
+    """
+    Expected start and end (unix time) of all queued tasks, predicted by the scheduler
+    from the runtimes of finished tasks
+    """
+    return jsonify({str(_id): {'start': start, 'end': end} for _id, (start, end) in scheduler_client.eta().items()})
+
+
+@app.route("/blobs/missing", methods=["POST"])
+def missing_blobs():
+    """
+    Which files have to be uploaded at all.
+    Expects JSON {"hashes": [SHA-256 of the files], "store": "code" (default, for tasks) or "data"},
+    returns {"missing": [the hashes that aren't stored yet]}
+    """
+    data = request.get_json(force=True, silent=True) or {}
+    blobs = data_blobs if data.get('store') == 'data' else code_blobs
+    return jsonify({"missing": blobs.missing([str(h).lower() for h in data.get('hashes') or []])})
+
+
+@app.route("/blobs/<digest>", methods=["PUT"])
+def put_blob(digest):
+    """ Upload one file of a task, the body is the raw data and has to match the SHA-256 <digest> """
+    if code_blobs.has(digest):
+        return jsonify({"sha256": digest.lower()})
+    code_blobs.add_stream(request.stream, digest)
+    return make_response(jsonify({"sha256": digest.lower()}), 201)
 
 
 @app.route('/dropzone', methods=['POST'])
 def handle_drop():
     """
-    Handle uploads from the dropzone and save them in a folder for later use/moving
+    Handle uploads from the dropzone and store them by their SHA-256 for '/addtask'
     Is only used internally by '/addtask'
+
+    If the field 'manifest' lists all files of the task as JSON [{"fullPath", "sha256"}],
+    only those the server doesn't have yet (see '/blobs/missing') have to be sent
     """
-    session['files'] = []
+    session['manifest'] = None
+    session['staged'] = None
     session['status'] = False
+    files = []
     for key, f in request.files.items():
         if key.startswith('file'):
             logging.info("%s uploaded over dropzone" % f.filename)
             i = int(key.split("[")[-1].strip("]"))
-            f.save(os.path.join(app.config['PYTHONFILE_FOLDER'], secure_filename(f.filename)))
-            session['files'] = session['files'] + [(secure_filename(f.filename), request.form['fullPath_%d' % i])]
+            digest = code_blobs.add_stream(f.stream, request.form.get('sha256_%d' % i))
+            files.append((secure_filename(f.filename), request.form['fullPath_%d' % i], digest))
+    if request.form.get('manifest'):
+        try:
+            manifest = [(secure_filename(os.path.basename(m['fullPath'])), m['fullPath'], m['sha256'].lower())
+                        for m in json.loads(request.form['manifest'])]
+        except (ValueError, TypeError, KeyError, AttributeError):
+            raise UploadError("Invalid manifest")
+        missing = code_blobs.missing([digest for _, _, digest in manifest])
+        if missing:
+            raise UploadError("Files are missing: %s" % ", ".join(missing), 409)
+        logging.info("%d of %d files were stored already" % (len(manifest) - len(files), len(manifest)))
+        files = manifest
+    session['manifest'] = code_blobs.save_manifest(files)
     session['status'] = True
+    code_blobs.collect(referenced=task_blobs)
     return '', 204
 
 
+@app.route('/dropzone/archive', methods=['POST'])
+def handle_archive():
+    """
+    Upload all files of a task as one archive for '/addtask', instead of one by one to '/dropzone'.
+    The body is a tar (also compressed) or zip, its folder structure is kept like the 'fullPath' of the dropzone
+    (e.g. 'tar -c proj | curl --data-binary @- -H "Content-Type: application/x-tar" ...').
+    The tar is extracted while it is received, '/addtask' then moves the extracted folder in place at once.
+    Returns {"files": number of files}
+    """
+    session['manifest'] = None
+    session['staged'] = None
+    session['status'] = False
+    archives.cleanup()
+    token, files = archives.extract(request.stream)
+    logging.info("%d files uploaded as archive" % len(files))
+    session['manifest'] = code_blobs.save_manifest(files)
+    session['staged'] = token
+    session['status'] = True
+    code_blobs.collect(referenced=task_blobs)
+    return jsonify({"files": len(files)})
+
+
 @app.route("/addtask", methods=["GET", "POST"])
 def add_task():
     """
@@ -142,132 +563,423 @@ def add_task():
     form = TaskForm()
         
     if form.validate_on_submit():
+        # The datasets are copied to the node of the task before it starts
+        try:
+            datasets = task_datasets(form.datasets.data)
+        except ValueError as e:
+            flash(str(e))
+            return redirect("/addtask")
+
         # save to queue
         task = Task()
         task.owner = secure_filename(form.owner.data) or "dfki"
         task.task_type = form.task_type.data
         task.duration = form.duration.data or 0
         task.status = 'Ready'
+        task.cpu = form.cpu.data
+        task.mem = form.mem.data
+        task.gpu = form.gpu.data
+        # Without a request use what the previous tasks of the user needed (instead of the default of the scheduler)
+        suggestion = resource_suggestion(task.owner, task.task_type)
+        if suggestion is not None:
+            task.cpu = task.cpu or suggestion['cpu']
+            task.mem = task.mem or suggestion['mem']
+        task.priority = form.priority.data or 0
+        task.submitted = time.time()
+        task.headless = runs_headless(task.task_type, form.headless.data)
+        task.datasets = datasets
 
-        # Ugly but finds next id
-        qry = db_session.query(Task)
-        results = qry.all()
-        logging.info([vars(task) for task in results])
-        task.id = max([int(vars(task)['id']) for task in results], default=0) + 1
-        logging.info(task.id)
-        
-        # Save Script in folder of User
-        directory = os.path.join(app.config['PYTHONFILE_FOLDER'], task.owner)
-        # if new user: build folder and init standard pwd (same as Username)
-        if not os.path.exists(directory):
-            logging.info("Making Account for %s" % task.owner)
-            os.makedirs(directory)
-            with open(os.path.join(directory, "pwd"), "w+") as pwd:
-                pwd.write(passwd(task.owner))
-        with open(os.path.join(directory, "pwd"), "r") as pwd:
-            task.pwd = pwd.read()
-
-        # Place in sub folder of id
-        directory = os.path.join(directory, str(task.id))
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-        else:
-            # Delete previous files in this folder
-            for f in os.listdir(directory):
-                file_path = os.path.join(directory, f)
-                try:
-                    if os.path.isfile(file_path) or os.path.islink(file_path):
-                        os.unlink(file_path)
-                    elif os.path.isdir(file_path):
-                        shutil.rmtree(file_path)
-                except Exception as e:
-                    flash('Failed to delete %s. Reason: %s - This should never happen!' % (file_path, e))
-                    return redirect("/addtask")
-
-        # Create empty notebook if none is given
-        if task.task_type == 'empty_notebook':
-            nb = nbf.v4.new_notebook()
-            nbf.write(nb, os.path.join(directory, "test.ipynb"))
-            task.program = "test.ipynb"
-            found = True
-
-        # Handle uploaded Files
-        else:
-            # Try to find the main
-            task.program = form.main.data if form.main.data.endswith('.py') else form.main.data + ".py"
-            found = False
-            last = None
+        # Save Script in folder of User (if new user: build folder and init standard pwd)
+        task.pwd = user_pwd(task.owner)
 
+        files = []
+        if task.task_type != 'empty_notebook':
+            files = code_blobs.load_manifest(session.get('manifest')) or []
             if session['status'] is False:
                 # Should never happen
                 flash("Session was not ready (Files are still uploading")
                 return redirect("/addtask")
-            elif len(session['files']) == 0:
+            elif len(files) == 0:
                 flash("Select a file")
                 return redirect("/addtask")
-            else:
-
-                # Get rid of folder where files were in by stepping into the common prefix
-                prefix = os.path.commonpath([path for _, path in session['files']])\
-                    if len(session['files']) >= 2 else ""
-
-                for file, fullPath in session['files']:
-                    relpath = os.path.relpath(fullPath, prefix)
-
-                    last = relpath
-                    if file == task.program or relpath == task.program:
-                        found = True
-                        task.program = relpath
-
-                    try:
-                        # Rebuild the client-side folder structure
-                        loc = os.path.join(directory, os.path.dirname(relpath))
-                        if not os.path.exists(loc):
-                            os.makedirs(loc)
-                        os.replace(os.path.join(app.config['PYTHONFILE_FOLDER'], file),
-                                   os.path.join(directory, relpath))
-                    # When no file was provided
-                    except IsADirectoryError:
-                        flash("Select a file")
-                        return redirect("/addtask")
-
-        # Use last file uploaded if no main is found
-        if not found:
-            task.program = last
-
-        # Convert only main to a notebook if not already
-        if task.task_type == 'python':
-            main_path = os.path.join(directory, task.program)
-            nb = nbf.v4.new_notebook()
 
-            with open(main_path) as f:
-                code = f.read()
+        try:
+            task.program, entries = bundle(files, form.main.data, task.task_type)
+        # When no file was provided
+        except IsADirectoryError:
+            flash("Select a file")
+            return redirect("/addtask")
+        if task.task_type == 'script' and not task.program.endswith('.py'):
+            flash("A script has to be a .py file")
+            return redirect("/addtask")
 
-            nb.cells.append(nbf.v4.new_code_cell(code))
-            nbf.write(nb, main_path.replace('.py', '.ipynb'))
-            os.remove(main_path)
-            task.program = task.program.replace('.py', '.ipynb')
+        # An array task runs once per index (of the form or of the entries in the sweep file)
+        if task.task_type == 'array':
+            task.array_size = form.array_size.data or sweep_size(entries)
+            task.parallelism = form.parallelism.data
+            if not task.array_size:
+                flash("Give the number of indexes or a %s with a list" % SWEEP_FILE)
+                return redirect("/addtask")
 
-        # Add task to database
+        # Only a valid task gets its files, the files of an archive can only be moved in place once.
+        # They go to a folder of their own as long as the task has no id: the id comes with the write lock
+        # of the database, which is only taken once all files are in place
+        folder = new_task_folder(task.owner)
+        try:
+            # Files uploaded as an archive are moved in place at once
+            rest = place_staged(session.get('staged'), files, entries, folder)
+            session['staged'] = None
+            materialize(folder, rest)
+            list_files(folder, entries)
+        except IsADirectoryError:
+            shutil.rmtree(folder, ignore_errors=True)
+            flash("Select a file")
+            return redirect("/addtask")
+
+        # Get the next id from the database (ids are never reused) and add the task to it
         db_session.add(task)
-        db_session.commit()
+        try:
+            db_session.flush()
+            move_task_folder(folder, task.owner, task.id)
+            db_session.commit()
+        except Exception:
+            db_session.rollback()
+            shutil.rmtree(folder, ignore_errors=True)
+            raise
+        logging.info("New task %d" % task.id)
+        current_generation.invalidate()
 
         # Update Scheduler and let it start the task when the queue is empty
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((HOST, PORT))
-            s.sendall(b'update')
-            # Wait for a response of the Scheduler.
-            # This adds stability.
-            # Can be commented out to improve the loading speed of the website.
-            data = s.recv(1024)
-
-        logging.info('Received status: %s' % data.decode('utf-8'))
+        # It only acknowledges the update, use 'scheduler_client.wait_for' to wait for the reconcile
+        generation = scheduler_client.notify_update()
+        logging.info('Task %d will be scheduled in reconcile %s' % (task.id, generation))
         
         return redirect('/')
  
     return render_template('addtask.html', form=form)
 
 
+@app.route("/tasks/batch", methods=["POST"])
+def add_tasks():
+    """
+    Add many tasks with the same files at once (e.g. a parameter sweep).
+    Expects JSON (or a multipart form with the JSON in the field 'spec' and the files like '/dropzone'):
+    {"owner", "task_type", "main", "duration", "cpu", "mem", "gpu", "priority", "headless",
+     "datasets" (list of names) - as in '/addtask', for all tasks
+     "manifest": "session" - the files sent to '/dropzone' before, or "files": [{"fullPath", "sha256"}] of stored
+     files (see '/blobs/missing'),
+     "tasks": [{"params": {...}, "env": {"NAME": "value"}, and any of the settings above but owner/task_type}]}
+    Every task gets its params as 'params.json' and its env as environment of the notebook.
+    -----
+    The files are placed once per task as copies (reflinks where possible), the notebook is converted once.
+    All tasks are inserted in one transaction and the scheduler is notified once.
+    Returns {"ids": [...], "generation": <reconcile that will include them>}
+    """
+    if request.files or request.form:
+        try:
+            spec = json.loads(request.form.get('spec') or '{}')
+        except ValueError:
+            raise UploadError("Invalid spec")
+    else:
+        spec = request.get_json(force=True, silent=True)
+    if not isinstance(spec, dict) or not isinstance(spec.get('tasks'), list) or not spec['tasks']:
+        raise UploadError("A list of tasks is missing")
+    if len(spec['tasks']) > MAX_BATCH:
+        raise UploadError("At most %d tasks per batch" % MAX_BATCH, 413)
+    owner = secure_filename(spec.get('owner') or '') or "dfki"
+    task_type = spec.get('task_type', 'python')
+    if task_type not in [t for t, _ in TaskForm.supported_tasks]:
+        raise UploadError("Unknown task type %s" % task_type)
+
+    # The files of the batch: uploaded with it, by '/dropzone' or stored already
+    files = []
+    for key, f in request.files.items():
+        if key.startswith('file'):
+            i = int(key.split("[")[-1].strip("]"))
+            files.append((secure_filename(f.filename), request.form['fullPath_%d' % i],
+                          code_blobs.add_stream(f.stream, request.form.get('sha256_%d' % i))))
+    if spec.get('manifest') == 'session':
+        files += code_blobs.load_manifest(session.get('manifest')) or []
+    elif spec.get('files'):
+        try:
+            files += [(secure_filename(os.path.basename(f['fullPath'])), f['fullPath'], f['sha256'].lower())
+                      for f in spec['files']]
+        except (TypeError, KeyError, AttributeError):
+            raise UploadError("Invalid list of files")
+    missing = code_blobs.missing([digest for _, _, digest in files])
+    if missing:
+        raise UploadError("Files are missing: %s" % ", ".join(missing), 409)
+    if not files and task_type != 'empty_notebook':
+        raise UploadError("Select a file")
+    program, entries = bundle(files, spec.get('main') or '', task_type)
+    if task_type == 'script' and not program.endswith('.py'):
+        raise UploadError("A script has to be a .py file")
+
+    pwd = user_pwd(owner)
+    suggestion = resource_suggestion(owner, task_type) or {}
+    now = time.time()
+    tasks = []
+    for i, item in enumerate(spec['tasks']):
+        item = dict(spec, **item) if isinstance(item, dict) else None
+        try:
+            env = {str(k): str(v) for k, v in (item.get('env') or {}).items()}
+            if not all(ENV_NAME.match(k) and k not in RESERVED_ENV for k in env):
+                raise ValueError("invalid name of an environment variable")
+            task = Task(owner=owner, task_type=task_type, program=program, pwd=pwd, status='Ready', submitted=now,
+                        duration=int(item.get('duration') or 0),
+                        cpu=float(item['cpu']) if item.get('cpu') else suggestion.get('cpu'),
+                        mem=int(item['mem']) if item.get('mem') else suggestion.get('mem'),
+                        gpu=int(item['gpu']) if item.get('gpu') is not None else None,
+                        priority=int(item.get('priority') or 0),
+                        array_size=int(item['array_size']) if item.get('array_size') else None,
+                        parallelism=int(item['parallelism']) if item.get('parallelism') else None,
+                        headless=runs_headless(task_type, item.get('headless')),
+                        datasets=task_datasets(item.get('datasets')))
+            if task_type == 'array':
+                task.array_size = task.array_size or sweep_size(entries)
+                if not task.array_size or not 1 <= task.array_size <= MAX_ARRAY:
+                    raise ValueError("an array task needs 1 - %d indexes" % MAX_ARRAY)
+        except (TypeError, ValueError, AttributeError) as e:
+            raise UploadError("Task %d is invalid: %s" % (i, e))
+        if (task.cpu is not None and task.cpu < 0.1) or (task.mem is not None and task.mem < 100) or \
+                (task.gpu is not None and task.gpu < 0) or not 0 <= task.priority <= 10:
+            raise UploadError("Task %d requests invalid resources or priority" % i)
+        tasks.append((task, item.get('params'), env))
+
+    # The files of every task are placed before the ids are taken, the write lock of the database is only held
+    # for the inserts and the renames of the folders
+    folders = []
+    try:
+        for task, params, env in tasks:
+            folder = new_task_folder(owner)
+            folders.append(folder)
+            materialize(folder, entries)
+            list_files(folder, entries)
+            if params is not None:
+                with open(os.path.join(folder, "params.json"), "w") as f:
+                    json.dump(params, f)
+            if env:
+                # Sourced by the notebook before it runs (see jupyter/entrypoint.sh)
+                with open(os.path.join(folder, ".env"), "w") as f:
+                    f.writelines("export %s=%s\n" % (k, shlex.quote(v)) for k, v in env.items())
+        # All ids at once, nothing is committed before the folders have their place
+        db_session.add_all([task for task, _, _ in tasks])
+        db_session.flush()
+        for (task, _, _), folder in zip(tasks, folders):
+            move_task_folder(folder, owner, task.id)
+        db_session.commit()
+        current_generation.invalidate()
+    except Exception:
+        db_session.rollback()
+        for folder in folders:
+            shutil.rmtree(folder, ignore_errors=True)
+        raise
+
+    generation = scheduler_client.notify_update()
+    ids = [task.id for task, _, _ in tasks]
+    logging.info("New tasks %d - %d (%d), will be scheduled in reconcile %s" % (ids[0], ids[-1], len(ids), generation))
+    return make_response(jsonify({"ids": ids, "generation": generation}), 201)
+
+
+def user_pwd(owner):
+    """ The password (hash) of <owner>, a new user gets a folder and the standard pwd (same as Username) """
+    directory = os.path.join(app.config['PYTHONFILE_FOLDER'], owner)
+    if not os.path.exists(directory):
+        logging.info("Making Account for %s" % owner)
+        os.makedirs(directory)
+        with open(os.path.join(directory, "pwd"), "w+") as pwd:
+            pwd.write(passwd(owner))
+    with open(os.path.join(directory, "pwd"), "r") as pwd:
+        return pwd.read()
+
+
+def new_task_folder(owner):
+    """ A new folder for the files of a task of <owner> that has no id yet (see 'move_task_folder') """
+    folder = tempfile.mkdtemp(prefix='.new-', dir=os.path.join(app.config['PYTHONFILE_FOLDER'], owner))
+    os.chmod(folder, 0o755)
+    return folder
+
+
+def move_task_folder(folder, owner, id):
+    """ Give the <folder> of 'new_task_folder' the place of the task <id> (replaces what a failed insert left) """
+    directory = os.path.join(app.config['PYTHONFILE_FOLDER'], owner, str(id))
+    shutil.rmtree(directory, ignore_errors=True)
+    os.rename(folder, directory)
+    return directory
+
+
+def bundle(files, main, task_type):
+    """
+    Input: files - [(filename, fullPath, SHA-256)] of the stored files (see blobs.py)
+           main - name of the file to execute (with or without .py), the last file if it isn't found
+    -----
+    Returns (program, [(relpath, SHA-256)]): what to execute and all files of a task.
+    The client-side folder structure is rebuilt below the common prefix of the files.
+    A python main is converted to a notebook and stored as well, a script (task_type 'script') is run as it is.
+    """
+    if task_type == 'empty_notebook':
+        with timed(CONVERSION_SECONDS, 'notebook empty', kind='empty_notebook'):
+            digest = code_blobs.add_stream(io.BytesIO(nbf.writes(nbf.v4.new_notebook()).encode('utf-8')))
+        return "test.ipynb", [("test.ipynb", digest)]
+
+    # Try to find the main
+    program = main if main.endswith(('.py', '.ipynb')) else main + ".py"
+    found = False
+    last = None
+    # Get rid of folder where files were in by stepping into the common prefix
+    prefix = common_prefix(files)
+    digests = {}
+    for file, fullPath, digest in files:
+        relpath = relative_path(fullPath, prefix)
+        last = relpath
+        if file == program or relpath == program:
+            found = True
+            program = relpath
+        digests[relpath] = digest
+    # Use last file uploaded if no main is found
+    if not found:
+        program = last
+
+    # Convert only main to a notebook if not already
+    if task_type == 'python' or (task_type == 'array' and program.endswith('.py')):
+        with timed(CONVERSION_SECONDS, 'notebook from python', kind='python'):
+            with open(code_blobs.path(digests.pop(program)), 'r') as f:
+                code = f.read()
+            nb = nbf.v4.new_notebook()
+            nb.cells.append(nbf.v4.new_code_cell(code))
+            program = program.replace('.py', '.ipynb')
+            digests[program] = code_blobs.add_stream(io.BytesIO(nbf.writes(nb).encode('utf-8')))
+    return program, list(digests.items())
+
+
+def common_prefix(files):
+    """ The folder all <files> (see 'bundle') were in on the client, it isn't part of their path in the task """
+    return os.path.commonpath([path for _, path, _ in files]) if len(files) >= 2 else ""
+
+
+def relative_path(path, prefix):
+    """ os.path.relpath, much faster for the usual clean paths below <prefix> (modules have thousands of files) """
+    if prefix and path.startswith(prefix + '/') and os.path.normpath(path) == path:
+        return path[len(prefix) + 1:]
+    return os.path.relpath(path, prefix)
+
+
+def place_staged(token, files, entries, directory):
+    """
+    Move the folder of an archive with the <files> of a task (see '/dropzone/archive') to its <directory> at once.
+    Returns the <entries> (see 'bundle') that still have to be placed ('materialize'): all without such folder,
+    otherwise those that were moved into the blob store while the archive was extracted
+    """
+    if not files:
+        return entries
+    prefix = common_prefix(files)
+    if not archives.place(token, prefix, directory):
+        return entries
+    # A python main converted to a notebook isn't part of the task
+    for relpath in {relative_path(path, prefix) for _, path, _ in files} - {relpath for relpath, _ in entries}:
+        if os.path.isfile(os.path.join(directory, relpath)):
+            os.remove(os.path.join(directory, relpath))
+    return [(relpath, digest) for relpath, digest in entries if not os.path.isfile(os.path.join(directory, relpath))]
+
+
+def task_datasets(names):
+    """
+    Input: names - the datasets a task reads (a list or separated by commas)
+    -----
+    Returns the JSON [{"name", "sha256", "size", "path"}] of the datasets (what is copied to the node of the task,
+    the columns of a converted CSV, see Scheduler/locality.py), None without datasets.
+    Raises ValueError if one isn't registered or still being converted
+    """
+    if isinstance(names, str):
+        names = names.split(",")
+    datasets = []
+    for name in dict.fromkeys(secure_filename(str(name).strip()) for name in names or []):
+        if not name:
+            continue
+        entry = registry.get(name)
+        if entry is None:
+            raise ValueError("Dataset %s isn't registered" % name)
+        if entry['status'] == 'converting':
+            raise ValueError("Dataset %s is still being converted" % name)
+        path = entry.get('columns') or name
+        folder = os.path.join(app.config['UPLOAD_FOLDER'], path)
+        size = sum(os.path.getsize(os.path.join(folder, f)) for f in os.listdir(folder)) \
+            if os.path.isdir(folder) else entry['size']
+        datasets.append({'name': name, 'sha256': entry['sha256'], 'size': size, 'path': path})
+    return json.dumps(datasets) if datasets else None
+
+
+def runs_headless(task_type, requested):
+    """
+    Whether a task runs without Jupyter (see jupyter/entrypoint.sh): scripts always,
+    notebooks if <requested>. Array tasks have a runner of their own, an empty notebook only makes sense with Jupyter
+    """
+    return task_type == 'script' or (bool(requested) and task_type in ('python', 'jupyter_notebook'))
+
+
+def sweep_size(entries):
+    """ Number of entries in the sweep file of a task (see 'bundle'), None if there is none """
+    for relpath, digest in entries:
+        if relpath == SWEEP_FILE:
+            try:
+                with open(code_blobs.path(digest), 'r') as f:
+                    sweep = json.load(f)
+            except (OSError, ValueError):
+                return None
+            return min(len(sweep), MAX_ARRAY) if isinstance(sweep, list) else None
+    return None
+
+
+def array_status(owner, task_id, size):
+    """
+    Status of every index of an array task, reported by the pods (see jupyter/array_index.py):
+    [(status, since)], 'Ready' for indexes that didn't start yet
+    """
+    directory = os.path.join(app.config['PYTHONFILE_FOLDER'], owner, str(task_id))
+    statuses = []
+    for index in range(size or 0):
+        try:
+            with open(os.path.join(directory, str(index), '.status'), 'r') as f:
+                status, since = f.read().split()
+            statuses.append((status, float(since)))
+        except (OSError, ValueError):
+            statuses.append(('Ready', None))
+    return statuses
+
+
+def list_files(directory, entries):
+    """
+    Save all files of a task (see 'bundle') with their SHA-256 in its folder (FILES_LIST), their blobs are kept
+    as long as the task is active (see 'task_blobs')
+    """
+    with open(os.path.join(directory, FILES_LIST), 'w') as f:
+        json.dump(entries, f)
+
+
+def task_blobs():
+    """ The SHA-256s of the files of all active tasks (see 'list_files'), for the garbage collection of blobs.py """
+    digests = set()
+    for task in active_tasks():
+        try:
+            with open(os.path.join(app.config['PYTHONFILE_FOLDER'], task.owner, str(task.id), FILES_LIST)) as f:
+                digests.update(digest for _, digest in json.load(f))
+        except (OSError, ValueError):
+            pass
+    return digests
+
+
+def materialize(directory, entries):
+    """
+    Place the files of a task (see 'bundle') in its folder: every file is a copy of its own (a reflink where the
+    file system can, see blobs.py), tasks run as root and may write to any of their files
+    """
+    for relpath, digest in entries:
+        loc = os.path.join(directory, os.path.dirname(relpath))
+        if not os.path.exists(loc):
+            os.makedirs(loc)
+        code_blobs.copy(digest, os.path.join(directory, relpath))
+
+
 @app.route("/changepwd", methods=["GET", "POST"])
 def change_pwd():
     """
@@ -321,7 +1033,10 @@ def upload_dataset():
         filename = secure_filename(file.filename)
         logging.info("Uploaded Dataset: %s" % filename)
         try:
-            file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+            path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+            digest = data_blobs.add_stream(file.stream)
+            data_blobs.link(digest, path)
+            registry.register(path, digest, request.form.get('convert') == 'true')
         except:
             traceback.print_exc(file=sys.stderr)
 
@@ -332,8 +1047,104 @@ def upload_dataset():
     return render_template("upload.html")
 
 
+@app.errorhandler(UploadError)
+def upload_error(e):
+    return make_response(jsonify({"message": str(e)}), e.status)
+
+
+@app.route("/upload/sessions", methods=["POST"])
+def create_upload():
+    """
+    Start a chunked upload (used by '/upload').
+    Expects JSON {"filename", "size", "chunk_size" (optional), "sha256" (optional, of the whole file),
+    "convert" (optional, convert a CSV to columns for 'dataregistry', see registry.py)}.
+    Returns the session with its id, chunk size and the missing chunks.
+    If a file with this SHA-256 is stored already it's only linked to the name, the answer has
+    "deduplicated" then and nothing has to be sent.
+    """
+    data = request.get_json(force=True, silent=True) or {}
+    try:
+        size = int(data['size'])
+    except (KeyError, TypeError, ValueError):
+        raise UploadError("The size of the file is missing")
+    upload = uploads.create(data.get('filename'), size, data.get('chunk_size') or DEFAULT_CHUNK, data.get('sha256'))
+    data_blobs.collect()
+    if upload.get('deduplicated'):
+        # The file is stored already and was just linked to its name
+        logging.info("Uploaded Dataset: %s (stored already)" % upload['filename'])
+        registry.register(os.path.join(app.config['UPLOAD_FOLDER'], upload['filename']), upload['sha256'],
+                          bool(data.get('convert')))
+        return jsonify(upload)
+    logging.info("Upload %s of %s started" % (upload['id'], data.get('filename')))
+    return make_response(jsonify(uploads.status(upload['id'])), 201)
+
+
+@app.route("/upload/sessions/<session_id>", methods=["GET"])
+def upload_status(session_id):
+    """ Which chunks of an upload are still missing (to resume it) """
+    return jsonify(uploads.status(session_id))
+
+
+@app.route("/upload/sessions/<session_id>", methods=["PUT"])
+def upload_chunk(session_id):
+    """
+    Write one or more chunks of an upload. The body is the raw data,
+    its place is given by the header 'Content-Range: bytes <start>-<end>/<size>'.
+    The body is written directly into the file, without a temporary copy.
+    """
+    chunks = uploads.write(session_id, request.headers.get('Content-Range'), request.stream,
+                           request.headers.get('X-Chunk-Sha256'))
+    return jsonify({"chunks": chunks})
+
+
+@app.route("/upload/sessions/<session_id>/complete", methods=["POST"])
+def complete_upload(session_id):
+    """
+    Check the file, move it to the datasets and register it.
+    Optional JSON {"sha256", "convert" (convert a CSV to columns)}
+    """
+    data = request.get_json(force=True, silent=True) or {}
+    path, sha256, completed = uploads.complete(session_id, data.get('sha256'))
+    if completed:
+        logging.info("Uploaded Dataset: %s" % path)
+        entry = registry.register(path, sha256, bool(data.get('convert')))
+    else:
+        # Completed by a request sent at the same time, which registers it
+        entry = registry.get(os.path.basename(path)) or {'status': 'registering'}
+    return jsonify({"message": "File uploaded", "sha256": sha256, "status": entry['status']})
+
+
+@app.route("/upload/sessions/<session_id>", methods=["DELETE"])
+def abort_upload(session_id):
+    uploads.load(session_id)
+    uploads.abort(session_id)
+    return jsonify({"message": "Upload cancelled"})
+
+
+@app.route("/datasets")
+def datasets():
+    """ All registered datasets with size, SHA-256, format, schema and status of the conversion """
+    return jsonify(registry.all())
+
+
+@app.route("/datasets/<name>")
+def dataset(name):
+    entry = registry.get(secure_filename(name))
+    if entry is None:
+        return make_response(jsonify({"message": "Unknown dataset %s" % name}), 404)
+    return jsonify(entry)
+
+
+@app.route("/stats/db")
+def db_stats():
+    """
+    How long writes of the website had to wait for the database lock
+    """
+    return jsonify(lock_stats.as_dict())
+
+
 if __name__ == "__main__":
-    """ Starts the logger and the app. """
+    """ Starts the logger and the app (development server, in production: gunicorn, see gunicorn.conf.py) """
     logging.basicConfig(level=logging.INFO)
     # For debugging set debug to True
     app.run(debug=False, host='0.0.0.0')
@@ -0,0 +1,226 @@
+from uploads import UploadError, BLOCK, MAX_AGE
+from instrument import measured, FILE_SECONDS
+from werkzeug.utils import secure_filename
+import tempfile
+import zipfile
+import tarfile
+import hashlib
+import secrets
+import logging
+import shutil
+import stat
+import time
+import os
+import re
+
+"""
+Upload of all files of a task as one archive (tar, also compressed, or zip).
+
+A tar is extracted while it arrives, member by member, into a folder of its own (<root>/.staging/<token>),
+nothing of it is held in memory. A zip has its directory at the end, so it's written to a temporary file
+(on the disk) first. Every file is hashed while it's written, so the list of them (the manifest) works everywhere
+a manifest does ('/tasks/batch'). A file that isn't in the BlobStore yet (see blobs.py) is moved into it,
+every file is written only once. One that is stored already stays in the staged folder.
+When the task is added, the staged folder is moved to <owner>/<id> with one rename, only the files that were
+moved into the store are copied from there (see 'place_staged' in app.py).
+-----
+Paths in the archive must stay within it (no absolute paths, no '..'), links and devices are skipped.
+An archive may hold at most MAX_FILES members (files, folders, links, everything) and MAX_BYTES bytes
+(counted while extracting, not trusting the sizes the archive claims).
+Staged folders that weren't used for MAX_AGE are removed.
+"""
+
+MAX_FILES = 50000
+MAX_BYTES = 2 * 2 ** 30
+TOKEN = re.compile(r'^[0-9a-f]{32}$')
+ZIP_MAGIC = b'PK\x03\x04'
+
+
+class Prefixed:
+    """ A stream of which the first bytes were already read (to tell the format of the archive) """
+    def __init__(self, head, stream):
+        self.head = head
+        self.stream = stream
+
+    def read(self, size=-1):
+        if not self.head:
+            return self.stream.read(size)
+        if size is None or size < 0:
+            data, self.head = self.head + self.stream.read(), b''
+            return data
+        data, self.head = self.head[:size], self.head[size:]
+        if len(data) < size:
+            data += self.stream.read(size - len(data))
+        return data
+
+
+def member_path(name):
+    """ The relative path of a member of an archive, None for the top folder. Raises UploadError if it leaves it """
+    name = name.replace('\\', '/')
+    parts = [part for part in name.split('/') if part not in ('', '.')]
+    if name.startswith('/') or '\0' in name or '..' in parts or (parts and ':' in parts[0]):
+        raise UploadError("Invalid path in the archive: %s" % name)
+    return '/'.join(parts) or None
+
+
+class ArchiveStaging:
+    def __init__(self, root, blobs):
+        self.root = root
+        self.folder = os.path.join(root, '.staging')
+        self.blobs = blobs
+
+    @measured(FILE_SECONDS, 'archive extract', operation='archive_extract')
+    def extract(self, stream):
+        """
+        Input: stream - file-like object with a tar (gz, bz2, xz) or zip (e.g. a request body)
+        -----
+        Extract the archive into a new staged folder.
+        Returns (token, [(filename, fullPath, SHA-256)]) of all files, fullPath relative to the archive
+        """
+        token = secrets.token_hex(16)
+        tmp = os.path.join(self.folder, token + '.tmp')
+        os.makedirs(tmp)
+        head = stream.read(len(ZIP_MAGIC))
+        try:
+            if head == ZIP_MAGIC:
+                files = self._extract_zip(Prefixed(head, stream), tmp)
+            else:
+                files = self._extract_tar(Prefixed(head, stream), tmp)
+            os.rename(tmp, os.path.join(self.folder, token))
+        except (tarfile.TarError, zipfile.BadZipFile, EOFError) as e:
+            raise UploadError("Invalid archive: %s" % e)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        if not files:
+            self.remove(token)
+            raise UploadError("The archive has no files")
+        return token, [(secure_filename(os.path.basename(path)), path, digest) for path, digest in files.items()]
+
+    def _extract_tar(self, stream, dest):
+        files = {}
+        budget = MAX_BYTES
+        folders = set()
+        with tarfile.open(fileobj=stream, mode='r|*') as tar:
+            for count, member in enumerate(tar, 1):
+                if count > MAX_FILES:
+                    raise UploadError("The archive has more than %d members" % MAX_FILES, 413)
+                path = member_path(member.name)
+                if path is None:
+                    continue
+                if member.isdir():
+                    self._makedirs(dest, path, folders)
+                elif member.isfile():
+                    files[path], size = self._write(tar.extractfile(member), dest, path, files, budget, folders)
+                    budget -= size
+                else:
+                    logging.info("Skipped %s in the archive (not a file)" % member.name)
+        return files
+
+    def _extract_zip(self, stream, dest):
+        files = {}
+        budget = MAX_BYTES
+        folders = set()
+        fd, spool = tempfile.mkstemp(dir=self.folder, suffix='.zip.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                size = 0
+                while True:
+                    data = stream.read(BLOCK)
+                    if not data:
+                        break
+                    size += len(data)
+                    if size > MAX_BYTES:
+                        raise UploadError("The archive is larger than %d bytes" % MAX_BYTES, 413)
+                    f.write(data)
+            with zipfile.ZipFile(spool) as archive:
+                if len(archive.infolist()) > MAX_FILES:
+                    raise UploadError("The archive has more than %d members" % MAX_FILES, 413)
+                for info in archive.infolist():
+                    path = member_path(info.filename)
+                    if path is None:
+                        continue
+                    if info.is_dir():
+                        self._makedirs(dest, path, folders)
+                    elif stat.S_ISLNK(info.external_attr >> 16):
+                        logging.info("Skipped %s in the archive (a link)" % info.filename)
+                    else:
+                        with archive.open(info) as member:
+                            files[path], size = self._write(member, dest, path, files, budget, folders)
+                        budget -= size
+        finally:
+            os.remove(spool)
+        return files
+
+    @staticmethod
+    def _makedirs(dest, path, folders):
+        """ Create the folder <path> (unless it is in <folders>, those created already) """
+        if path in folders:
+            return
+        try:
+            os.makedirs(os.path.join(dest, path), exist_ok=True)
+        except (FileExistsError, NotADirectoryError):
+            raise UploadError("%s is a file and a folder in the archive" % path)
+        folders.add(path)
+
+    def _write(self, member, dest, path, files, budget, folders):
+        """
+        Write one file of the archive (at most <budget> bytes), hashed while it's written,
+        and move it into the BlobStore unless it's stored already. Returns (SHA-256, size)
+        """
+        target = os.path.join(dest, path)
+        self._makedirs(dest, os.path.dirname(path), folders)
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            if path in files and os.path.exists(target):
+                os.remove(target)
+            with open(target, 'wb') as f:
+                while True:
+                    data = member.read(BLOCK)
+                    if not data:
+                        break
+                    size += len(data)
+                    if size > budget:
+                        raise UploadError("The archive has more than %d bytes" % MAX_BYTES, 413)
+                    digest.update(data)
+                    f.write(data)
+        except IsADirectoryError:
+            raise UploadError("%s is a file and a folder in the archive" % path)
+        # A stored blob counts as used from now on
+        if self.blobs.missing([digest.hexdigest()]):
+            self.blobs.add_file(target, digest.hexdigest())
+        return digest.hexdigest(), size
+
+    def place(self, token, prefix, dest):
+        """
+        Move the staged folder <token> (its subfolder <prefix>) to <dest>, which mustn't exist or be empty.
+        Returns False if there is no such folder (it was used or removed already)
+        """
+        if not token or not TOKEN.match(token):
+            return False
+        source = os.path.join(self.folder, token, prefix)
+        if not os.path.isdir(source):
+            return False
+        os.replace(source, dest)
+        self.remove(token)
+        return True
+
+    def remove(self, token):
+        shutil.rmtree(os.path.join(self.folder, token), ignore_errors=True)
+
+    def cleanup(self, now=None):
+        """ Remove staged folders (and interrupted extractions) that weren't used for MAX_AGE """
+        now = now or time.time()
+        if not os.path.isdir(self.folder):
+            return
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            try:
+                if os.stat(path).st_mtime >= now - MAX_AGE:
+                    continue
+            except FileNotFoundError:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
@@ -0,0 +1,215 @@
+from uploads import UploadError, BLOCK, MAX_AGE
+from instrument import measured, FILE_SECONDS
+import tempfile
+import hashlib
+import secrets
+import shutil
+import fcntl
+import errno
+import json
+import time
+import os
+import re
+
+"""
+Content-addressed storage of uploaded files.
+
+Every file is stored once under <root>/.blobs/<first 2 hex digits>/<sha256>, so the same module or dataset
+uploaded again isn't sent again. The datasets are hardlinks to these blobs (the notebooks mount /data read-only).
+The files of a task are reflinks (copy-on-write) where the file system supports it and copies otherwise:
+tasks run as root and may write to their files, a write to a hardlink would change the blob for every task.
+Without reflinks (ext4, NFS) every task has full copies of its files, for code the deduplication then only
+saves the upload and the space of the store itself, not the space of the task folders.
+-----
+A dataset references its blob by its hardlink, so the link count says if a dataset still uses it.
+The files of a task aren't linked, every task lists them with their SHA-256 in its folder (see 'list_files'
+in app.py) and the website passes the SHA-256s of all active tasks to the garbage collection ('referenced').
+Blobs that are neither linked nor referenced are removed once they weren't used for MAX_AGE
+(uploading or copying a blob counts as use).
+Hardlinks and reflinks only work within one mount, so /mnt/data and /mnt/internal have a store each.
+"""
+
+DIGEST = re.compile(r'^[0-9a-f]{64}$')
+# Run the garbage collection at most this often (seconds)
+COLLECT_INTERVAL = 3600
+# ioctl to clone a file (btrfs, xfs): linux/fs.h FICLONE
+FICLONE = 0x40049409
+
+
+class BlobStore:
+    def __init__(self, root):
+        self.root = root
+        self.folder = os.path.join(root, '.blobs')
+        self.manifests = os.path.join(self.folder, 'manifests')
+        self.collected = 0
+
+    def path(self, digest):
+        digest = digest.lower()
+        if not DIGEST.match(digest):
+            raise UploadError("Invalid SHA-256 %s" % digest)
+        return os.path.join(self.folder, digest[:2], digest)
+
+    def has(self, digest):
+        return os.path.isfile(self.path(digest))
+
+    def missing(self, digests):
+        """
+        The SHA-256s that aren't stored yet (in the order given).
+        The others count as used, so they aren't collected before the client refers to them
+        """
+        missing = []
+        for digest in digests:
+            try:
+                os.utime(self.path(digest))
+            except FileNotFoundError:
+                missing.append(digest)
+        return missing
+
+    @measured(FILE_SECONDS, 'blob add_stream', operation='blob_add_stream')
+    def add_stream(self, stream, sha256=None):
+        """
+        Input: stream - file-like object (e.g. a request body)
+               sha256 - expected SHA-256 of the data (optional)
+        -----
+        Store the data (hashed while it's written) and return its SHA-256
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        digest = hashlib.sha256()
+        fd, tmp = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    data = stream.read(BLOCK)
+                    if not data:
+                        break
+                    digest.update(data)
+                    f.write(data)
+            if sha256 is not None and digest.hexdigest() != sha256.lower():
+                raise UploadError("SHA-256 of the data doesn't match", 422)
+            return self.add_file(tmp, digest.hexdigest())
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def add_file(self, path, digest):
+        """
+        Move the file <path> (with the SHA-256 <digest>) into the store, it's removed if the
+        blob exists already. Returns the digest
+        """
+        blob = self.path(digest)
+        if os.path.exists(blob):
+            os.remove(path)
+            # Used again, the garbage collection counts from now
+            os.utime(blob)
+        else:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            # Blobs are shared, they are never written
+            os.chmod(path, 0o444)
+            os.replace(path, blob)
+        return digest
+
+    @measured(FILE_SECONDS, 'blob link', operation='blob_link')
+    def link(self, digest, dest):
+        """ Place the blob at <dest> as a hardlink (replaces an existing file) """
+        tmp = "%s.%s.tmp" % (dest, secrets.token_hex(4))
+        os.link(self.path(digest), tmp)
+        os.replace(tmp, dest)
+
+    @measured(FILE_SECONDS, 'blob copy', operation='blob_copy')
+    def copy(self, digest, dest):
+        """
+        Place the blob at <dest> as a file of its own (reflink if possible), for the files of tasks.
+        Replaces an existing file (also a hardlink to the blob, which isn't touched)
+        """
+        blob = self.path(digest)
+        tmp = "%s.%s.tmp" % (dest, secrets.token_hex(4))
+        clone(blob, tmp)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, dest)
+        # Used again, the garbage collection counts from now
+        os.utime(blob)
+
+    def save_manifest(self, files):
+        """ Keep the list of uploaded files of a task until it is submitted, returns its token """
+        os.makedirs(self.manifests, exist_ok=True)
+        token = secrets.token_hex(16)
+        with open(os.path.join(self.manifests, token + '.json'), 'w') as f:
+            json.dump(files, f)
+        return token
+
+    def load_manifest(self, token):
+        """ The list saved with 'save_manifest', None if there is none (they are removed after MAX_AGE) """
+        if not token or not re.match(r'^[0-9a-f]{32}$', token):
+            return None
+        path = os.path.join(self.manifests, token + '.json')
+        try:
+            with open(path, 'r') as f:
+                files = json.load(f)
+        except FileNotFoundError:
+            return None
+        return files
+
+    def collect(self, now=None, force=False, referenced=None):
+        """
+        Input: referenced - function that returns the SHA-256s of the blobs in use that aren't linked
+                            (the files of active tasks), only called when the collection runs
+        -----
+        Remove blobs that no dataset links to and nothing references anymore and weren't used for MAX_AGE,
+        and old manifests. Runs at most every COLLECT_INTERVAL unless forced.
+        Returns (number of blobs, bytes) removed
+        """
+        now = now or time.time()
+        if not force and now - self.collected < COLLECT_INTERVAL:
+            return 0, 0
+        self.collected = now
+        removed, freed = 0, 0
+        if not os.path.isdir(self.folder):
+            return removed, freed
+        keep = set(referenced()) if referenced is not None else set()
+        for shard in os.listdir(self.folder):
+            shard_path = os.path.join(self.folder, shard)
+            if not os.path.isdir(shard_path):
+                # Temporary files of uploads that were interrupted
+                if shard.endswith('.tmp') and os.stat(shard_path).st_mtime < now - MAX_AGE:
+                    os.remove(shard_path)
+                continue
+            for name in os.listdir(shard_path):
+                path = os.path.join(shard_path, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if shard == 'manifests':
+                    if stat.st_mtime < now - MAX_AGE:
+                        os.remove(path)
+                elif stat.st_nlink == 1 and name not in keep and stat.st_mtime < now - MAX_AGE:
+                    os.remove(path)
+                    removed += 1
+                    freed += stat.st_size
+        return removed, freed
+
+    def usage(self):
+        """ (bytes stored, bytes of all links to them), the difference is what deduplication saves """
+        stored, linked = 0, 0
+        if not os.path.isdir(self.folder):
+            return stored, linked
+        for shard in os.listdir(self.folder):
+            shard_path = os.path.join(self.folder, shard)
+            if shard == 'manifests' or not os.path.isdir(shard_path):
+                continue
+            for name in os.listdir(shard_path):
+                stat = os.stat(os.path.join(shard_path, name))
+                stored += stat.st_size
+                linked += stat.st_size * (stat.st_nlink - 1)
+        return stored, linked
+
+
+def clone(source, dest):
+    """ Copy <source> to the new file <dest>, as a reflink (sharing the blocks until one is written) if possible """
+    with open(source, 'rb') as src, open(dest, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.EBADF):
+                raise
+            shutil.copyfileobj(src, dst, BLOCK)
@@ -0,0 +1,66 @@
+import logging
+import shutil
+import os
+
+"""
+Production mode of the website (the Docker image runs it, 'python app.py' is the development server):
+
+    gunicorn -c gunicorn.conf.py app:app
+
+WEB_WORKERS processes (pre-fork) with WEB_THREADS threads each. A slow request (an upload, a round trip to the
+scheduler) only takes one thread, notebooks are converted in parallel by several processes. A log that is streamed
+takes its thread as long as it's open, so a worker streams at most LOG_STREAMS logs at once, each for at most
+a few minutes (see logs.py), more viewers get 503 and try again. Every process has its own database engine
+and pool (see store.py), every request its own session. Uploads are written to the disk while they are read
+(see uploads.py, archives.py), nginx in front of the website (proxy/nginx.conf) buffers the other bodies,
+so slow clients don't hold a thread.
+-----
+The app is imported once by the master and the workers are forked from it, so they start at once.
+'kill -HUP 1' (in the container) replaces all workers and reloads this config, the old workers stop accepting
+and finish their requests (at most GRACEFUL seconds, streams of logs are closed and resumed by the browser).
+New code comes with a new image, i.e. a new pod: SIGTERM from Kubernetes stops the same way.
+The metrics of all workers are collected in PROMETHEUS_MULTIPROC_DIR, so '/metrics' counts all of them.
+"""
+
+GRACEFUL = 30
+
+bind = '0.0.0.0:5000'
+# One process per core, more only add work for the CPU, threads wait for I/O
+workers = int(os.environ.get('WEB_WORKERS', min(os.cpu_count() or 1, 8)))
+worker_class = 'gthread'
+preload_app = True
+# At most one connection of the pool per thread and as many as the pool has (DB_POOL_SIZE + overflow)
+threads = int(os.environ.get('WEB_THREADS', 8))
+# Only how long a worker may not answer the master, requests can take longer with threads
+timeout = 60
+graceful_timeout = GRACEFUL
+# Longer than nginx keeps its connections to the website open
+keepalive = 75
+# The heartbeat of the workers, in memory so a slow disk doesn't get them killed
+worker_tmp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+errorlog = '-'
+loglevel = 'info'
+
+# The workers inherit both, they have to be set before the app is imported
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/prometheus-website')
+logging.basicConfig(level=logging.INFO)
+
+
+def on_starting(server):
+    """ Metrics of a previous run would be counted again """
+    shutil.rmtree(os.environ['PROMETHEUS_MULTIPROC_DIR'], ignore_errors=True)
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'])
+
+
+def post_fork(server, worker):
+    """ The connections of the master (opened by the import of the app) must not be shared """
+    from store import engine
+    from instrument import tracer
+    engine.dispose()
+    tracer.pid = os.getpid()
+
+
+def child_exit(server, worker):
+    # Imported here: prometheus_client decides when it's imported whether to write to PROMETHEUS_MULTIPROC_DIR
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
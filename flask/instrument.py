@@ -0,0 +1,63 @@
+from prometheus_client import Counter, Histogram, CollectorRegistry, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.multiprocess import MultiProcessCollector
+from flask import request, g
+# Shared with the scheduler (common/tracing.py), imported from here by the modules of the website
+from tracing import tracer, timed, measured
+import time
+import os
+
+"""
+Timing of the hot paths of the website (the scheduler has its own, see Scheduler/instrument.py,
+the timing itself is in common/tracing.py).
+
+Every request, db statement, message to the scheduler, file operation and conversion is measured
+in a Prometheus histogram, served as text on '/metrics'.
+With several worker processes (see gunicorn.conf.py) they write their measurements to PROMETHEUS_MULTIPROC_DIR
+and '/metrics' adds up those of all of them.
+If TRACE_FILE is set every measurement is also written as a span to that file, nested in the span
+of its request (Chrome trace event format, see common/tracing.py for viewers and flame graphs).
+"""
+
+# Buckets from 1ms to 60s
+BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+REQUEST_SECONDS = Histogram('frontend_request_seconds', "Duration of requests", ['endpoint', 'method', 'status'],
+                            buckets=BUCKETS)
+DB_STATEMENT_SECONDS = Histogram('frontend_db_statement_seconds', "Duration of db statements (writes include the "
+                                                                  "wait for the lock)", ['statement'], buckets=BUCKETS)
+IPC_SECONDS = Histogram('frontend_scheduler_ipc_seconds', "Round trip of messages to the scheduler", ['op'],
+                        buckets=BUCKETS)
+IPC_ERRORS = Counter('frontend_scheduler_ipc_errors_total', "Messages to the scheduler that failed", ['op'])
+FILE_SECONDS = Histogram('frontend_file_seconds', "Duration of storing, linking and moving files", ['operation'],
+                         buckets=BUCKETS)
+CONVERSION_SECONDS = Histogram('frontend_conversion_seconds', "Duration of conversions (notebooks, CSVs)", ['kind'],
+                               buckets=BUCKETS)
+
+
+def init_app(app):
+    """ Measure all requests of <app> and serve the metrics on '/metrics' """
+    @app.before_request
+    def start_request():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def stop_request(response):
+        start = g.pop('request_start', None)
+        if start is not None:
+            duration = time.perf_counter() - start
+            # The rule and not the path, so the number of series stays bounded
+            endpoint = request.url_rule.rule if request.url_rule is not None else 'unknown'
+            REQUEST_SECONDS.labels(endpoint=endpoint, method=request.method,
+                                   status=str(response.status_code)).observe(duration)
+            tracer.add("%s %s" % (request.method, endpoint), start, duration,
+                       {'path': request.path, 'status': response.status_code})
+        return response
+
+    @app.route("/metrics")
+    def metrics():
+        """ All measurements in the Prometheus text format """
+        if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+            registry = CollectorRegistry()
+            MultiProcessCollector(registry)
+            return generate_latest(registry), 200, {'Content-Type': CONTENT_TYPE_LATEST}
+        return generate_latest(), 200, {'Content-Type': CONTENT_TYPE_LATEST}
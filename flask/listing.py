@@ -0,0 +1,92 @@
+from collections import OrderedDict
+import threading
+import time
+
+"""
+Caches of the task listing (the start page, '/tasks/list' and '/api/tasks'), one per process.
+
+Everything shown about the tasks in the database only changes with the counter 'task_seq' (see store.py),
+so it is read and rendered once per value of the counter, all viewers get the same copy.
+What changes without it (the expected start of queued tasks, the usage and logs of running ones) is read again
+after a few seconds at most, not by every request. The ETags are built from the counter and a hash of that data,
+so they are the same in every worker process and a page that didn't change is answered with 304.
+"""
+
+
+class Cached:
+    """
+    The result of <compute(key, *args)>, computed again when it is asked for with another key
+    or is older than <max_age> seconds (None: only for another key)
+    -----
+    Only one thread computes it at a time, without holding the lock (compute may ask the scheduler).
+    While it's computed again only because of its age the others get the last value, otherwise they wait for it
+    """
+    def __init__(self, compute, max_age=None):
+        self.compute = compute
+        self.max_age = max_age
+        self._key = None
+        self._value = None
+        self._computed = None
+        self._computing = False
+        # Counts 'invalidate', a value computed before one isn't valid after it
+        self._version = 0
+        self._changed = threading.Condition()
+
+    def _valid(self, key):
+        if self._computed is None or self._key != key:
+            return False
+        return self.max_age is None or time.monotonic() - self._computed < self.max_age
+
+    def get(self, key=None, *args):
+        """ The value for <key>, <args> are only passed on to compute (e.g. the data the key was made from) """
+        with self._changed:
+            while self._computing:
+                if self._computed is not None and self._key == key:
+                    # Valid or only too old (it's computed again already)
+                    return self._value
+                self._changed.wait()
+            if self._valid(key):
+                return self._value
+            self._computing = True
+            version = self._version
+        try:
+            value = self.compute(key, *args)
+        except BaseException:
+            with self._changed:
+                self._computing = False
+                self._changed.notify_all()
+            raise
+        with self._changed:
+            self._computing = False
+            self._key, self._value = key, value
+            self._computed = time.monotonic() if version == self._version else None
+            self._changed.notify_all()
+        return value
+
+    def invalidate(self):
+        """ Compute it again the next time (e.g. after a write of this process) """
+        with self._changed:
+            self._version += 1
+            self._computed = None
+
+
+class LruCache:
+    """ The <size> entries used last """
+    def __init__(self, size=256):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
@@ -0,0 +1,154 @@
+from urllib.parse import urlsplit, urlencode
+from collections import defaultdict
+import http.client
+import threading
+import argparse
+import secrets
+import json
+import time
+import re
+
+"""
+Load test of the website: concurrent clients that load the start page, submit tasks and upload datasets,
+then the latency (p50, p99, max) of each kind of request and how many there were per second.
+
+    python loadtest.py --url http://127.0.0.1:5000 --index 16 --submit 4 --upload 2 --duration 30
+
+Run it against a test instance only: the submitted tasks (owner 'loadtest', a script that prints a line) end up
+in the queue and the datasets (loadtest-*.bin) in /mnt/data.
+-----
+Every client has its own connection (kept alive) and cookie session and sends its next request as soon as
+the previous one is answered. A submission is '/addtask' (for the CSRF token), '/dropzone' and the form,
+an upload is a chunked upload (see uploads.py) of --upload-mib MiB, both are measured as a whole.
+"""
+
+CSRF = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+CHUNK = 8 * 2 ** 20
+
+
+class Client:
+    """ A browser: one connection and the cookie of its session """
+    def __init__(self, url, timeout=60):
+        parts = urlsplit(url)
+        self.connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=timeout)
+        self.cookie = None
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        for retry in (True, False):
+            reused = self.connection.sock is not None
+            try:
+                self.connection.request(method, path, body, headers)
+                response = self.connection.getresponse()
+                data = response.read()
+                break
+            except (OSError, http.client.HTTPException) as e:
+                self.connection.close()
+                # Closed by the server while it was kept alive (e.g. a worker that stops), browsers send again
+                if not (retry and reused and isinstance(e, (http.client.RemoteDisconnected, BrokenPipeError,
+                                                            ConnectionResetError))):
+                    raise
+        cookie = response.getheader('Set-Cookie')
+        if cookie:
+            self.cookie = cookie.split(';')[0]
+        if response.status >= 400:
+            raise IOError("%s %s: %d" % (method, path, response.status))
+        return data
+
+
+def load_index(client, args):
+    client.request('GET', '/')
+
+
+def submit(client, args):
+    token = CSRF.search(client.request('GET', '/addtask').decode('utf-8')).group(1)
+    boundary = secrets.token_hex(16)
+    body = ("--%s\r\nContent-Disposition: form-data; name=\"fullPath_0\"\r\n\r\nmain.py\r\n"
+            "--%s\r\nContent-Disposition: form-data; name=\"file[0]\"; filename=\"main.py\"\r\n"
+            "Content-Type: text/x-python\r\n\r\nprint('load test %s')\r\n--%s--\r\n"
+            % (boundary, boundary, secrets.token_hex(4), boundary)).encode('utf-8')
+    client.request('POST', '/dropzone', body, {'Content-Type': 'multipart/form-data; boundary=%s' % boundary})
+    client.request('POST', '/addtask', urlencode({'csrf_token': token, 'task_type': 'script', 'owner': 'loadtest',
+                                                  'main': 'main.py'}),
+                   {'Content-Type': 'application/x-www-form-urlencoded'})
+
+
+def upload(client, args):
+    size = args.upload_mib * 2 ** 20
+    # Random data, stored blobs would be deduplicated
+    data = secrets.token_bytes(size)
+    upload = json.loads(client.request('POST', '/upload/sessions',
+                                       json.dumps({'filename': 'loadtest-%s.bin' % secrets.token_hex(4),
+                                                   'size': size, 'chunk_size': CHUNK}),
+                                       {'Content-Type': 'application/json'}))
+    for start in range(0, size, upload['chunk_size']):
+        end = min(start + upload['chunk_size'], size) - 1
+        client.request('PUT', '/upload/sessions/%s' % upload['id'], data[start:end + 1],
+                       {'Content-Range': 'bytes %d-%d/%d' % (start, end, size)})
+    client.request('POST', '/upload/sessions/%s/complete' % upload['id'], '{}', {'Content-Type': 'application/json'})
+
+
+KINDS = {'index': load_index, 'submit': submit, 'upload': upload}
+
+
+def run_client(kind, args, until, latencies, errors, lock):
+    client = Client(args.url)
+    while time.time() < until:
+        start = time.perf_counter()
+        try:
+            KINDS[kind](client, args)
+        except (OSError, AttributeError) as e:
+            with lock:
+                errors[kind] += 1
+            if args.verbose:
+                print("%s failed: %s" % (kind, e))
+            client = Client(args.url)
+            time.sleep(0.1)
+            continue
+        with lock:
+            latencies[kind].append(time.perf_counter() - start)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))] if values else float('nan')
+
+
+def report(latencies, errors, duration):
+    print("%-8s %8s %8s %9s %9s %9s %7s" % ('kind', 'count', 'per s', 'p50 ms', 'p99 ms', 'max ms', 'errors'))
+    for kind in KINDS:
+        values = latencies[kind]
+        if not values and not errors[kind]:
+            continue
+        print("%-8s %8d %8.1f %9.1f %9.1f %9.1f %7d" % (
+            kind, len(values), len(values) / duration, 1000 * percentile(values, 50), 1000 * percentile(values, 99),
+            1000 * max(values, default=float('nan')), errors[kind]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the website (latency of concurrent requests)")
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help="address of the website")
+    parser.add_argument('--index', type=int, default=16, help="clients that load the start page")
+    parser.add_argument('--submit', type=int, default=4, help="clients that submit tasks")
+    parser.add_argument('--upload', type=int, default=2, help="clients that upload datasets")
+    parser.add_argument('--upload-mib', type=int, default=16, help="size of each dataset in MiB")
+    parser.add_argument('--duration', type=float, default=30, help="seconds")
+    parser.add_argument('--verbose', action='store_true', help="print every failed request")
+    args = parser.parse_args()
+
+    latencies, errors, lock = defaultdict(list), defaultdict(int), threading.Lock()
+    start = time.time()
+    until = start + args.duration
+    threads = [threading.Thread(target=run_client, args=(kind, args, until, latencies, errors, lock), daemon=True)
+               for kind in KINDS for _ in range(getattr(args, kind))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report(latencies, errors, time.time() - start)
+
+
+if __name__ == '__main__':
+    main()
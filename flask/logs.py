@@ -0,0 +1,204 @@
+import threading
+import json
+import time
+import os
+
+"""
+Following the logs of running tasks ('output.log' in the folder of the task, see jupyter/batch.py).
+
+All viewers of a log share one LogFollower: only one of them looks at the file at a time (a stat every
+POLL seconds) and reads what was appended, the others wait for it. The last BUFFER bytes are kept in memory,
+so new viewers don't read the file again. Older parts are read from the file at their offset, never from the start.
+-----
+The stream is in the Server-Sent Events format, every event has the offset (in bytes) after its data as id,
+so browsers resume where they stopped after a reconnect (Last-Event-ID) and clients can ask for any offset.
+The data is the text as JSON string (progress bars write '\r', which would end an event line).
+Every stream holds a thread of the worker while it's open: a worker streams at most MAX_STREAMS logs at once
+(the other requests always get a thread), each for at most MAX_STREAM seconds, then the browser reconnects
+and may get the thread of another viewer. More viewers are refused (503, see 'reserve') and try again later.
+"""
+
+POLL = 0.25
+BUFFER = 64 * 1024
+# Most bytes in one event and seconds between keep-alive comments (to notice viewers that are gone)
+CHUNK = 16 * 1024
+KEEPALIVE = 15
+# The stream ends after this long, browsers reconnect where they stopped
+MAX_STREAM = 300
+# Streams at once per worker (it has WEB_THREADS threads, see gunicorn.conf.py)
+MAX_STREAMS = int(os.environ.get('LOG_STREAMS', 4))
+# Seconds until a refused viewer tries again
+RETRY = 5
+
+
+class LogFollower:
+    def __init__(self, path, status_path):
+        self.path = path
+        self.status_path = status_path
+        self.buffer = b""
+        self.end = 0
+        self.viewers = 0
+        self._polling = False
+        self._checked = 0
+        self._changed = threading.Condition()
+
+    @property
+    def start(self):
+        """ Offset of the first byte in the buffer """
+        return self.end - len(self.buffer)
+
+    def refresh(self):
+        """ Read what was appended to the file, at most the last BUFFER bytes (a file that shrank starts anew) """
+        self._checked = time.monotonic()
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        if size < self.end:
+            self.buffer, self.end = b"", 0
+        if size == self.end:
+            return
+        start = max(self.end, size - BUFFER)
+        with open(self.path, 'rb') as f:
+            data = os.pread(f.fileno(), size - start, start)
+        self.buffer = data if start > self.end else (self.buffer + data)[-BUFFER:]
+        self.end = start + len(data)
+
+    def read(self, offset, limit=CHUNK, fresh=False):
+        """ Up to <limit> bytes from <offset> on, from the buffer or (if it's older) the file """
+        with self._changed:
+            if fresh or (not self._polling and self._checked < time.monotonic() - POLL):
+                self.refresh()
+            if offset >= self.start or not limit:
+                return self.buffer[offset - self.start:offset - self.start + limit]
+            limit = min(limit, self.start - offset)
+        try:
+            with open(self.path, 'rb') as f:
+                return os.pread(f.fileno(), limit, offset)
+        except OSError:
+            return b""
+
+    def wait(self, offset, timeout):
+        """
+        Wait until there is data after <offset> (or the timeout passed).
+        One waiting viewer polls the file, the others are woken up by it
+        """
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while self.end <= offset and time.monotonic() < deadline:
+                if self._polling:
+                    self._changed.wait(max(0, deadline - time.monotonic()))
+                    continue
+                self._polling = True
+                self._changed.release()
+                try:
+                    time.sleep(min(POLL, max(0, deadline - time.monotonic())))
+                finally:
+                    self._changed.acquire()
+                    self._polling = False
+                self.refresh()
+                self._changed.notify_all()
+            return self.end > offset
+
+    def finished(self):
+        """ Whether the code of the task has finished (nothing is appended anymore) """
+        return task_finished(self.status_path)
+
+
+class LogTails:
+    """ The followers of all logs that are streamed, one per file """
+    def __init__(self, max_streams=MAX_STREAMS):
+        self._followers = {}
+        self._lock = threading.Lock()
+        self.max_streams = max_streams
+        self.streams = 0
+
+    def reserve(self):
+        """ Take one of the <max_streams> places for a stream, False if all are taken (give it back with 'release') """
+        with self._lock:
+            if self.streams >= self.max_streams:
+                return False
+            self.streams += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.streams -= 1
+
+    def tail(self, path, size=2048):
+        """ The last <size> bytes of a log starting at a line (from the buffer if it's streamed) """
+        follower = self._followers.get(path)
+        if follower is not None and len(follower.buffer) >= min(size, follower.end):
+            data = follower.buffer[-size:]
+        else:
+            try:
+                with open(path, 'rb') as f:
+                    end = os.fstat(f.fileno()).st_size
+                    data = os.pread(f.fileno(), min(size, end), max(0, end - size))
+            except OSError:
+                return None
+        if len(data) == size and b"\n" in data:
+            data = data[data.index(b"\n") + 1:]
+        return data.decode('utf-8', 'replace')
+
+    def stream(self, path, status_path, offset=None, done=False):
+        """
+        Server-Sent Events with the log from <offset> on (the last BUFFER bytes if None), until the task
+        finished (or is <done>) and everything was sent: 'id: <offset>' 'data: "<text>"' per chunk,
+        'event: end' at the end
+        """
+        with self._lock:
+            follower = self._followers.get(path)
+            if follower is None:
+                follower = self._followers[path] = LogFollower(path, status_path)
+            follower.viewers += 1
+        try:
+            follower.read(0, 0)
+            if offset is None or offset > follower.end:
+                offset = follower.start
+            started = time.monotonic()
+            while time.monotonic() - started < MAX_STREAM:
+                raw = follower.read(offset)
+                if offset > follower.end:
+                    # The file was started anew
+                    offset = follower.start
+                    continue
+                data = utf8_prefix(raw)
+                if not data and (done or follower.finished()):
+                    # The status is written after the last output
+                    raw = follower.read(offset, fresh=True)
+                    data = utf8_prefix(raw)
+                    if not data:
+                        yield "id: %d\nevent: end\ndata: \"\"\n\n" % offset
+                        return
+                if data:
+                    offset += len(data)
+                    yield "id: %d\ndata: %s\n\n" % (offset, json.dumps(data.decode('utf-8', 'replace')))
+                elif not follower.wait(offset + len(raw), KEEPALIVE):
+                    yield ": keep-alive\n\n"
+        finally:
+            with self._lock:
+                follower.viewers -= 1
+                if follower.viewers == 0:
+                    self._followers.pop(path, None)
+
+
+def task_finished(status_path):
+    """ Whether the status a task (or index of an array task) reported says its code has finished """
+    try:
+        with open(status_path, 'r') as f:
+            return f.read().split(" ")[0] in ('Finished', 'Failed')
+    except OSError:
+        return False
+
+
+def utf8_prefix(data):
+    """ <data> without an incomplete UTF-8 character at the end (it's sent with the next chunk) """
+    for i in range(1, min(4, len(data)) + 1):
+        byte = data[-i]
+        if byte & 0xC0 == 0x80:
+            continue
+        # The first byte of the last character says how long it is
+        length = 1 if byte < 0xC0 else 2 if byte < 0xE0 else 3 if byte < 0xF0 else 4
+        return data if length <= i else data[:-i]
+    return data
@@ -0,0 +1,223 @@
+from uploads import file_sha256
+from instrument import timed, CONVERSION_SECONDS
+import numpy as np
+import threading
+import logging
+import secrets
+import shutil
+import json
+import time
+import csv
+import os
+
+"""
+Registry of the datasets in /mnt/data (/data in the notebook pods).
+
+Every uploaded dataset gets an entry <root>/.registry/<name>.json with its size, SHA-256,
+format and schema (columns and types of a CSV, dtype and shape of a NPY).
+A CSV can be converted once at upload time into one .npy file per column
+(<root>/.registry/columns/<sha256>/), which the notebooks map into memory with
+'dataregistry.load' (jupyter/dataregistry.py) instead of parsing the CSV in every job.
+All jobs on a node then share the same pages of the page cache.
+NPY files are mapped directly, they don't have to be converted.
+-----
+The conversion runs in a thread, the entry has the status 'converting' until it's 'ready' (or 'failed').
+Columns are stored by the SHA-256 of the CSV, the same file uploaded under another name isn't converted again.
+"""
+
+# Rows that are parsed at once during the conversion
+BLOCK_ROWS = 65536
+
+
+class DatasetRegistry:
+    def __init__(self, root):
+        self.root = root
+        self.folder = os.path.join(root, '.registry')
+        self.columns = os.path.join(self.folder, 'columns')
+
+    def _entry_path(self, name):
+        return os.path.join(self.folder, name + '.json')
+
+    def get(self, name):
+        try:
+            with open(self._entry_path(name), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def all(self):
+        if not os.path.isdir(self.folder):
+            return []
+        return [self.get(name[:-5]) for name in sorted(os.listdir(self.folder)) if name.endswith('.json')]
+
+    def _save(self, entry):
+        os.makedirs(self.folder, exist_ok=True)
+        path = self._entry_path(entry['name'])
+        tmp = "%s.%s.tmp" % (path, secrets.token_hex(4))
+        with open(tmp, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp, path)
+
+    def register(self, path, sha256=None, convert=False):
+        """
+        Input: path - the dataset (directly in <root>)
+               sha256 - its SHA-256, computed if not given
+               convert - convert a CSV to columns (in the background)
+        -----
+        Catalogue the dataset, returns its entry
+        """
+        name = os.path.basename(path)
+        entry = {'name': name, 'size': os.path.getsize(path), 'sha256': sha256 or file_sha256(path),
+                 'format': dataset_format(name), 'registered': time.time(), 'status': 'ready'}
+        try:
+            entry['schema'] = read_schema(path, entry['format'])
+        except (ValueError, OSError, UnicodeDecodeError) as e:
+            logging.warning("Could not read the schema of %s: %s" % (name, e))
+            entry['format'] = 'file'
+
+        if convert and entry['format'] == 'csv':
+            columns = os.path.join(self.columns, entry['sha256'])
+            if os.path.isdir(columns):
+                self._converted(entry, columns)
+            else:
+                entry['status'] = 'converting'
+                threading.Thread(target=self.convert, args=(entry, path), daemon=True).start()
+        self._save(entry)
+        logging.info("Dataset %s registered (%s, %d bytes)" % (name, entry['format'], entry['size']))
+        return entry
+
+    def convert(self, entry, path):
+        """ Convert the CSV <path> to columns and update its entry """
+        columns = os.path.join(self.columns, entry['sha256'])
+        tmp = "%s.%s.tmp" % (columns, secrets.token_hex(4))
+        try:
+            with timed(CONVERSION_SECONDS, 'convert csv', kind='csv') as t:
+                convert_csv(path, tmp)
+            try:
+                os.replace(tmp, columns)
+            except OSError:
+                # Converted at the same time by someone else
+                shutil.rmtree(tmp)
+            self._converted(entry, columns)
+            logging.info("Dataset %s converted to columns in %.1fs" % (entry['name'], t.duration))
+        except Exception as e:
+            shutil.rmtree(tmp, ignore_errors=True)
+            entry['status'] = 'failed'
+            entry['error'] = str(e)
+            logging.warning("Could not convert the dataset %s: %s" % (entry['name'], e))
+        self._save(entry)
+
+    def _converted(self, entry, columns):
+        with open(os.path.join(columns, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        entry['schema'] = meta
+        entry['columns'] = os.path.relpath(columns, self.root)
+        entry['status'] = 'ready'
+
+
+def dataset_format(name):
+    ext = os.path.splitext(name)[1].lower()
+    return {'.csv': 'csv', '.npy': 'npy'}.get(ext, 'file')
+
+
+def read_schema(path, fmt):
+    """ Schema of a dataset: the header of a CSV (names only), dtype and shape of a NPY, None for other files """
+    if fmt == 'npy':
+        with open(path, 'rb') as f:
+            version = np.lib.format.read_magic(f)
+            read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) \
+                else np.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(f)
+        return {'dtype': dtype.str, 'shape': list(shape), 'fortran_order': fortran_order}
+    if fmt == 'csv':
+        with open(path, 'r', newline='') as f:
+            header = next(csv.reader(f), [])
+        return {'columns': [{'name': name} for name in header]}
+    return None
+
+
+def _blocks(path):
+    """ The rows of a CSV (without the header) in blocks of BLOCK_ROWS, as columns (tuples of strings) """
+    with open(path, 'r', newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        width = len(header)
+        rows = []
+        for row in reader:
+            if not row:
+                continue
+            if len(row) != width:
+                # Missing values count as empty, additional ones are dropped
+                row = (row + [''] * width)[:width]
+            rows.append(row)
+            if len(rows) == BLOCK_ROWS:
+                yield header, list(zip(*rows))
+                rows = []
+        if rows:
+            yield header, list(zip(*rows))
+
+
+def _floats(values):
+    """ Parse a column as floats, empty values are NaN """
+    try:
+        return np.fromiter(map(float, values), np.float64, len(values))
+    except ValueError:
+        return np.fromiter((float(v) if v.strip() else np.nan for v in values), np.float64, len(values))
+
+
+def _parse(values, kind):
+    """
+    Parse a column as 'int', 'float' or 'str' (or the first of them after <kind> that works).
+    Returns (kind, array)
+    """
+    if kind == 'int':
+        try:
+            return kind, np.fromiter(map(int, values), np.int64, len(values))
+        except ValueError:
+            kind = 'float'
+    if kind == 'float':
+        try:
+            return kind, _floats(values)
+        except ValueError:
+            pass
+    return 'str', np.array([v.encode('utf-8') for v in values])
+
+
+def convert_csv(path, dest):
+    """
+    Convert the CSV <path> (with a header) into the folder <dest>: one .npy per column and meta.json.
+    Columns are int64, float64 (empty values are NaN) or fixed-width UTF-8 bytes.
+    Two passes over the file (types, then data), so only BLOCK_ROWS rows are held in memory
+    """
+    with open(path, 'r', newline='') as f:
+        header = next(csv.reader(f), [])
+    kinds = ['int'] * len(header)
+    widths = [1] * len(header)
+    rows = 0
+    for _, columns in _blocks(path):
+        for i, values in enumerate(columns):
+            kinds[i], array = _parse(values, kinds[i])
+            if kinds[i] == 'str':
+                widths[i] = max(widths[i], array.dtype.itemsize)
+        rows += len(columns[0])
+
+    os.makedirs(dest)
+    dtypes = [np.dtype(np.int64) if kind == 'int' else np.dtype(np.float64) if kind == 'float'
+              else np.dtype('S%d' % width) for kind, width in zip(kinds, widths)]
+    files = ['%d.npy' % i for i in range(len(header))]
+    arrays = [np.lib.format.open_memmap(os.path.join(dest, file), mode='w+', dtype=dtype, shape=(rows,))
+              for file, dtype in zip(files, dtypes)]
+    offset = 0
+    for _, columns in _blocks(path):
+        n = len(columns[0])
+        for values, kind, array in zip(columns, kinds, arrays):
+            array[offset:offset + n] = _parse(values, kind)[1]
+        offset += n
+    for array in arrays:
+        array.flush()
+    del arrays
+
+    meta = {'rows': rows, 'columns': [{'name': name, 'dtype': dtype.str, 'file': file}
+                                      for name, dtype, file in zip(header, dtypes, files)]}
+    with open(os.path.join(dest, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
@@ -0,0 +1,102 @@
+from instrument import timed, IPC_SECONDS, IPC_ERRORS
+import socket
+import struct
+import logging
+import json
+
+# Connection to Scheduler (see Scheduler/ipc.py for the protocol)
+HOST = '127.0.0.1'
+PORT = 65432
+HEADER = struct.Struct('>I')
+
+
+def _recv_exactly(s, n):
+    data = b''
+    while len(data) < n:
+        chunk = s.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError("Scheduler closed the connection")
+        data += chunk
+    return data
+
+
+def request(message, timeout=1.0):
+    """
+    Send a single message to the scheduler and return its answer.
+    Raises OSError if the scheduler can't be reached in time.
+    The round trip is measured in 'frontend_scheduler_ipc_seconds' (see instrument.py)
+    """
+    data = json.dumps(message).encode('utf-8')
+    try:
+        with timed(IPC_SECONDS, 'ipc ' + message['op'], op=message['op']), \
+                socket.create_connection((HOST, PORT), timeout=timeout) as s:
+            s.sendall(HEADER.pack(len(data)) + data)
+            length, = HEADER.unpack(_recv_exactly(s, HEADER.size))
+            return json.loads(_recv_exactly(s, length).decode('utf-8'))
+    except (OSError, ValueError):
+        IPC_ERRORS.labels(op=message['op']).inc()
+        raise
+
+
+def notify_update():
+    """
+    Tell the scheduler that the database changed.
+    The scheduler answers immediately, returns the reconcile generation that will include the change
+    or None if the scheduler isn't reachable (it will still pick up the change with its next reconcile).
+    """
+    try:
+        return request({'op': 'update'})['generation']
+    except (OSError, ValueError, KeyError) as e:
+        logging.warning("Could not reach the scheduler: %s" % e)
+        return None
+
+
+def eta(timeout=0.5):
+    """
+    Expected start and end (unix time) of all queued tasks as {id: (start, end)},
+    empty if the scheduler isn't reachable
+    """
+    try:
+        return {int(_id): tuple(eta) for _id, eta in request({'op': 'eta'}, timeout=timeout)['eta'].items()}
+    except (OSError, ValueError, KeyError) as e:
+        logging.warning("Could not reach the scheduler: %s" % e)
+        return {}
+
+
+def metrics(id=None, last=None, timeout=0.5):
+    """
+    Resource usage measured by the scheduler (see Scheduler/telemetry.py):
+    of the task <id> as {field: [values], 'peaks': {...}} (None if nothing is known)
+    or of all running tasks as {id: {'cpu': [...], 'mem': [...]}} (empty if the scheduler isn't reachable)
+    """
+    try:
+        answer = request({'op': 'metrics', 'id': id, 'last': last}, timeout=timeout)
+    except (OSError, ValueError, KeyError) as e:
+        logging.warning("Could not reach the scheduler: %s" % e)
+        return None if id is not None else {}
+    if id is not None:
+        return answer.get('metrics')
+    return {int(_id): series for _id, series in (answer.get('metrics') or {}).items()}
+
+
+def route(id, timeout=0.5):
+    """
+    '<ip>:<port>' of the Jupyter server of task <id> (for the proxy, see proxy/nginx.conf),
+    None if it isn't running or the scheduler isn't reachable
+    """
+    try:
+        return request({'op': 'route', 'id': id}, timeout=timeout).get('address')
+    except (OSError, ValueError, KeyError) as e:
+        logging.warning("Could not reach the scheduler: %s" % e)
+        return None
+
+
+def wait_for(generation, timeout=10.0):
+    """
+    Block until the scheduler finished reconcile <generation>, returns False on timeout
+    """
+    try:
+        return request({'op': 'wait', 'generation': generation, 'timeout': timeout}, timeout=timeout + 1)['ok']
+    except (OSError, ValueError, KeyError) as e:
+        logging.warning("Could not reach the scheduler: %s" % e)
+        return False
@@ -0,0 +1,159 @@
+from sqlalchemy import create_engine, inspect, Column, Integer, Float, String, Boolean, or_
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import QueuePool
+from instrument import DB_STATEMENT_SECONDS
+# Shared with the scheduler (common/database.py)
+from database import BUSY_TIMEOUT, LockStats, configure_sqlite
+import logging
+import math
+import os
+
+"""
+The task store shared by the website and the scheduler (Scheduler/store.py)
+
+Every insert, update and delete on 'tasks' increases the counter in 'task_seq' (by triggers),
+updated rows get the new value in 'seq'. So readers can ask for the rows changed since their
+last read and detect any change of the table with a single lookup.
+Finished tasks are not deleted but kept with the status 'Done' (or 'Failed' if a headless task failed).
+
+The database is opened in WAL mode (see common/database.py), so reads never wait for the writes of the scheduler.
+Only two writers have to wait for each other, this time is measured in 'lock_stats'.
+"""
+
+# Tasks with one of these statuses are shown and scheduled
+ACTIVE = ['Ready', 'Running', 'Finished']
+
+SCHEMA_DDL = [
+    "CREATE TABLE IF NOT EXISTS task_seq (id INTEGER PRIMARY KEY CHECK (id = 0), value INTEGER NOT NULL)",
+    "INSERT OR IGNORE INTO task_seq VALUES (0, 0)",
+    """CREATE TRIGGER IF NOT EXISTS tasks_insert AFTER INSERT ON tasks BEGIN
+        UPDATE task_seq SET value = value + 1;
+        UPDATE tasks SET seq = (SELECT value FROM task_seq) WHERE id = NEW.id;
+    END""",
+    # Doesn't trigger itself (recursive triggers are off)
+    """CREATE TRIGGER IF NOT EXISTS tasks_update AFTER UPDATE ON tasks BEGIN
+        UPDATE task_seq SET value = value + 1;
+        UPDATE tasks SET seq = (SELECT value FROM task_seq) WHERE id = NEW.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS tasks_delete AFTER DELETE ON tasks BEGIN
+        UPDATE task_seq SET value = value + 1;
+    END""",
+]
+
+# How many connections to keep open
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+
+
+# Connect to database (one engine per process)
+engine = create_engine('sqlite:////mnt/internal/queue.db', convert_unicode=True,
+                       poolclass=QueuePool, pool_size=POOL_SIZE, max_overflow=POOL_SIZE,
+                       connect_args={'check_same_thread': False, 'timeout': BUSY_TIMEOUT / 1000})
+lock_stats = LockStats()
+configure_sqlite(engine, lock_stats, DB_STATEMENT_SECONDS)
+db_session = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
+Base = declarative_base()
+Base.query = db_session.query_property()
+
+
+# Model (as used in the database)
+class Task(Base):
+    __tablename__ = "tasks"
+    # Ids are never reused, they name the folders and jobs of a task
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    id = Column(Integer, primary_key=True)
+    owner = Column(String, index=True)
+    task_type = Column(String)
+    duration = Column(Integer)
+    program = Column(String)
+    status = Column(String, index=True)
+    pwd = Column(String)
+    seq = Column(Integer, index=True)
+    # Requested resources (None: use the default of the scheduler)
+    cpu = Column(Float)
+    mem = Column(Integer)
+    gpu = Column(Integer)
+    # Queue order (see Scheduler/policy.py): priority 0 - 10 and time of submission (unix time)
+    priority = Column(Integer, default=0)
+    submitted = Column(Float)
+    # When the notebook reported 'Running' and 'Finished' (set by the scheduler, to learn runtimes)
+    started = Column(Float)
+    finished = Column(Float)
+    # Peak usage while the task ran: CPU cores and memory in MiB (set by the scheduler, see Scheduler/telemetry.py)
+    peak_cpu = Column(Float)
+    peak_mem = Column(Float)
+    # Array tasks: how many indexes the notebook runs for and how many at once (None: the scheduler decides)
+    array_size = Column(Integer)
+    parallelism = Column(Integer)
+    # Batch mode: the notebook runs without Jupyter and the job stops, the results are shown by the website
+    headless = Column(Boolean, default=False)
+    # Datasets the task reads as JSON [{"name", "sha256", "size", "path"}], copied to its node before it starts
+    datasets = Column(String)
+
+    def __repr__(self):
+        return "%s - %10s - id: %s" % (self.owner, self.task_type, self.id)
+
+    def to_dict(self):
+        """ All columns of the task (without the internals of SQLAlchemy) """
+        task = {c.name: getattr(self, c.name) for c in self.__table__.columns}
+        task['duration'] = int(task['duration'] or 0)
+        return task
+
+
+def create_schema(bind):
+    """
+    Create all tables, indexes and triggers that don't exist yet (the website does at every start)
+    and add the columns and indexes of the model that an older 'tasks' doesn't have yet.
+    Columns are only added, never changed or removed
+    """
+    Base.metadata.create_all(bind=bind)
+    with bind.begin() as connection:
+        inspector = inspect(connection)
+        columns = {column['name'] for column in inspector.get_columns(Task.__tablename__)}
+        for column in Task.__table__.columns:
+            if column.name not in columns:
+                logging.info("Adding the column %s to %s" % (column.name, Task.__tablename__))
+                connection.execute("ALTER TABLE %s ADD COLUMN %s %s" % (
+                    Task.__tablename__, column.name, column.type.compile(dialect=connection.dialect)))
+        indexes = {index['name'] for index in inspector.get_indexes(Task.__tablename__)}
+        for index in Task.__table__.indexes:
+            if index.name not in indexes:
+                index.create(bind=connection)
+        for ddl in SCHEMA_DDL:
+            connection.execute(ddl)
+
+
+def active_tasks():
+    """ All tasks that are not done yet, ordered by id """
+    return Task.query.filter(Task.status.in_(ACTIVE)).order_by(Task.id).all()
+
+
+def finished_results(limit=20):
+    """ The last ended tasks (Done or Failed) whose results are shown by the website (headless and array tasks) """
+    return Task.query.filter(Task.status.in_(['Done', 'Failed']),
+                             or_(Task.headless.is_(True), Task.task_type == 'array')) \
+        .order_by(Task.id.desc()).limit(limit).all()
+
+
+def resource_suggestion(owner, task_type, history=20, headroom=1.2):
+    """
+    Resources for the next task of <owner> from the peak usage of its last <history> tasks of the same type
+    (with <headroom> on top of the 90th percentile). None if fewer than 3 tasks were measured
+    """
+    peaks = Task.query.filter(Task.owner == owner, Task.task_type == task_type, Task.peak_mem.isnot(None))\
+        .order_by(Task.id.desc()).limit(history).all()
+    if len(peaks) < 3:
+        return None
+
+    def p90(values):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(math.ceil(0.9 * len(values))) - 1)]
+    return {'cpu': max(0.1, math.ceil(10 * headroom * p90([t.peak_cpu or 0 for t in peaks])) / 10),
+            'mem': max(100, int(math.ceil(headroom * p90([t.peak_mem for t in peaks]) / 100)) * 100),
+            'tasks': len(peaks)}
+
+
+def generation():
+    """ Increases with every change of the table 'tasks' """
+    return db_session.execute("SELECT value FROM task_seq").scalar()
@@ -0,0 +1,219 @@
+from urllib.parse import urlsplit
+import http.client
+import threading
+import argparse
+import secrets
+import json
+import time
+import os
+
+"""
+Benchmark of the dataset uploads: throughput (MB/s) and the peak memory (RSS) of the website per file size,
+for the old multipart form ('/upload') and the chunked upload (see uploads.py), also when it's resumed.
+
+    python uploadbench.py --url http://127.0.0.1:5000 --pid <pid of gunicorn> [--sizes-mib 1024 10240]
+                          [--modes multipart chunked resume] [--parallel 4]
+
+Run it against a test instance only, the datasets (uploadbench-*.bin) end up in /mnt/data.
+-----
+The data is generated while it's sent (every MiB is unique, so nothing is deduplicated) and never held in memory.
+  multipart  one POST of the file as form field 'file', as the upload page of older versions did it
+  chunked    '/upload/sessions', the chunks sent by <parallel> connections, then the completion
+  resume     as chunked, but the connection is dropped in the middle of the upload and the client asks
+             for the missing chunks and sends only those (shown as 'resent')
+The peak RSS is the largest VmHWM of the process <pid> and its children (the workers of gunicorn), it is reset
+before every upload (/proc/<pid>/clear_refs, the benchmark has to run as the user of the website for that).
+"""
+
+BLOCK = 2 ** 20
+CHUNK = 8 * 2 ** 20
+
+
+class Data:
+    """ <size> bytes of unique data, generated block by block """
+    def __init__(self, size):
+        self.size = size
+        self.seed = secrets.token_hex(8).encode('ascii')
+        self.base = secrets.token_bytes(BLOCK)
+
+    def blocks(self, start, end):
+        """ The data from <start> (a multiple of BLOCK) to <end> """
+        for offset in range(start, end, BLOCK):
+            header = b'%s %d ' % (self.seed, offset)
+            block = header + self.base[len(header):]
+            yield block[:min(BLOCK, end - offset)]
+
+
+class ServerMemory:
+    """ The peak RSS of the website: its process and all children """
+    def __init__(self, pids):
+        self.pids = pids
+
+    def processes(self):
+        found = []
+        todo = list(self.pids)
+        while todo:
+            pid = todo.pop()
+            found.append(pid)
+            try:
+                for tid in os.listdir('/proc/%d/task' % pid):
+                    with open('/proc/%d/task/%s/children' % (pid, tid)) as f:
+                        todo += [int(child) for child in f.read().split()]
+            except OSError:
+                pass
+        return found
+
+    def reset(self):
+        for pid in self.processes():
+            try:
+                with open('/proc/%d/clear_refs' % pid, 'w') as f:
+                    f.write('5')
+            except OSError:
+                pass
+
+    def peak_mib(self):
+        """ None without pids """
+        peaks = []
+        for pid in self.processes():
+            try:
+                with open('/proc/%d/status' % pid) as f:
+                    peaks += [int(line.split()[1]) / 1024 for line in f if line.startswith('VmHWM:')]
+            except OSError:
+                pass
+        return max(peaks) if peaks else None
+
+
+def connect(url, timeout=600):
+    parts = urlsplit(url)
+    return http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=timeout)
+
+
+def request(connection, method, path, body=None, headers=None):
+    connection.request(method, path, body, headers or {})
+    response = connection.getresponse()
+    answer = response.read()
+    if response.status >= 400:
+        raise IOError("%s %s: %d %s" % (method, path, response.status, answer[:200]))
+    return json.loads(answer) if answer else None
+
+
+def upload_multipart(args, data, name):
+    boundary = secrets.token_hex(16)
+    head = ("--%s\r\nContent-Disposition: form-data; name=\"file\"; filename=\"%s\"\r\n"
+            "Content-Type: application/octet-stream\r\n\r\n" % (boundary, name)).encode('utf-8')
+    tail = ("\r\n--%s--\r\n" % boundary).encode('utf-8')
+
+    def body():
+        yield head
+        yield from data.blocks(0, data.size)
+        yield tail
+    connection = connect(args.url)
+    request(connection, 'POST', '/upload', body(),
+            {'Content-Type': 'multipart/form-data; boundary=%s' % boundary,
+             'Content-Length': str(len(head) + data.size + len(tail))})
+    connection.close()
+    return 0
+
+
+def put_chunks(args, data, upload, chunks):
+    """ Send the <chunks> of the <upload> over <parallel> connections """
+    chunks = list(chunks)
+    lock = threading.Lock()
+    errors = []
+
+    def worker():
+        connection = connect(args.url)
+        while True:
+            with lock:
+                if not chunks or errors:
+                    break
+                index = chunks.pop(0)
+            start = index * upload['chunk_size']
+            end = min(start + upload['chunk_size'], data.size)
+            try:
+                request(connection, 'PUT', '/upload/sessions/%s' % upload['id'], data.blocks(start, end),
+                        {'Content-Range': 'bytes %d-%d/%d' % (start, end - 1, data.size),
+                         'Content-Length': str(end - start)})
+            except (OSError, http.client.HTTPException) as e:
+                errors.append(e)
+        connection.close()
+    threads = [threading.Thread(target=worker) for _ in range(args.parallel)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def chunk_length(upload, size, index):
+    return min(upload['chunk_size'], size - index * upload['chunk_size'])
+
+
+def drop_in_chunk(args, data, upload, index):
+    """ Send half of the chunk <index> and close the connection (a client that lost its connection) """
+    start = index * upload['chunk_size']
+    end = start + chunk_length(upload, data.size, index)
+    connection = connect(args.url)
+    connection.putrequest('PUT', '/upload/sessions/%s' % upload['id'])
+    connection.putheader('Content-Range', 'bytes %d-%d/%d' % (start, end - 1, data.size))
+    connection.putheader('Content-Length', str(end - start))
+    connection.endheaders()
+    for block in data.blocks(start, start + (end - start) // 2):
+        connection.send(block)
+    connection.close()
+
+
+def upload_chunked(args, data, name, resume=False):
+    """ Returns the bytes that were sent again """
+    connection = connect(args.url)
+    upload = request(connection, 'POST', '/upload/sessions',
+                     json.dumps({'filename': name, 'size': data.size, 'chunk_size': CHUNK}),
+                     {'Content-Type': 'application/json'})
+    chunks = list(range(upload['chunks']))
+    resent = 0
+    if resume:
+        half = len(chunks) // 2
+        put_chunks(args, data, upload, chunks[:half])
+        drop_in_chunk(args, data, upload, half)
+        missing = request(connection, 'GET', '/upload/sessions/%s' % upload['id'])['missing']
+        # Sent before the connection was dropped and sent again: what the server didn't keep
+        resent = sum(chunk_length(upload, data.size, i) // (2 if i == half else 1) for i in missing if i <= half)
+        chunks = missing
+    put_chunks(args, data, upload, chunks)
+    request(connection, 'POST', '/upload/sessions/%s/complete' % upload['id'], '{}',
+            {'Content-Type': 'application/json'})
+    connection.close()
+    return resent
+
+
+MODES = {'multipart': upload_multipart,
+         'chunked': upload_chunked,
+         'resume': lambda args, data, name: upload_chunked(args, data, name, resume=True)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help="address of the website")
+    parser.add_argument('--pid', type=int, nargs='*', default=[], help="process of the website (e.g. gunicorn)")
+    parser.add_argument('--sizes-mib', type=int, nargs='+', default=[1024, 10240])
+    parser.add_argument('--modes', nargs='+', default=list(MODES), choices=list(MODES))
+    parser.add_argument('--parallel', type=int, default=4, help="connections of a chunked upload")
+    args = parser.parse_args()
+
+    memory = ServerMemory(args.pid)
+    print("%-10s %9s %9s %9s %14s %10s" % ('mode', 'size MiB', 'seconds', 'MB/s', 'peak RSS MiB', 'resent MiB'))
+    for size in args.sizes_mib:
+        for mode in args.modes:
+            data = Data(size * 2 ** 20)
+            memory.reset()
+            start = time.perf_counter()
+            resent = MODES[mode](args, data, 'uploadbench-%s.bin' % secrets.token_hex(4))
+            seconds = time.perf_counter() - start
+            peak = memory.peak_mib()
+            print("%-10s %9d %9.1f %9.1f %14s %10.1f" % (mode, size, seconds, data.size / seconds / 1e6,
+                                                        '-' if peak is None else "%.0f" % peak, resent / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
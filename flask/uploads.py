@@ -0,0 +1,277 @@
+from werkzeug.utils import secure_filename
+from instrument import measured, FILE_SECONDS
+import hashlib
+import secrets
+import json
+import time
+import os
+import re
+
+"""
+Chunked, resumable uploads of datasets.
+
+An upload session is created with the name and size of the file. Its data goes straight into a
+preallocated file next to the target (<root>/.uploads/<id>.part), every chunk is written with pwrite
+at its offset, so chunks can be sent in any order and in parallel, also by different workers.
+Which chunks arrived is kept in <id>.map (one byte per chunk), a client that lost its connection
+asks for the session and only sends the missing chunks again.
+When all chunks are there the file is checked against the SHA-256 given by the client
+(if there is one) and moved to its place, only once if the completion is sent twice.
+With a BlobStore (see blobs.py) the file is stored by its SHA-256 and only linked to its name,
+a file that is there already isn't uploaded at all.
+-----
+A chunk may come with the header 'X-Chunk-Sha256', it is only counted if its data matches.
+"""
+
+DEFAULT_CHUNK = 8 * 2 ** 20
+MIN_CHUNK = 2 ** 20
+MAX_CHUNK = 64 * 2 ** 20
+# Read/write in pieces of this size, so nothing is held in memory
+BLOCK = 2 ** 20
+# Sessions that weren't touched for this long are removed
+MAX_AGE = 24 * 3600
+
+SESSION_ID = re.compile(r'^[0-9a-f]{32}$')
+CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+
+class UploadError(Exception):
+    """ Error of a request, with the HTTP status to answer with """
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class UploadSessions:
+    def __init__(self, root, blobs=None):
+        self.root = root
+        self.folder = os.path.join(root, '.uploads')
+        self.blobs = blobs
+
+    def _path(self, session_id, ext):
+        if not SESSION_ID.match(session_id):
+            raise UploadError("Unknown upload %s" % session_id, 404)
+        return os.path.join(self.folder, "%s.%s" % (session_id, ext))
+
+    def load(self, session_id):
+        try:
+            with open(self._path(session_id, 'json'), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise UploadError("Unknown upload %s" % session_id, 404)
+
+    def create(self, filename, size, chunk_size=DEFAULT_CHUNK, sha256=None):
+        """
+        Start an upload of <size> bytes, the space is allocated right away.
+        Returns the session (a dict with its id), or with 'deduplicated' if the file with
+        this SHA-256 is stored already, it's linked to its name then and nothing has to be sent
+        """
+        filename = secure_filename(filename or '')
+        if not filename:
+            raise UploadError("No file name")
+        if size < 0:
+            raise UploadError("Invalid size")
+        if sha256 is not None and not re.match(r'^[0-9a-fA-F]{64}$', sha256):
+            raise UploadError("Invalid SHA-256")
+        chunk_size = min(max(int(chunk_size), MIN_CHUNK), MAX_CHUNK)
+        if sha256 is not None and self.blobs is not None and self.blobs.has(sha256):
+            self.blobs.link(sha256, os.path.join(self.root, filename))
+            return {'id': None, 'filename': filename, 'size': size, 'chunk_size': chunk_size, 'chunks': 0,
+                    'sha256': sha256.lower(), 'deduplicated': True, 'received': [], 'missing': []}
+        os.makedirs(self.folder, exist_ok=True)
+        self.cleanup()
+
+        session = {'id': secrets.token_hex(16), 'filename': filename, 'size': size, 'chunk_size': chunk_size,
+                   'chunks': (size + chunk_size - 1) // chunk_size, 'sha256': sha256 and sha256.lower(),
+                   'created': time.time()}
+        fd = os.open(self._path(session['id'], 'part'), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            if size > 0:
+                try:
+                    os.posix_fallocate(fd, 0, size)
+                except (AttributeError, OSError):
+                    # Not supported by the file system, the file is at least sized
+                    os.ftruncate(fd, size)
+        except OSError as e:
+            os.close(fd)
+            os.remove(self._path(session['id'], 'part'))
+            raise UploadError("Not enough space for %d bytes: %s" % (size, e), 507)
+        os.close(fd)
+        with open(self._path(session['id'], 'map'), 'wb') as f:
+            f.truncate(session['chunks'])
+        with open(self._path(session['id'], 'json'), 'w') as f:
+            json.dump(session, f)
+        return session
+
+    def received(self, session):
+        """ Indexes of all chunks that arrived """
+        with open(self._path(session['id'], 'map'), 'rb') as f:
+            chunk_map = f.read()
+        return [i for i, done in enumerate(chunk_map) if done]
+
+    def status(self, session_id):
+        session = self.load(session_id)
+        received = self.received(session)
+        return dict(session, received=received, missing=sorted(set(range(session['chunks'])) - set(received)))
+
+    @measured(FILE_SECONDS, 'upload write', operation='upload_write')
+    def write(self, session_id, content_range, stream, sha256=None):
+        """
+        Input: content_range - the header 'Content-Range: bytes <start>-<end>/<size>',
+                               the range has to start at a chunk and contain whole chunks
+               stream - the request body
+               sha256 - the SHA-256 of the data (optional)
+        -----
+        Writes the data directly into the file, returns the indexes of the chunks that were written
+        """
+        session = self.load(session_id)
+        match = CONTENT_RANGE.match(content_range or '')
+        if match is None:
+            raise UploadError("Content-Range 'bytes <start>-<end>/<size>' is missing")
+        start, end, size = [int(x) for x in match.groups()]
+        end += 1
+        chunk_size = session['chunk_size']
+        if size != session['size'] or start % chunk_size or end <= start or \
+                (end % chunk_size and end != size) or end > size:
+            raise UploadError("Range %d-%d doesn't cover whole chunks of %d bytes" % (start, end - 1, chunk_size), 416)
+
+        digest = hashlib.sha256() if sha256 else None
+        fd = os.open(self._path(session_id, 'part'), os.O_WRONLY)
+        try:
+            offset = start
+            while offset < end:
+                data = stream.read(min(BLOCK, end - offset))
+                if not data:
+                    break
+                if digest is not None:
+                    digest.update(data)
+                view = memoryview(data)
+                while view:
+                    written = os.pwrite(fd, view, offset)
+                    offset += written
+                    view = view[written:]
+        finally:
+            os.close(fd)
+        if offset != end:
+            # The client disconnected, the chunks are sent again
+            raise UploadError("Got %d of %d bytes" % (offset - start, end - start))
+        if digest is not None and digest.hexdigest() != sha256.lower():
+            raise UploadError("SHA-256 of the data doesn't match", 422)
+
+        chunks = list(range(start // chunk_size, (end + chunk_size - 1) // chunk_size))
+        map_fd = os.open(self._path(session_id, 'map'), os.O_WRONLY)
+        try:
+            os.pwrite(map_fd, b'\x01' * len(chunks), chunks[0])
+        finally:
+            os.close(map_fd)
+        return chunks
+
+    @measured(FILE_SECONDS, 'upload complete', operation='upload_complete')
+    def complete(self, session_id, sha256=None):
+        """
+        Check that all chunks arrived and the SHA-256 of the file (if given now or at the start)
+        and move the file to its place. Returns the path, the SHA-256 and whether this call completed the upload.
+        -----
+        The request that renames <id>.part to <id>.completing completes the upload, others that come at the
+        same time (also from other workers) wait for it and get its result, which is kept in <id>.done
+        """
+        done = self.finished(session_id)
+        if done is not None:
+            return done + (False,)
+        try:
+            session = self.load(session_id)
+        except UploadError:
+            # Completed and removed in the meantime
+            done = self.finished(session_id)
+            if done is None:
+                raise
+            return done + (False,)
+        part = self._path(session_id, 'part')
+        claimed = self._path(session_id, 'completing')
+        try:
+            os.rename(part, claimed)
+        except FileNotFoundError:
+            return self.wait_finished(session_id) + (False,)
+
+        try:
+            missing = session['chunks'] - len(self.received(session))
+            if missing:
+                raise UploadError("%d chunks are missing" % missing, 409)
+            expected = (sha256 or session['sha256'] or '').lower()
+            digest = None
+            if expected or self.blobs is not None:
+                digest = file_sha256(claimed)
+                if expected and digest != expected:
+                    self.abort(session_id)
+                    raise UploadError("SHA-256 of the file doesn't match (%s)" % digest, 422)
+            fd = os.open(claimed, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            target = os.path.join(self.root, session['filename'])
+            if self.blobs is not None:
+                self.blobs.add_file(claimed, digest)
+                self.blobs.link(digest, target)
+            else:
+                os.replace(claimed, target)
+        except BaseException:
+            # Can be completed again (after the missing chunks were sent)
+            try:
+                os.rename(claimed, part)
+            except FileNotFoundError:
+                pass
+            raise
+        with open(self._path(session_id, 'done.tmp'), 'w') as f:
+            json.dump({'path': target, 'sha256': digest}, f)
+        os.replace(self._path(session_id, 'done.tmp'), self._path(session_id, 'done'))
+        self.abort(session_id)
+        return target, digest, True
+
+    def finished(self, session_id):
+        """ (path, SHA-256) of a completed upload, None if it isn't completed """
+        try:
+            with open(self._path(session_id, 'done'), 'r') as f:
+                done = json.load(f)
+        except FileNotFoundError:
+            return None
+        return done['path'], done['sha256']
+
+    def wait_finished(self, session_id, interval=0.1):
+        """ Wait for the request that completes the upload (see 'complete'), returns its (path, SHA-256) """
+        while os.path.exists(self._path(session_id, 'completing')):
+            time.sleep(interval)
+        done = self.finished(session_id)
+        if done is None:
+            raise UploadError("The upload %s couldn't be completed, check its missing chunks" % session_id, 409)
+        return done
+
+    def abort(self, session_id):
+        for ext in ('part', 'completing', 'map', 'json'):
+            try:
+                os.remove(self._path(session_id, ext))
+            except FileNotFoundError:
+                pass
+
+    def cleanup(self):
+        """ Remove sessions that weren't touched for MAX_AGE """
+        now = time.time()
+        for name in os.listdir(self.folder):
+            session_id, ext = os.path.splitext(name)
+            if ext in ('.map', '.done') and SESSION_ID.match(session_id) and \
+                    os.stat(os.path.join(self.folder, name)).st_mtime < now - MAX_AGE:
+                self.abort(session_id)
+                if ext == '.done':
+                    os.remove(os.path.join(self.folder, name))
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    buffer = bytearray(BLOCK)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            digest.update(memoryview(buffer)[:n])
+    return digest.hexdigest()
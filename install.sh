@@ -12,10 +12,10 @@ sudo cp -i /etc/kubernetes/admin.conf $HOME/.kube/config
 sudo chown $(id -u):$(id -g) $HOME/.kube/config
 sudo mkdir -p /mnt/sharedfolder/data
 sudo mkdir -p /mnt/sharedfolder/internal
-sudo cp -i flask/queue.db /mnt/sharedfolder/internal
-sudo docker image build -t flask:1.0 flask/
-sudo docker image build -t scheduler:1.0 Scheduler/
+sudo docker image build -t flask:1.0 -f flask/Dockerfile .
+sudo docker image build -t scheduler:1.0 -f Scheduler/Dockerfile .
 sudo docker image build -t notebookserver:1.0 jupyter/
+sudo docker image build -t proxy:1.0 proxy/
 cd Kubernetes/
 kubectl apply -f kube-flannel.yaml
 kubectl taint node --all node-role.kubernetes.io/master:NoSchedule-
@@ -0,0 +1,69 @@
+from batch import execute
+import nbformat
+import json
+import time
+import sys
+import os
+
+"""
+Runs one index of an array task (started by entrypoint.sh in every pod of the Indexed Job):
+
+    python /array_index.py /scripts <notebook> <index>
+
+The notebook gets a cell with the parameters of the index (like papermill: after the cell tagged
+'parameters' or at the top): ARRAY_INDEX, ARRAY_SIZE and, if the task has a 'sweep.json' with a list,
+every key of its entry <index> as a variable. It's executed in '<index>/' (its own copy, the outputs of
+the index and its log 'output.log' land there as well, see batch.py) and the status of the index is written to '<index>/.status'
+('Running', 'Finished' or 'Failed'). A failed index exits with an error, so Kubernetes retries it.
+"""
+
+SWEEP_FILE = 'sweep.json'
+
+
+def report_status(folder, status):
+    with open(os.path.join(folder, '.status.tmp'), 'w') as f:
+        f.write("%s %f\n" % (status, time.time()))
+    os.replace(os.path.join(folder, '.status.tmp'), os.path.join(folder, '.status'))
+
+
+def parameters(root, index):
+    params = {'ARRAY_INDEX': index, 'ARRAY_SIZE': int(os.environ.get('ARRAY_SIZE', 0))}
+    try:
+        with open(os.path.join(root, SWEEP_FILE), 'r') as f:
+            sweep = json.load(f)
+    except (OSError, ValueError):
+        sweep = None
+    if isinstance(sweep, list) and index < len(sweep) and isinstance(sweep[index], dict):
+        params.update({k: v for k, v in sweep[index].items() if str(k).isidentifier()})
+    return params
+
+
+def inject(nb, params):
+    """ Add the cell with the parameters after the one tagged 'parameters' (or as first cell) """
+    cell = nbformat.v4.new_code_cell("# Parameters\n" + "".join("%s = %r\n" % item for item in params.items()))
+    cell.metadata['tags'] = ['injected-parameters']
+    position = 0
+    for i, c in enumerate(nb.cells):
+        if 'parameters' in c.get('metadata', {}).get('tags', []):
+            position = i + 1
+            break
+    nb.cells.insert(position, cell)
+
+
+def main(root, program, index):
+    folder = os.path.join(root, str(index))
+    os.makedirs(folder, exist_ok=True)
+    report_status(folder, 'Running')
+    nb = nbformat.read(os.path.join(root, program), as_version=4)
+    inject(nb, parameters(root, index))
+    path = os.path.join(folder, os.path.basename(program))
+
+    # The modules of the task are in <root>, the notebook runs in <folder>
+    os.environ['PYTHONPATH'] = os.pathsep.join(p for p in (root, os.environ.get('PYTHONPATH')) if p)
+    success = execute(path, os.path.join(folder, 'output.log'), nb)
+    report_status(folder, 'Finished' if success else 'Failed')
+    return 0 if success else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1], sys.argv[2], int(sys.argv[3])))
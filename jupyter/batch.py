@@ -0,0 +1,82 @@
+from nbconvert.preprocessors import ExecutePreprocessor, CellExecutionError
+import nbformat
+import sys
+import re
+import os
+
+"""
+Runs a notebook without a Jupyter server (batch mode, started by entrypoint.sh):
+
+    python /batch.py [--allow-errors] <notebook> <log>
+
+The cells are executed one after the other, the notebook is saved after every cell (so the website
+shows the progress, see '/tasks/<id>/view') and everything the cells print is appended to <log>
+as soon as it arrives. Stops at the first cell that fails (the notebook then shows the error),
+with --allow-errors all cells run (before the notebook is opened in Jupyter).
+"""
+
+# Colors of tracebacks, the log is plain text
+ANSI = re.compile(r'\x1b\[[0-9;]*m')
+
+
+class StreamingExecutor(ExecutePreprocessor):
+    """ Saves the notebook after every cell and writes the output of the cells to a log """
+    def __init__(self, path, log, **kwargs):
+        super().__init__(timeout=None, **kwargs)
+        self.path = path
+        self.log_file = log
+        self.notebook = None
+
+    def preprocess(self, nb, resources=None, km=None):
+        self.notebook = nb
+        return super().preprocess(nb, resources, km)
+
+    def preprocess_cell(self, cell, resources, index):
+        try:
+            return super().preprocess_cell(cell, resources, index)
+        finally:
+            self.save()
+
+    def process_message(self, msg, cell, cell_index):
+        content = msg.get('content', {})
+        if msg.get('msg_type') == 'stream':
+            self.write(content.get('text', ''))
+        elif msg.get('msg_type') == 'error':
+            self.write(ANSI.sub('', "\n".join(content.get('traceback', []))) + "\n")
+        return super().process_message(msg, cell, cell_index)
+
+    def write(self, text):
+        self.log_file.write(text)
+        self.log_file.flush()
+
+    def save(self):
+        if self.notebook is not None:
+            nbformat.write(self.notebook, self.path + '.tmp')
+            os.replace(self.path + '.tmp', self.path)
+
+
+def execute(path, log_path, nb=None, allow_errors=False):
+    """
+    Input: path - the notebook, it's replaced by the executed one
+           log_path - file the output of the cells is appended to
+           nb - the notebook to run instead of the one at <path>
+           allow_errors - run the remaining cells after a cell failed
+    -----
+    Runs the notebook in its folder, returns False if a cell failed (and stopped the notebook)
+    """
+    nb = nb or nbformat.read(path, as_version=4)
+    with open(log_path, 'a') as log:
+        executor = StreamingExecutor(path, log, allow_errors=allow_errors)
+        try:
+            executor.preprocess(nb, {'metadata': {'path': os.path.dirname(os.path.abspath(path))}})
+        except CellExecutionError:
+            return False
+        finally:
+            executor.save()
+    return True
+
+
+if __name__ == '__main__':
+    allow_errors = '--allow-errors' in sys.argv
+    args = [arg for arg in sys.argv[1:] if arg != '--allow-errors']
+    sys.exit(0 if execute(args[0], args[1], allow_errors=allow_errors) else 1)
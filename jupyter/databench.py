@@ -0,0 +1,130 @@
+import subprocess
+import statistics
+import argparse
+import tempfile
+import shutil
+import json
+import time
+import sys
+import os
+
+"""
+Benchmark of loading a dataset in a notebook: parsing the CSV in every job against the columns of the registry
+that are mapped into memory (dataregistry.load, see flask/registry.py for the conversion).
+
+    python databench.py [--rows 2000000] [--jobs 1 4] [--methods read loadtxt mmap] [--repeat 3]
+
+A CSV of <rows> rows (int, two floats, a short string) is registered and converted in a temporary folder,
+then <jobs> processes load it at the same time, each with one method:
+  read     open().read() of the whole file (the pattern of dataset_test.py, nothing parsed yet)
+  loadtxt  np.loadtxt of the numeric columns, i.e. parsed into arrays of its own
+  mmap     dataregistry.load, then every numeric column is summed so all its pages are really read
+Reported per job (median of <repeat> runs): the load time and, while all jobs still hold the data, its memory
+from /proc/self/smaps_rollup: RSS, PSS (shared pages split between the jobs) and the private pages.
+The file is in the page cache for all methods (it was just written), the load time doesn't include the disk.
+"""
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+WEBSITE = os.path.join(HERE, '..', 'flask')
+COMMON = os.path.join(HERE, '..', 'common')
+NAME = 'bench.csv'
+
+
+def create_dataset(root, rows):
+    """ The CSV <root>/bench.csv, registered and converted to columns by the registry of the website """
+    with open(os.path.join(root, NAME), 'w') as f:
+        f.write("id,x,y,label\n")
+        for i in range(rows):
+            f.write("%d,%.6f,%.3f,l%d\n" % (i, i * 0.001, (i % 1000) / 7, i % 100))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([WEBSITE, COMMON]))
+    subprocess.run([sys.executable, '-c', "import sys, os, registry; r = registry.DatasetRegistry(sys.argv[1]); "
+                                          "path = os.path.join(sys.argv[1], sys.argv[2]); "
+                                          "r.convert(r.register(path), path)", root, NAME],
+                   cwd=WEBSITE, env=env, check=True)
+
+
+def memory():
+    """ {Rss, Pss, Private} of this process in MiB """
+    values = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                values[parts[0].rstrip(':')] = int(parts[1]) / 1024
+    return {'Rss': values['Rss'], 'Pss': values['Pss'],
+            'Private': values['Private_Clean'] + values['Private_Dirty']}
+
+
+def job(method):
+    """ One notebook: load the dataset, say so and keep it until the benchmark has the memory of all jobs """
+    import numpy as np
+    path = os.path.join(os.environ['DATA_DIR'], NAME)
+    base = memory()
+    start = time.perf_counter()
+    if method == 'read':
+        with open(path) as f:
+            data = f.read()
+    elif method == 'loadtxt':
+        data = np.loadtxt(path, delimiter=',', skiprows=1, usecols=(0, 1, 2))
+        data[:, 1].sum()
+    else:
+        sys.path.insert(0, HERE)
+        import dataregistry
+        data = dataregistry.load(NAME)
+        for column in ('id', 'x', 'y'):
+            data[column].sum()
+    seconds = time.perf_counter() - start
+    print('ready', flush=True)
+    sys.stdin.readline()
+    used = memory()
+    print(json.dumps(dict({key: used[key] - base[key] for key in used}, seconds=seconds)), flush=True)
+    del data
+
+
+def run(root, method, jobs):
+    """ Start <jobs> jobs at once, returns the mean of their results """
+    env = dict(os.environ, DATA_DIR=root)
+    processes = [subprocess.Popen([sys.executable, os.path.abspath(__file__), '--job', method], env=env,
+                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+                 for _ in range(jobs)]
+    for process in processes:
+        assert process.stdout.readline().strip() == 'ready'
+    results = []
+    for process in processes:
+        process.stdin.write('\n')
+        process.stdin.flush()
+        results.append(json.loads(process.stdout.readline()))
+    for process in processes:
+        process.wait()
+    return {key: statistics.mean(result[key] for result in results) for key in results[0]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=2000000)
+    parser.add_argument('--jobs', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--methods', nargs='+', default=['read', 'loadtxt', 'mmap'])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--job', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.job:
+        job(args.job)
+        return
+
+    root = tempfile.mkdtemp(prefix='databench-')
+    try:
+        create_dataset(root, args.rows)
+        print("%d rows, CSV %.1f MiB" % (args.rows, os.path.getsize(os.path.join(root, NAME)) / 2 ** 20))
+        print("%-8s %5s %10s %9s %9s %12s" % ('method', 'jobs', 'load ms', 'RSS MiB', 'PSS MiB', 'private MiB'))
+        for jobs in args.jobs:
+            for method in args.methods:
+                runs = [run(root, method, jobs) for _ in range(args.repeat)]
+                result = {key: statistics.median(r[key] for r in runs) for key in runs[0]}
+                print("%-8s %5d %10.1f %9.1f %9.1f %12.1f" % (method, jobs, result['seconds'] * 1000, result['Rss'],
+                                                              result['Pss'], result['Private']))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+import numpy as np
+import json
+import os
+
+"""
+Datasets of the server (/data) as NumPy arrays that are mapped into memory, not read.
+
+    import dataregistry
+    dataregistry.names()                 # all registered datasets
+    dataregistry.info('measurements.csv')    # size, SHA-256, schema, status
+    columns = dataregistry.load('measurements.csv')
+    columns['temperature'].mean()
+
+A CSV that was converted at upload time (see flask/registry.py) is loaded as {column: array},
+a NPY file as one array. The arrays are read-only views of the files: nothing is parsed or copied,
+only the pages that are used are read and all jobs on a node share them in the page cache.
+Datasets the task was started with were copied to the local disk of the node before (LOCAL_DATA, see stage.py),
+they are mapped from there instead of the shared volume. 'dataregistry.path(name)' is where to open other files.
+"""
+
+DATA_DIR = os.environ.get('DATA_DIR', '/data')
+REGISTRY_DIR = os.path.join(DATA_DIR, '.registry')
+LOCAL_DIR = os.environ.get('LOCAL_DATA', '/localdata')
+
+
+def names():
+    if not os.path.isdir(REGISTRY_DIR):
+        return []
+    return sorted(name[:-5] for name in os.listdir(REGISTRY_DIR) if name.endswith('.json'))
+
+
+def info(name):
+    """ The registry entry of the dataset <name> """
+    try:
+        with open(os.path.join(REGISTRY_DIR, name + '.json'), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise KeyError("Dataset %s isn't registered" % name)
+
+
+def local(entry):
+    """ The copy of a dataset on the local disk of the node (a folder), None if there is none """
+    folder = os.path.join(LOCAL_DIR, entry['sha256'])
+    return folder if os.path.isdir(folder) else None
+
+
+def path(name):
+    """ Where to open the file of the dataset <name>: its local copy if there is one, otherwise in /data """
+    folder = local(info(name))
+    if folder is not None and os.path.isfile(os.path.join(folder, name)):
+        return os.path.join(folder, name)
+    return os.path.join(DATA_DIR, name)
+
+
+def load(name):
+    """
+    Input: name - file name of the dataset in /data
+    -----
+    Returns {column name: read-only array} for a converted CSV, a read-only array for a NPY file
+    """
+    entry = info(name)
+    if entry['format'] == 'npy':
+        return np.load(path(name), mmap_mode='r')
+    if entry.get('columns'):
+        folder = local(entry) or os.path.join(DATA_DIR, entry['columns'])
+        return {column['name']: np.load(os.path.join(folder, column['file']), mmap_mode='r')
+                for column in entry['schema']['columns']}
+    if entry['status'] == 'converting':
+        raise ValueError("Dataset %s is still being converted, try again later" % name)
+    raise ValueError("Dataset %s wasn't converted (status %s), open %s instead"
+                     % (name, entry['status'], os.path.join(DATA_DIR, name)))
@@ -1,9 +1,71 @@
 #!/bin/bash
-jupyter notebook --generate-config && \
+# Report status transitions to the scheduler (read by Scheduler/status.py)
+report_status() {
+    echo "$1 $(date +%s.%N)" > /scripts/.status.tmp && mv /scripts/.status.tmp /scripts/.status
+}
+if [ -n "${JOB_COMPLETION_INDEX}" ]; then
+    # One index of an array task (see array_index.py): run the notebook with its parameters and stop
+    if [ -f /scripts/.env ]; then . /scripts/.env; fi
+    echo "Running $(date +%s.%N)" > /scripts/.status.${JOB_COMPLETION_INDEX} && \
+        mv /scripts/.status.${JOB_COMPLETION_INDEX} /scripts/.status
+    exec python /array_index.py /scripts "${PY_FILE}" ${JOB_COMPLETION_INDEX}
+fi
+if [ -n "${HEADLESS}" ]; then
+    # Batch mode: run the notebook (see batch.py) or script without Jupyter and stop, the website shows the results
+    if [ -f /scripts/.env ]; then . /scripts/.env; fi
+    python /telemetry.py /scripts/.metrics &
+    report_status Running
+    if [[ "${PY_FILE}" == *.py ]]; then
+        # As 'python -m <module>' in its folder, with the upload root (/scripts) on the path: a main in a subfolder
+        # is part of its package (relative imports work), modules next to it are found as well.
+        # Paths that aren't module names (e.g. 'my-code/main.py') run as 'python <script>'.
+        # Unbuffered so the log is always up to date.
+        # Signals (e.g. when the task is deleted) are passed on, bash as PID 1 would ignore them
+        MODULE="${PY_FILE%.py}"
+        MODULE="${MODULE//\//.}"
+        cd "$(dirname "/scripts/${PY_FILE}")"
+        trap 'kill -TERM ${CHILD} 2>/dev/null' TERM INT
+        if [[ "${MODULE}" =~ ^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)*$ ]]; then
+            PYTHONPATH="/scripts${PYTHONPATH:+:${PYTHONPATH}}" PYTHONUNBUFFERED=1 \
+                python -u -m "${MODULE}" >> /scripts/output.log 2>&1 &
+        else
+            PYTHONUNBUFFERED=1 python -u "/scripts/${PY_FILE}" >> /scripts/output.log 2>&1 &
+        fi
+        CHILD=$!
+        wait ${CHILD}; CODE=$?
+        while kill -0 ${CHILD} 2>/dev/null; do wait ${CHILD}; CODE=$?; done
+        echo "[exit code ${CODE}]" >> /scripts/output.log
+    else
+        python /batch.py "/scripts/${PY_FILE}" /scripts/output.log
+        CODE=$?
+    fi
+    # The pod ends successfully either way, Kubernetes would run the task again otherwise
+    if [ ${CODE} -eq 0 ]; then report_status Finished; else report_status Failed; fi
+    exit 0
+fi
+if [ -n "${WARM_POOL}" ]; then
+    # Warm pod (see Scheduler/warmpool.py): initialise Jupyter and wait until the scheduler assigns a task,
+    # /scripts becomes the folder of the task then
+    jupyter notebook --generate-config
+    while [ ! -f /scripts/.assigned ]; do sleep 0.1; done
+    # One field per line (the file name may contain spaces)
+    { read -r OWNER; read -r ID; read -r PY_FILE; read -r JUPYTER_PWD; } < /scripts/.assigned
+    rm /scripts/.assigned
+    report_status Ready
+else
+    report_status Ready
+    jupyter notebook --generate-config
+fi
+# Environment of a task added with others in a batch (see '/tasks/batch' in flask/app.py)
+if [ -f /scripts/.env ]; then . /scripts/.env; fi
+# Resource usage of this container for the scheduler (see telemetry.py)
+python /telemetry.py /scripts/.metrics &
 cd /root/.jupyter/ && \
 echo "c.NotebookApp.password = u'${JUPYTER_PWD}'" >> jupyter_notebook_config.py
-echo 'JUPYTER_STATUS=Running' >> ~/.bashrc
-jupyter nbconvert --to=notebook --allow-errors --inplace --execute /scripts/${PY_FILE}
-echo 'JUPYTER_STATUS=Finished' >> ~/.bashrc
+report_status Running
+# Outputs are saved after every cell and streamed to output.log (shown by the website while it runs)
+python /batch.py --allow-errors "/scripts/${PY_FILE}" /scripts/output.log
+report_status Finished
 cd /scripts
-jupyter notebook --port=8888 --no-browser --ip=0.0.0.0 --allow-root
+# Reached through the proxy of the website (see proxy/nginx.conf)
+jupyter notebook --port=8888 --no-browser --ip=0.0.0.0 --allow-root --NotebookApp.base_url=/nb/${ID}/
@@ -0,0 +1,95 @@
+import secrets
+import shutil
+import json
+import time
+import os
+
+"""
+Copies the datasets of a task from the shared volume to the local disk of the node, run by the
+init container of the job before the notebook starts (see 'create_job' in Scheduler/schedule.py):
+
+    DATASETS='[{"name", "sha256", "size", "path"}]' NODE_NAME=<node> python /stage.py
+
+Every dataset goes to /localdata/<sha256>/ (the file, or the columns of a converted CSV), where 'dataregistry'
+finds it. Datasets that are there already are only marked as used. For every dataset on the node there is
+a marker /locality/<node>/<sha256> with its size, so the scheduler places the next tasks that read it here
+(see Scheduler/locality.py).
+When the datasets on the node would take more than LOCAL_DATA_LIMIT GiB, those used the longest time ago
+are deleted (their marker first). Notebooks that still map them keep reading them until they are closed.
+"""
+
+DATA_DIR = '/data'
+LOCAL_DIR = '/localdata'
+LOCALITY_DIR = '/locality'
+
+
+def folder_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def evict(needed, keep, limit, markers):
+    """ Delete the datasets used the longest time ago (but not those in <keep>) until <needed> bytes fit """
+    staged = []
+    for sha256 in os.listdir(LOCAL_DIR):
+        path = os.path.join(LOCAL_DIR, sha256)
+        if not sha256.startswith('.') and os.path.isdir(path):
+            staged.append((os.path.getmtime(path), sha256, folder_size(path)))
+    used = sum(size for _, _, size in staged)
+    for _, sha256, size in sorted(staged):
+        if used + needed <= limit:
+            break
+        if sha256 in keep:
+            continue
+        try:
+            os.remove(os.path.join(markers, sha256))
+        except FileNotFoundError:
+            pass
+        shutil.rmtree(os.path.join(LOCAL_DIR, sha256), ignore_errors=True)
+        used -= size
+        print("Evicted %s (%d bytes)" % (sha256, size), flush=True)
+
+
+def copy(dataset, dest):
+    """ Copy a dataset to <dest> (atomically, another pod on the node may copy it at the same time) """
+    source = os.path.join(DATA_DIR, dataset['path'])
+    tmp = os.path.join(LOCAL_DIR, ".%s.%s.tmp" % (dataset['sha256'], secrets.token_hex(4)))
+    try:
+        if os.path.isdir(source):
+            shutil.copytree(source, tmp)
+        else:
+            os.makedirs(tmp)
+            shutil.copyfile(source, os.path.join(tmp, os.path.basename(source)))
+        try:
+            os.rename(tmp, dest)
+        except OSError:
+            # Copied by another pod in the meantime
+            pass
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def stage(datasets, node, limit):
+    """ Copy all <datasets> that are not on this node yet, returns the number of bytes copied """
+    markers = os.path.join(LOCALITY_DIR, node)
+    os.makedirs(markers, exist_ok=True)
+    copied = 0
+    for dataset in datasets:
+        dest = os.path.join(LOCAL_DIR, dataset['sha256'])
+        start = time.time()
+        if os.path.isdir(dest):
+            os.utime(dest)
+            print("%s is on this node already" % dataset['name'], flush=True)
+        else:
+            evict(int(dataset['size']), {d['sha256'] for d in datasets}, limit, markers)
+            copy(dataset, dest)
+            copied += int(dataset['size'])
+            print("Copied %s (%d bytes) in %.1fs" % (dataset['name'], int(dataset['size']), time.time() - start),
+                  flush=True)
+        with open(os.path.join(markers, dataset['sha256']), 'w') as f:
+            f.write(str(folder_size(dest)))
+    return copied
+
+
+if __name__ == '__main__':
+    stage(json.loads(os.environ.get('DATASETS') or '[]'), os.environ['NODE_NAME'],
+          float(os.environ.get('LOCAL_DATA_LIMIT', 50)) * 2 ** 30)
@@ -0,0 +1,115 @@
+import subprocess
+import shutil
+import time
+import sys
+import os
+
+"""
+Samples the resource usage of this container and appends it to a file on the shared volume
+(read by Scheduler/telemetry.py), started in the background by entrypoint.sh:
+
+    python /telemetry.py /scripts/.metrics
+
+Every <INTERVAL> seconds one line '<time> <cpu seconds> <memory bytes> <read bytes> <written bytes>
+<gpu %> <gpu memory MiB>' is written. CPU and I/O are counters since the start of the container,
+the scheduler turns them into rates. The values come from the cgroup of the container (v2 or v1),
+the GPU from nvidia-smi if there is one (-1 otherwise).
+When the file is larger than MAX_BYTES it is started again (the old one is kept as <file>.1).
+"""
+
+INTERVAL = 5
+MAX_BYTES = 256 * 1024
+CGROUP = '/sys/fs/cgroup'
+
+
+def read(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def cpu_seconds():
+    stat = read(os.path.join(CGROUP, 'cpu.stat'))
+    if stat is not None:
+        for line in stat.splitlines():
+            key, value = line.split()
+            if key == 'usage_usec':
+                return int(value) / 1e6
+    usage = read(os.path.join(CGROUP, 'cpuacct', 'cpuacct.usage')) or read(os.path.join(CGROUP, 'cpu,cpuacct', 'cpuacct.usage'))
+    return int(usage) / 1e9 if usage else -1
+
+
+def memory_bytes():
+    """ Working set (usage without inactive file pages, as 'kubectl top' shows it) """
+    for usage_file, stat_file, inactive_key in (('memory.current', 'memory.stat', 'inactive_file'),
+                                                ('memory/memory.usage_in_bytes', 'memory/memory.stat',
+                                                 'total_inactive_file')):
+        usage = read(os.path.join(CGROUP, usage_file))
+        if usage is None:
+            continue
+        inactive = 0
+        for line in (read(os.path.join(CGROUP, stat_file)) or '').splitlines():
+            key, value = line.split()
+            if key == inactive_key:
+                inactive = int(value)
+        return max(int(usage) - inactive, 0)
+    return -1
+
+
+def io_bytes():
+    """ (read, written) bytes of all devices """
+    rbytes = wbytes = 0
+    stat = read(os.path.join(CGROUP, 'io.stat'))
+    if stat is not None:
+        for line in stat.splitlines():
+            for field in line.split()[1:]:
+                key, _, value = field.partition('=')
+                if key == 'rbytes':
+                    rbytes += int(value)
+                elif key == 'wbytes':
+                    wbytes += int(value)
+        return rbytes, wbytes
+    stat = read(os.path.join(CGROUP, 'blkio', 'blkio.throttle.io_service_bytes'))
+    if stat is None:
+        return -1, -1
+    for line in stat.splitlines():
+        parts = line.split()
+        if len(parts) == 3 and parts[1] == 'Read':
+            rbytes += int(parts[2])
+        elif len(parts) == 3 and parts[1] == 'Write':
+            wbytes += int(parts[2])
+    return rbytes, wbytes
+
+
+def gpu():
+    """ (utilization %, memory MiB) summed over all GPUs of the container, (-1, -1) without GPU """
+    if shutil.which('nvidia-smi') is None:
+        return -1, -1
+    try:
+        out = subprocess.run(['nvidia-smi', '--query-gpu=utilization.gpu,memory.used', '--format=csv,noheader,nounits'],
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=2, check=True).stdout
+    except (OSError, subprocess.SubprocessError):
+        return -1, -1
+    values = [[float(v) for v in line.split(',')] for line in out.decode().splitlines() if line.strip()]
+    if not values:
+        return -1, -1
+    return sum(v[0] for v in values), sum(v[1] for v in values)
+
+
+def main(path):
+    while True:
+        sample = (time.time(), cpu_seconds(), memory_bytes()) + io_bytes() + gpu()
+        try:
+            if os.path.getsize(path) > MAX_BYTES:
+                os.replace(path, path + '.1')
+        except OSError:
+            pass
+        with open(path, 'a') as f:
+            f.write("%.3f %.3f %d %d %d %g %g\n" % sample)
+        time.sleep(INTERVAL)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])